@@ -1,27 +1,183 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify
+from flask import Flask, Request, render_template, request, redirect, url_for, flash, jsonify
 from flask_sqlalchemy import SQLAlchemy
 from werkzeug.utils import secure_filename
-from PIL import Image
-import pytesseract
-import cv2
-import numpy as np
+from werkzeug.http import is_resource_modified
+import click
 import re
 import os
+import io
+import hashlib
+import json
+import logging
+import threading
+import time
+import uuid
+import zlib
+from sqlalchemy.orm import selectinload
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import nullcontext
+from functools import lru_cache
+from typing import NamedTuple
+from itertools import groupby
 from datetime import datetime, timedelta
-from dateutil import parser
 import tempfile
 
+# OpenCV, NumPy, Pillow, Tesseract and dateutil are imported where they are used, so
+# workers that only serve pages and the API start without them. get_processor() loads
+# the OCR stack on the first OCR, or at startup with OCR_PRELOAD.
+from ocr_cache import OCRCache
+from jobs import JobWorkerPool
+from item_catalog import ItemCatalog, edit_distance
+from ocr_ranking import ConfigRanking
+from cpu_budget import OCRBusy, OCRLimiter, available_cpus, limit_native_threads, plan_budget
+from database import configure_engine, engine_options, exclusive_lock, retry_write, sqlite_pragmas
+from metrics import registry as metrics_registry, CONTENT_TYPE as METRICS_CONTENT_TYPE
+
+class InMemoryUploadRequest(Request):
+    """Keep uploaded files in memory instead of spooling large ones to a temp file.
+    
+    Uploads are bounded by MAX_CONTENT_LENGTH, so this never holds more than 16MB.
+    """
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return io.BytesIO()
+
 app = Flask(__name__)
+app.request_class = InMemoryUploadRequest
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'your-secret-key-here-change-in-production')
 app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///costco_receipts.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['UPLOAD_FOLDER'] = 'uploads'
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
+# Uploads are processed in memory; set to keep a copy of each image in UPLOAD_FOLDER
+app.config['ARCHIVE_UPLOADS'] = os.environ.get('ARCHIVE_UPLOADS', 'False').lower() == 'true'
+# Per-line parser and full OCR text output is logged at DEBUG only
+app.config['LOG_LEVEL'] = os.environ.get('LOG_LEVEL', 'INFO').upper()
+# CPU budget: the cores the app may use, split between WEB_CONCURRENCY worker processes
+# (gunicorn.conf.py exports the worker count). Each worker gets an equal share of
+# OpenCV/OpenMP threads and concurrent OCR passes.
+app.config['CPU_BUDGET'] = int(os.environ.get('CPU_BUDGET', 0)) or available_cpus()
+app.config['WEB_CONCURRENCY'] = int(os.environ.get('WEB_CONCURRENCY', 1))
+app.config['CPU_THREADS_PER_WORKER'] = int(os.environ.get(
+    'CPU_THREADS_PER_WORKER', plan_budget(app.config['CPU_BUDGET'], app.config['WEB_CONCURRENCY']).threads_per_worker))
+# Receipts OCR'd at once per process, how many more may queue, and for how long, before uploads get a 503
+app.config['OCR_MAX_CONCURRENT'] = int(os.environ.get('OCR_MAX_CONCURRENT', app.config['CPU_THREADS_PER_WORKER']))
+app.config['OCR_QUEUE_DEPTH'] = int(os.environ.get('OCR_QUEUE_DEPTH', 2 * app.config['OCR_MAX_CONCURRENT']))
+app.config['OCR_QUEUE_TIMEOUT'] = float(os.environ.get('OCR_QUEUE_TIMEOUT', 30))
+# Run the OCR config sweep concurrently and stop at the first good-enough result
+app.config['OCR_PARALLEL'] = os.environ.get('OCR_PARALLEL', 'False').lower() == 'true'
+app.config['OCR_POOL_SIZE'] = int(os.environ.get('OCR_POOL_SIZE', app.config['CPU_THREADS_PER_WORKER']))
+# An OCR output is good enough to stop the sweep with this many parsed items at this
+# mean Tesseract word confidence (0-100)
+app.config['OCR_MIN_ITEM_LINES'] = int(os.environ.get('OCR_MIN_ITEM_LINES', 3))
+app.config['OCR_MIN_CONFIDENCE'] = float(os.environ.get('OCR_MIN_CONFIDENCE', 70))
+# Try the OCR configs that win most often first; win counts are shared through the database
+app.config['OCR_ADAPTIVE_ORDER'] = os.environ.get('OCR_ADAPTIVE_ORDER', 'True').lower() == 'true'
+app.config['OCR_RANKING_REFRESH_SECONDS'] = float(os.environ.get('OCR_RANKING_REFRESH_SECONDS', 60))
+# Start with one cheap pass and escalate to more configs and the quality preprocessing
+# only while the items don't add up to the receipt's SUBTOTAL
+app.config['OCR_ESCALATION'] = os.environ.get('OCR_ESCALATION', 'True').lower() == 'true'
+# How many of the top-ranked configs the escalation runs on the quality preprocessing
+app.config['OCR_QUALITY_CONFIGS'] = int(os.environ.get('OCR_QUALITY_CONFIGS', 2))
+# Cut the receipt into horizontal line strips and OCR them in parallel
+app.config['OCR_SEGMENTATION'] = os.environ.get('OCR_SEGMENTATION', 'False').lower() == 'true'
+app.config['OCR_STRIP_LINES'] = int(os.environ.get('OCR_STRIP_LINES', 4))
+# 'auto' uses warm in-process tesserocr engines when installed, else pytesseract
+app.config['OCR_BACKEND'] = os.environ.get('OCR_BACKEND', 'auto')
+# Load the OCR stack when the app starts instead of on the first upload
+app.config['OCR_PRELOAD'] = os.environ.get('OCR_PRELOAD', 'False').lower() == 'true'
+# Preprocessing profile: 'quality' (full-resolution NL-means denoise) or 'fast'
+app.config['PREPROCESS_PROFILE'] = os.environ.get('PREPROCESS_PROFILE', 'quality')
+# The fast profile rescales the receipt so its text lands at roughly this DPI
+app.config['PREPROCESS_TARGET_DPI'] = int(os.environ.get('PREPROCESS_TARGET_DPI', 300))
+# Disk-backed OCR result cache keyed on the uploaded image bytes
+app.config['OCR_CACHE_ENABLED'] = os.environ.get('OCR_CACHE_ENABLED', 'True').lower() == 'true'
+app.config['OCR_CACHE_PATH'] = os.environ.get('OCR_CACHE_PATH', os.path.join(app.instance_path, 'ocr_cache.db'))
+app.config['OCR_CACHE_MAX_BYTES'] = int(os.environ.get('OCR_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+# Queue uploads as background jobs instead of processing them inside the request
+app.config['ASYNC_PROCESSING'] = os.environ.get('ASYNC_PROCESSING', 'False').lower() == 'true'
+app.config['JOB_WORKERS'] = int(os.environ.get('JOB_WORKERS', 2))
+app.config['JOB_POLL_INTERVAL'] = float(os.environ.get('JOB_POLL_INTERVAL', 2.0))
+app.config['JOB_STALE_SECONDS'] = int(os.environ.get('JOB_STALE_SECONDS', 600))
+# Correct misread item numbers and descriptions against items seen on earlier receipts
+app.config['ITEM_CATALOG_ENABLED'] = os.environ.get('ITEM_CATALOG_ENABLED', 'True').lower() == 'true'
+app.config['ITEM_CATALOG_REFRESH_SECONDS'] = float(os.environ.get('ITEM_CATALOG_REFRESH_SECONDS', 60))
+# Keep each receipt's raw OCR text (compressed) so it can be re-parsed later
+app.config['KEEP_OCR_TEXT'] = os.environ.get('KEEP_OCR_TEXT', 'True').lower() == 'true'
+# Receipts per /history page
+app.config['HISTORY_PAGE_SIZE'] = int(os.environ.get('HISTORY_PAGE_SIZE', 25))
+# Most purchases /api/item returns per item, and most items per /api/items request
+app.config['ITEM_HISTORY_MAX_LIMIT'] = int(os.environ.get('ITEM_HISTORY_MAX_LIMIT', 1000))
+app.config['ITEM_HISTORY_MAX_ITEMS'] = int(os.environ.get('ITEM_HISTORY_MAX_ITEMS', 100))
+# Seconds a connection waits for SQLite's write lock, and how often a locked write is retried
+app.config['DB_BUSY_TIMEOUT'] = float(os.environ.get('DB_BUSY_TIMEOUT', 30))
+app.config['DB_WRITE_RETRIES'] = int(os.environ.get('DB_WRITE_RETRIES', 5))
+# SQLite tuning; WAL lets readers and the writer in different workers proceed together
+app.config['SQLITE_JOURNAL_MODE'] = os.environ.get('SQLITE_JOURNAL_MODE', 'WAL')
+app.config['SQLITE_SYNCHRONOUS'] = os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL')
+app.config['SQLITE_CACHE_SIZE_KB'] = int(os.environ.get('SQLITE_CACHE_SIZE_KB', 32768))
+app.config['SQLITE_MMAP_SIZE'] = int(os.environ.get('SQLITE_MMAP_SIZE', 256 * 1024 * 1024))
+# Connection pool for server databases (PostgreSQL, MySQL) given via DATABASE_URL
+app.config['DB_POOL_SIZE'] = int(os.environ.get('DB_POOL_SIZE', 5))
+app.config['DB_MAX_OVERFLOW'] = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+app.config['DB_POOL_RECYCLE'] = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(
+    app.config['SQLALCHEMY_DATABASE_URI'],
+    busy_timeout=app.config['DB_BUSY_TIMEOUT'],
+    pool_size=app.config['DB_POOL_SIZE'],
+    max_overflow=app.config['DB_MAX_OVERFLOW'],
+    pool_recycle=app.config['DB_POOL_RECYCLE']
+)
 
 db = SQLAlchemy(app)
+with app.app_context():
+    configure_engine(db.engine, sqlite_pragmas(
+        journal_mode=app.config['SQLITE_JOURNAL_MODE'],
+        synchronous=app.config['SQLITE_SYNCHRONOUS'],
+        cache_size_kb=app.config['SQLITE_CACHE_SIZE_KB'],
+        mmap_size=app.config['SQLITE_MMAP_SIZE'],
+        busy_timeout=app.config['DB_BUSY_TIMEOUT']
+    ))
+
+logging.basicConfig(level=app.config['LOG_LEVEL'],
+                    format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+logger = logging.getLogger(__name__)
+
+# Metrics served on /metrics
+STAGE_SECONDS = metrics_registry.histogram(
+    'receipt_stage_seconds', 'Time spent in each receipt processing stage', ['stage'])
+PREPROCESS_SECONDS = metrics_registry.histogram(
+    'receipt_preprocess_step_seconds', 'Time spent in each image decode/preprocessing step', ['profile', 'step'])
+OCR_PASS_SECONDS = metrics_registry.histogram(
+    'receipt_ocr_pass_seconds', 'Time spent in a single OCR pass', ['config'])
+OCR_SWEEP_PASSES = metrics_registry.histogram(
+    'receipt_ocr_sweep_passes', 'Whole-page OCR passes run per receipt, by the tier the sweep stopped at', ['tier'],
+    buckets=(1, 2, 3, 4, 5, 6, 8, 11))
+TOTALS_TOTAL = metrics_registry.counter(
+    'receipt_totals_total', 'Stored receipts by how their items compare with the printed SUBTOTAL', ['status'])
+RECEIPTS_TOTAL = metrics_registry.counter(
+    'receipt_processed_total', 'Receipts processed, by outcome', ['result'])
+ITEMS_TOTAL = metrics_registry.counter(
+    'receipt_items_parsed_total', 'Items parsed from stored receipts')
+OCR_CACHE_TOTAL = metrics_registry.counter(
+    'receipt_ocr_cache_lookups_total', 'OCR cache lookups, by result', ['result'])
+DB_WRITE_RETRIES = metrics_registry.counter(
+    'receipt_db_write_retries_total', 'Database writes retried because the database was locked')
+
+def ocr_config_label(config):
+    """Short metric label for a Tesseract config string, e.g. psm6+whitelist"""
+    from ocr_backends import parse_tesseract_config
+    psm, variables = parse_tesseract_config(config)
+    label = f'psm{psm}' if psm is not None else 'default'
+    if 'tessedit_char_whitelist' in variables:
+        label += '+whitelist'
+    return label
 
-# Ensure upload folder exists
-os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+# Prices older than this are ignored when looking for a lower price elsewhere
+PRICE_WINDOW_DAYS = 30
+
+# Ensure upload folder exists when images are archived
+if app.config['ARCHIVE_UPLOADS']:
+    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 
 # Database Models
 class Receipt(db.Model):
@@ -30,7 +186,31 @@ class Receipt(db.Model):
     store_number = db.Column(db.String(50), nullable=False)
     upload_date = db.Column(db.DateTime, default=datetime.utcnow)
     receipt_date = db.Column(db.DateTime, nullable=True)
+    ocr_text_compressed = db.Column(db.LargeBinary, nullable=True)  # zlib-compressed raw OCR output
+    ocr_config = db.Column(db.String(100), nullable=True)
+    # Amounts printed on the receipt, and how the parsed items compare with the SUBTOTAL
+    subtotal = db.Column(db.Float, nullable=True)
+    tax = db.Column(db.Float, nullable=True)
+    total = db.Column(db.Float, nullable=True)
+    totals_status = db.Column(db.String(20), nullable=True)  # reconciled, mismatch or missing
+    totals_difference = db.Column(db.Float, nullable=True)  # SUBTOTAL minus the parsed line prices
     items = db.relationship('ReceiptItem', backref='receipt', lazy=True, cascade="all, delete-orphan")
+    
+    __table_args__ = (
+        # Keyset pagination order for /history
+        db.Index('ix_receipt_upload_date_id', 'upload_date', 'id'),
+    )
+    
+    @property
+    def ocr_text(self):
+        """The raw OCR text the receipt was parsed from, if it was kept"""
+        if self.ocr_text_compressed is None:
+            return None
+        return zlib.decompress(self.ocr_text_compressed).decode('utf-8')
+    
+    @ocr_text.setter
+    def ocr_text(self, text):
+        self.ocr_text_compressed = zlib.compress(text.encode('utf-8'), 6) if text is not None else None
 
 class ReceiptItem(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -41,9 +221,118 @@ class ReceiptItem(db.Model):
     original_price = db.Column(db.Float, nullable=True)  # Original price before discount
     discount = db.Column(db.Float, default=0)  # Discount amount
     date_recorded = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        # Covers the recent-lowest-price lookup without touching the table
+        db.Index('ix_receipt_item_number_date_price', 'item_number', 'date_recorded', 'price'),
+        db.Index('ix_receipt_item_receipt_id', 'receipt_id'),
+    )
+
+class ItemPriceSummary(db.Model):
+    """Running price summary per item, across all stores (store_number '') and per store"""
+    item_number = db.Column(db.String(50), primary_key=True)
+    store_number = db.Column(db.String(50), primary_key=True, default='')
+    last_price = db.Column(db.Float, nullable=False)
+    last_seen = db.Column(db.DateTime, nullable=False)
+    last_store_address = db.Column(db.String(500), nullable=True)
+    min_price = db.Column(db.Float, nullable=True)  # Lowest price within PRICE_WINDOW_DAYS
+    min_seen = db.Column(db.DateTime, nullable=True)
+    min_store_address = db.Column(db.String(500), nullable=True)
+    observation_count = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, nullable=True)  # Last write, by a new purchase or a rebuild
+    
+    def to_dict(self):
+        return {
+            'item_number': self.item_number,
+            'store_number': self.store_number or None,
+            'last_price': self.last_price,
+            'last_seen': self.last_seen.isoformat(),
+            'last_store': self.last_store_address,
+            'min_price': self.min_price,
+            'min_seen': self.min_seen.isoformat() if self.min_seen else None,
+            'min_store': self.min_store_address,
+            'observations': self.observation_count
+        }
+
+class SpendingRollup(db.Model):
+    """Running spend totals: overall (dimension 'total', key ''), per store, per month and per item"""
+    dimension = db.Column(db.String(10), primary_key=True)  # total, store, month, item
+    key = db.Column(db.String(50), primary_key=True, default='')  # Store number, YYYY-MM or item number
+    label = db.Column(db.String(500), nullable=True)  # Store address or item description
+    receipt_count = db.Column(db.Integer, nullable=False, default=0)
+    item_count = db.Column(db.Integer, nullable=False, default=0)
+    spend = db.Column(db.Float, nullable=False, default=0)
+    discount = db.Column(db.Float, nullable=False, default=0)
+    top_price = db.Column(db.Float, nullable=True)
+    top_price_item = db.Column(db.String(50), nullable=True)
+    top_discount = db.Column(db.Float, nullable=True)
+    top_discount_item = db.Column(db.String(50), nullable=True)
+    updated_at = db.Column(db.DateTime, nullable=True)
+    
+    __table_args__ = (
+        # Top stores/items by spend without sorting the whole table
+        db.Index('ix_spending_rollup_dimension_spend', 'dimension', 'spend'),
+    )
+    
+    def to_dict(self):
+        return {
+            'key': self.key or None,
+            'label': self.label,
+            'receipts': self.receipt_count,
+            'items': self.item_count,
+            'spend': round(self.spend, 2),
+            'discount': round(self.discount, 2),
+            'top_price': {'item_number': self.top_price_item, 'price': self.top_price} if self.top_price_item else None,
+            'top_discount': {'item_number': self.top_discount_item, 'discount': self.top_discount}
+            if self.top_discount_item else None
+        }
+
+class OCRConfigStat(db.Model):
+    """How often each OCR config was tried in a sweep and how often its output was kept"""
+    config = db.Column(db.String(200), primary_key=True)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    wins = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, nullable=True)
+
+class ImportedFile(db.Model):
+    """Image files loaded by bulk_import.py, so an interrupted import can resume"""
+    sha256 = db.Column(db.String(64), primary_key=True)
+    path = db.Column(db.String(1000), nullable=False)
+    receipt_id = db.Column(db.Integer, db.ForeignKey('receipt.id'), nullable=True)  # None when the file failed
+    error = db.Column(db.Text, nullable=True)
+    imported_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class ProcessingJob(db.Model):
+    id = db.Column(db.String(32), primary_key=True, default=lambda: uuid.uuid4().hex)
+    status = db.Column(db.String(20), nullable=False, default='queued', index=True)  # queued, running, done, failed
+    filename = db.Column(db.String(255), nullable=False)
+    image_data = db.Column(db.LargeBinary, nullable=True)  # Dropped once the job finishes
+    result = db.Column(db.Text, nullable=True)  # JSON of the data results.html renders
+    error = db.Column(db.Text, nullable=True)
+    receipt_id = db.Column(db.Integer, db.ForeignKey('receipt.id'), nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+class ReceiptProcessingError(Exception):
+    """A receipt that could not be processed; the message is shown to the user"""
+
+class OCRScore(NamedTuple):
+    """How well an OCR output reads; compared field by field, best first"""
+    reconciled: bool  # The parsed line prices add up to the receipt's SUBTOTAL
+    items: int
+    confidence: float  # Tesseract's mean word confidence, 0-100
+    has_totals: bool
 
 class ReceiptProcessor:
-    def __init__(self):
+    PREPROCESS_PROFILES = ('quality', 'fast')
+    RECEIPT_WIDTH_INCHES = 3.125  # 80mm thermal paper
+    TOTALS_TOLERANCE = 0.01  # Dollars the line prices may differ from SUBTOTAL by rounding
+    
+    def __init__(self, parallel_ocr=False, ocr_pool_size=None, min_item_lines=3, ocr_backend=None,
+                 ocr_cache=None, preprocess_profile='quality', target_dpi=300,
+                 segmentation=False, strip_lines=4, item_catalog=None, max_ocr_passes=None, ocr_limiter=None,
+                 min_confidence=70, config_ranking=None, escalate=True, quality_configs=2):
         # More flexible patterns for different receipt formats
         self.item_patterns = [
             # P0: Standard pattern: item_number, description, price. Price can be "12.34" or "12.34-"
@@ -62,259 +351,795 @@ class ReceiptProcessor:
         self.store_pattern = r'([A-Z\s]+#\d+)'
         self.address_pattern = r'(\d+\s+[A-Z\s]+(?:BLVD|AVE|ST|RD|DR|LN|CT|WAY))\s*([A-Z\s]+,\s*[A-Z]{2}\s*\d{5})'
         
-    def preprocess_image(self, image_path):
-        """Enhanced image preprocessing for better OCR results"""
-        # Read image
-        image = cv2.imread(image_path)
+        # Precompiled patterns for the single-pass line classifier
+        self.item_regexes = [re.compile(pattern, re.IGNORECASE) for pattern in self.item_patterns]
+        self.item_prefilter = re.compile(r'\d{6}')
+        self.price_regex = re.compile(r'^\d+\.\d{2}$')
+        self.discount_reference_regex = re.compile(r'/(\d{6,8})')
+        self.store_number_regex = re.compile(r'([A-Z\s]+)#(\d+)')
+        self.store_anchor_regex = re.compile(r'[A-Z\s]#\d')
+        self.line_start_store_regex = re.compile(r'#\d')
+        self.caps_line_regex = re.compile(r'[A-Z\s]*')
+        self.street_regex = re.compile(r'\d+\s+[A-Z\s]+(BLVD|AVE|ST|RD|DR|LN|CT|WAY)')
+        self.city_regex = re.compile(r'[A-Z\s]+,\s*[A-Z]{2}\s*\d{5}')
+        self.total_regex = re.compile(r'\b(?:SUB\s*TOTAL|TOTAL|TAX)\b', re.IGNORECASE)
+        # "SUBTOTAL 39.46", "TAX 2.10", "**** TOTAL 41.56"; SUBTOTAL is tried before TOTAL
+        self.total_amount_regex = re.compile(r'\b(SUB\s*TOTAL|TOTAL\s+TAX|TAX|TOTAL)\b[\s:$*]*(\d+\.\d{2})', re.IGNORECASE)
+        self.date_regexes = [
+            re.compile(r'\d{1,2}/\d{1,2}/\d{4}'),
+            re.compile(r'\d{4}-\d{2}-\d{2}'),
+            re.compile(r'\d{2}/\d{2}/\d{4}')
+        ]
+        self.any_date_regex = re.compile('|'.join(pattern.pattern for pattern in self.date_regexes))
+        self.loose_price_regex = re.compile(r'(\d+\.\d{2})[-]?\s*$')
+        self.loose_item_number_regex = re.compile(r'^(\d{6,8})')
+        self.loose_cleanup_regex = re.compile(r'[*\s]+')
+        
+        # OCR configurations, in the order they are tried
+        self.ocr_configs = [
+            '--psm 6 -c tessedit_char_whitelist=0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz .,/$-#*',
+            '--psm 4 -c tessedit_char_whitelist=0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz .,/$-#*',
+            '--psm 6',
+            '--psm 4',
+            '--psm 3'
+        ]
+        
+        # Sweep settings. Outputs are scored by the items extract_items finds and
+        # Tesseract's mean word confidence; the sweep stops at the first output with
+        # at least min_item_lines items and min_confidence. config_ranking (if any)
+        # orders the configs by how often each one wins.
+        self.parallel_ocr = parallel_ocr
+        self.ocr_pool_size = max(1, ocr_pool_size or os.cpu_count() or 1)
+        self.min_item_lines = min_item_lines
+        self.min_confidence = min_confidence
+        self.config_ranking = config_ranking
+        # Escalation: cheap passes first, more configs and the quality preprocessing
+        # only for receipts whose totals don't reconcile
+        self.escalate = escalate
+        self.quality_configs = max(1, quality_configs)  # Top-ranked configs run on the quality preprocessing
+        self._ocr_executor = None
+        
+        # Line-strip segmentation: one-line strips use the single-line PSM,
+        # taller strips the uniform-block PSM
+        self.segmentation = segmentation
+        self.strip_lines = max(1, strip_lines)
+        self.line_ocr_config = '--psm 7'
+        self.strip_ocr_config = '--psm 6'
+        
+        if ocr_backend is None:
+            from ocr_backends import PytesseractBackend
+            ocr_backend = PytesseractBackend()
+        self.ocr_backend = ocr_backend
+        self.ocr_cache = ocr_cache
+        # CPU budget: Tesseract passes running at once (across all receipts) and
+        # receipts admitted to OCR at once, with a bounded queue in front
+        self._ocr_pass_slots = threading.BoundedSemaphore(max_ocr_passes) if max_ocr_passes else None
+        self.ocr_limiter = ocr_limiter
+        # Known item numbers from earlier receipts, for correcting OCR misreads
+        self.item_catalog = item_catalog
+        
+        if preprocess_profile not in self.PREPROCESS_PROFILES:
+            raise ValueError(f"Unknown preprocessing profile: {preprocess_profile}")
+        self.preprocess_profile = preprocess_profile
+        self.target_width = int(target_dpi * self.RECEIPT_WIDTH_INCHES)
+        
+    def timed_stage(self, profile, stage):
+        """Record how long a preprocessing stage takes under a profile"""
+        return PREPROCESS_SECONDS.time(profile=profile, step=stage)
+    
+    def timing_stats(self):
+        """Average stage times per profile, for picking a profile per deployment"""
+        stats = {}
+        for (profile, stage), (count, total) in PREPROCESS_SECONDS.totals().items():
+            stats.setdefault(profile, {})[stage] = {
+                'count': count,
+                'total_seconds': round(total, 4),
+                'avg_ms': round(total / count * 1000, 2)
+            }
+        return stats
+    
+    def ocr_pass(self, image, config):
+        """One timed OCR pass through the configured backend"""
+        with self._ocr_pass_slots or nullcontext():
+            with OCR_PASS_SECONDS.time(config=ocr_config_label(config)):
+                return self.ocr_backend.image_to_string(image, config=config)
+    
+    def ocr_pass_with_confidence(self, image, config):
+        """One timed OCR pass returning (text, Tesseract's mean word confidence)"""
+        with self._ocr_pass_slots or nullcontext():
+            with OCR_PASS_SECONDS.time(config=ocr_config_label(config)):
+                return self.ocr_backend.image_to_text_with_confidence(image, config=config)
+    
+    def scored_ocr_pass(self, image, config):
+        """One timed OCR pass returning (text, score); see score_ocr_text"""
+        text, confidence = self.ocr_pass_with_confidence(image, config)
+        return text, self.score_ocr_text(text, confidence)
+    
+    def score_ocr_text(self, text, confidence):
+        """How well an OCR output reads, as an OCRScore.
+        
+        Scores compare as tuples: an output whose item prices add up to its
+        SUBTOTAL beats any that doesn't, then more items win and confidence
+        breaks ties. Unlike the text length, none of these rewards the stray
+        characters of a noisy pass.
+        """
+        classified = self.classify_lines(text)
+        items = self.extract_items(text, classified, timed=False)
+        totals = self.reconcile_totals(items, self.extract_totals(text, classified), classified)
+        return OCRScore(reconciled=totals['status'] == 'reconciled', items=len(items),
+                        confidence=round(confidence, 2), has_totals=totals['status'] != 'missing')
+    
+    def is_good_enough(self, score):
+        """Quality bar for stopping the configs on one image early.
+        
+        Reconciled totals settle it; otherwise enough items at enough confidence
+        will do. Totals that were read but don't add up rarely come right under
+        another config on the same image, so they don't hold up the sweep;
+        run_ocr_tiers gives them the configured preprocessing instead.
+        """
+        if score.reconciled:
+            return True
+        return score.items >= self.min_item_lines and score.confidence >= self.min_confidence
+    
+    def ranked_configs(self):
+        """The OCR configs in the order a sweep tries them"""
+        if self.config_ranking is None:
+            return list(self.ocr_configs)
+        return self.config_ranking.order(self.ocr_configs)
+    
+    def ocr_tiers(self, profile):
+        """[(tier, image, configs)] in the order they are tried; image is a preprocessing profile or 'original'.
+        
+        With escalation, the first tier is a single pass of the top-ranked config
+        over the fast preprocessing, then the other configs on the same image,
+        then (unless the fast profile was asked for) the top quality_configs
+        configs over the configured preprocessing. The last resort is the
+        unprocessed grayscale image.
+        """
+        configs = self.ranked_configs()
+        if not self.escalate:
+            return [('sweep', profile, configs), ('original', 'original', ['--psm 6'])]
+        tiers = [('cheap', 'fast', configs[:1]), ('sweep', 'fast', configs[1:])]
+        if profile != 'fast':
+            tiers.append(('quality', profile, configs[:self.quality_configs]))
+        tiers.append(('original', 'original', ['--psm 6']))
+        return tiers
+    
+    def record_sweep(self, tier, passes, tried, winner):
+        """Count a receipt's OCR passes and, for the ranking, which configs were tried and which one won"""
+        OCR_SWEEP_PASSES.observe(passes, tier=tier)
+        if self.config_ranking is not None and winner is not None:
+            self.config_ranking.record(tried, winner)
+    
+    def decode_image(self, image_bytes, profile=None):
+        """Decode uploaded image bytes into an array without touching disk.
+        
+        The quality profile decodes full-size BGR. The fast profile decodes straight
+        to grayscale, letting the JPEG decoder downscale when the image is far larger
+        than the target resolution.
+        """
+        import cv2
+        import numpy as np
+        
+        profile = profile or self.preprocess_profile
+        buffer = np.frombuffer(image_bytes, dtype=np.uint8)
+        with self.timed_stage(profile, 'decode'):
+            if profile == 'fast':
+                image = cv2.imdecode(buffer, self._reduced_decode_flag(image_bytes))
+            else:
+                image = cv2.imdecode(buffer, cv2.IMREAD_COLOR)
         if image is None:
             raise ValueError("Could not read image file")
+        return image
+    
+    def _reduced_decode_flag(self, image_bytes):
+        """Largest grayscale decode reduction that stays above the target width"""
+        import cv2
+        from PIL import Image
+        
+        try:
+            # Only parses the header; the receipt's width is the photo's shorter side
+            receipt_width = min(Image.open(io.BytesIO(image_bytes)).size)
+        except Exception:
+            return cv2.IMREAD_GRAYSCALE
+        
+        for factor, flag in ((8, cv2.IMREAD_REDUCED_GRAYSCALE_8),
+                             (4, cv2.IMREAD_REDUCED_GRAYSCALE_4),
+                             (2, cv2.IMREAD_REDUCED_GRAYSCALE_2)):
+            if receipt_width // factor >= self.target_width:
+                return flag
+        return cv2.IMREAD_GRAYSCALE
+    
+    def to_grayscale(self, image):
+        if image.ndim == 2:
+            return image
+        import cv2
+        return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    
+    def normalize_resolution(self, gray):
+        """Scale the receipt so its width matches the target DPI"""
+        import cv2
+        
+        receipt_width = min(gray.shape[:2])
+        scale = self.target_width / receipt_width
+        if abs(scale - 1.0) < 0.1:
+            return gray
+        interpolation = cv2.INTER_AREA if scale < 1 else cv2.INTER_CUBIC
+        return cv2.resize(gray, None, fx=scale, fy=scale, interpolation=interpolation)
+    
+    def preprocess_image(self, image, profile=None):
+        """Enhanced image preprocessing for better OCR results"""
+        profile = profile or self.preprocess_profile
+        if profile == 'fast':
+            return self._preprocess_fast(image)
+        return self._preprocess_quality(image)
+    
+    def _preprocess_quality(self, image):
+        import cv2
+        import numpy as np
+        
+        profile = 'quality'
         
         # Convert to grayscale
-        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        with self.timed_stage(profile, 'grayscale'):
+            gray = self.to_grayscale(image)
         
         # Apply multiple preprocessing techniques
         # 1. Noise reduction
-        denoised = cv2.fastNlMeansDenoising(gray)
+        with self.timed_stage(profile, 'denoise'):
+            denoised = cv2.fastNlMeansDenoising(gray)
         
         # 2. Contrast enhancement
-        clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8,8))
-        enhanced = clahe.apply(denoised)
+        with self.timed_stage(profile, 'contrast'):
+            clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8,8))
+            enhanced = clahe.apply(denoised)
         
         # 3. Adaptive thresholding for better text extraction
-        binary = cv2.adaptiveThreshold(enhanced, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, 
-                                     cv2.THRESH_BINARY, 11, 2)
+        with self.timed_stage(profile, 'threshold'):
+            binary = cv2.adaptiveThreshold(enhanced, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, 
+                                         cv2.THRESH_BINARY, 11, 2)
         
         # 4. Morphological operations to clean up text
-        kernel = np.ones((1,1), np.uint8)
-        cleaned = cv2.morphologyEx(binary, cv2.MORPH_CLOSE, kernel)
+        with self.timed_stage(profile, 'morphology'):
+            kernel = np.ones((1,1), np.uint8)
+            cleaned = cv2.morphologyEx(binary, cv2.MORPH_CLOSE, kernel)
         
         return cleaned
     
-    def extract_text_from_image(self, image_path):
-        """Extract text from receipt image using multiple OCR configurations"""
+    def _preprocess_fast(self, image):
+        """Cheaper pipeline: normalize resolution first, then run light filters.
+        
+        Replaces the NL-means denoiser with a 3x3 median blur and drops the 1x1
+        morphological close, which does not change the image.
+        """
+        import cv2
+        
+        profile = 'fast'
+        
+        with self.timed_stage(profile, 'grayscale'):
+            gray = self.to_grayscale(image)
+        
+        with self.timed_stage(profile, 'resize'):
+            normalized = self.normalize_resolution(gray)
+        
+        with self.timed_stage(profile, 'denoise'):
+            denoised = cv2.medianBlur(normalized, 3)
+        
+        with self.timed_stage(profile, 'contrast'):
+            clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8,8))
+            enhanced = clahe.apply(denoised)
+        
+        with self.timed_stage(profile, 'threshold'):
+            binary = cv2.adaptiveThreshold(enhanced, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
+                                         cv2.THRESH_BINARY, 11, 2)
+        
+        return binary
+    
+    def extract_text_from_image(self, image_bytes, profile=None):
+        """Extract text from receipt image bytes using multiple OCR configurations"""
+        text, _ = self.extract_text_with_config(image_bytes, profile)
+        return text
+    
+    def extract_text_with_config(self, image_bytes, profile=None, wait=True):
+        """Extract text from receipt image bytes and report which OCR config produced it.
+        
+        Cache hits skip the OCR limiter. On a miss, wait=False raises OCRBusy
+        instead of queueing behind a full OCR queue.
+        """
+        profile = profile or self.preprocess_profile
+        cache_key = None
+        if self.ocr_cache is not None:
+            cache_key = self.ocr_cache.make_key(image_bytes, self.ocr_settings_key(profile))
+            cached = self.ocr_cache.get(cache_key)
+            if cached is not None:
+                OCR_CACHE_TOTAL.inc(result='hit')
+                logger.debug("OCR cache hit: %s", cache_key[:12])
+                return cached
+            OCR_CACHE_TOTAL.inc(result='miss')
+        
+        if self.ocr_limiter is None:
+            return self._extract_text(image_bytes, profile, cache_key)
+        with STAGE_SECONDS.time(stage='ocr_wait'):
+            token = self.ocr_limiter.acquire(wait=wait)
+        try:
+            return self._extract_text(image_bytes, profile, cache_key)
+        finally:
+            self.ocr_limiter.release(token)
+    
+    def _extract_text(self, image_bytes, profile, cache_key):
         try:
-            # Preprocess image
-            processed_image = self.preprocess_image(image_path)
+            best_text, best_config, _ = self.run_ocr_tiers(image_bytes, profile)
             
-            # Try multiple OCR configurations
-            ocr_configs = [
-                '--psm 6 -c tessedit_char_whitelist=0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz .,/$-#*',
-                '--psm 4 -c tessedit_char_whitelist=0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz .,/$-#*',
-                '--psm 6',
-                '--psm 4',
-                '--psm 3'
-            ]
+            # Full text only at DEBUG level; it is large and on every request
+            logger.debug("OCR extracted %d characters (config: %s)\n%s\n%s",
+                         len(best_text), best_config, best_text, "=" * 50)
             
-            best_text = ""
-            for config in ocr_configs:
-                try:
-                    text = pytesseract.image_to_string(processed_image, config=config)
-                    if len(text.strip()) > len(best_text.strip()):
-                        best_text = text
-                except:
-                    continue
+            if cache_key is not None and best_text.strip():
+                self.ocr_cache.put(cache_key, best_text, best_config)
             
-            # If no good text extracted, try with original image
-            if len(best_text.strip()) < 50:
-                original_image = cv2.imread(image_path, cv2.IMREAD_GRAYSCALE)
-                best_text = pytesseract.image_to_string(original_image, config='--psm 6')
+            return best_text, best_config
+        except Exception as e:
+            logger.error("OCR Error: %s", e)
+            return "", None
+    
+    def run_ocr_tiers(self, image_bytes, profile):
+        """OCR the receipt tier by tier (see ocr_tiers) until an output is good enough.
+        
+        Reconciled totals end it anywhere. An output that reads well (see
+        is_good_enough) ends the configs on its image; if its totals still
+        don't add up, the configured preprocessing gets a look before the
+        escalation settles for it. Only receipts that read poorly on every
+        image tried go on to more configs and the unprocessed image. Returns
+        (text, config, score) of the best output from all tiers tried.
+        """
+        decoded = {}
+        processed = {}
+        best_text, best_config, best_score = "", None, None
+        tried = []
+        passes = 0
+        segmented = False
+        settled = set()  # Images with an output that reads well; more configs on them are skipped
+        profile_tried = False
+        tier = None
+        for tier, image_profile, configs in self.ocr_tiers(profile):
+            if not configs or image_profile in settled:
+                continue
+            source_profile = profile if image_profile == 'original' else image_profile
+            if source_profile not in decoded:
+                decoded[source_profile] = self.decode_image(image_bytes, source_profile)
+            if image_profile == 'original':
+                image = self.to_grayscale(decoded[source_profile])
+            else:
+                if image_profile not in processed:
+                    processed[image_profile] = self.preprocess_image(decoded[image_profile], image_profile)
+                image = processed[image_profile]
             
-            # Debug: Print extracted text (remove in production)
-            print(f"OCR Extracted text length: {len(best_text)}")
-            print("FULL EXTRACTED TEXT:")
-            print(best_text)
-            print("="*50)
+            # OCR line strips in parallel before the first whole-page sweep
+            if self.segmentation and not segmented:
+                segmented = True
+                text, config, score = self.run_ocr_segmented(image)
+                if config is not None and (best_score is None or score > best_score):
+                    best_text, best_config, best_score = text, config, score
+                if config is not None and self.is_good_enough(score):
+                    settled.add(image_profile)
             
-            return best_text
-        except Exception as e:
-            print(f"OCR Error: {e}")
-            return ""
+            if image_profile not in settled:
+                text, config, score, tier_tried = self.run_ocr_sweep(image, configs)
+                passes += len(tier_tried)
+                if image_profile == 'original':
+                    config = f'original {config}' if config else None
+                else:
+                    tried += tier_tried
+                if score is not None and (best_score is None or score > best_score):
+                    best_text, best_config, best_score = text, config, score
+                if score is not None and self.is_good_enough(score):
+                    settled.add(image_profile)
+            
+            profile_tried = profile_tried or image_profile == profile
+            if best_score is None:
+                continue
+            if best_score.reconciled:
+                break
+            # Reads well but doesn't reconcile: settle once the configured preprocessing has had its go
+            if self.is_good_enough(best_score) and profile_tried:
+                break
+        
+        self.record_sweep(tier, passes, tried, best_config)
+        return best_text, best_config, best_score
+    
+    def ocr_settings_key(self, profile=None):
+        """Everything besides the image that changes the OCR output, for cache keys"""
+        profile = profile or self.preprocess_profile
+        parts = [self.ocr_backend.name, profile, *self.ocr_configs]
+        if profile == 'fast':
+            parts.append(f'width:{self.target_width}')
+        parts.append(f'good-enough:{self.min_item_lines}/{self.min_confidence}')
+        if self.escalate:
+            parts.append(f'escalate:{self.quality_configs}')
+        if self.parallel_ocr:
+            parts.append('parallel')
+        if self.segmentation:
+            parts.append(f'segmented:{self.strip_lines}')
+        return '|'.join(parts)
+    
+    def run_ocr_sweep(self, processed_image, configs):
+        """Sweep the given configs, concurrently in parallel mode; returns (text, config, score, tried)"""
+        if self.parallel_ocr and len(configs) > 1:
+            return self.run_ocr_configs_parallel(processed_image, configs)
+        return self.run_ocr_configs(processed_image, configs)
+    
+    def run_ocr_configs(self, processed_image, configs=None):
+        """Run the OCR configs in turn until one is good enough; keep the best-scoring output"""
+        best_text = ""
+        best_config = None
+        best_score = None
+        tried = []
+        for config in configs if configs is not None else self.ranked_configs():
+            try:
+                text, score = self.scored_ocr_pass(processed_image, config)
+            except Exception:
+                continue
+            tried.append(config)
+            if best_score is None or score > best_score:
+                best_text, best_config, best_score = text, config, score
+            if self.is_good_enough(score):
+                break
+        
+        return best_text, best_config, best_score, tried
+    
+    def run_ocr_configs_parallel(self, processed_image, configs=None):
+        """Run the OCR configs concurrently and return the first good-enough result.
+        
+        Tesseract runs out of process (pytesseract) or without the GIL (tesserocr),
+        so a thread pool is enough to use every core.
+        Configs are submitted in ranked order. Passes still queued when a result clears
+        the quality bar are cancelled; a pass that has already started finishes in the
+        background and its output is dropped. If nothing clears the bar, the best score
+        wins, ties going to the config ranked first, which matches the sequential sweep.
+        """
+        configs = configs if configs is not None else self.ranked_configs()
+        executor = self._get_ocr_executor()
+        futures = {
+            executor.submit(self.scored_ocr_pass, processed_image, config): index
+            for index, config in enumerate(configs)
+        }
+        
+        results = {}
+        try:
+            for future in as_completed(futures):
+                index = futures[future]
+                try:
+                    text, score = future.result()
+                except Exception:
+                    continue
+                
+                results[index] = (text, score)
+                if self.is_good_enough(score):
+                    return text, configs[index], score, [configs[i] for i in sorted(results)]
+        finally:
+            for future in futures:
+                future.cancel()
+        
+        best_text = ""
+        best_config = None
+        best_score = None
+        for index in sorted(results):
+            text, score = results[index]
+            if best_score is None or score > best_score:
+                best_text, best_config, best_score = text, configs[index], score
+        
+        return best_text, best_config, best_score, [configs[i] for i in sorted(results)]
+    
+    def run_ocr_segmented(self, processed_image):
+        """OCR the receipt as horizontal line strips spread across the OCR pool.
+        
+        Strip texts are joined back in top-to-bottom order, so parse_receipt_text
+        sees the same layout as a whole-page pass. Returns (text, config, score), or
+        ("", None, None) when the image does not split into lines (e.g. heavy
+        background noise).
+        """
+        import cv2
+        from segmentation import split_into_strips
+        
+        strips = split_into_strips(processed_image, self.strip_lines)
+        if len(strips) < 2:
+            return "", None, None
+        
+        executor = self._get_ocr_executor()
+        futures = []
+        for strip, line_count in strips:
+            # Tesseract does better with some white space around the text
+            padded = cv2.copyMakeBorder(strip, 10, 10, 10, 10, cv2.BORDER_CONSTANT, value=255)
+            config = self.line_ocr_config if line_count == 1 else self.strip_ocr_config
+            futures.append(executor.submit(self.ocr_pass_with_confidence, padded, config))
+        
+        texts = []
+        confidences = []
+        for future in futures:
+            try:
+                text, confidence = future.result()
+            except Exception:
+                text, confidence = '', 0.0
+            texts.append(text.strip('\n\x0c'))
+            confidences.append(confidence)
+        
+        text = '\n'.join(text for text in texts if text)
+        score = self.score_ocr_text(text, sum(confidences) / len(confidences))
+        return text, f'segmented ({len(strips)} strips)', score
+    
+    def _get_ocr_executor(self):
+        if self._ocr_executor is None:
+            self._ocr_executor = ThreadPoolExecutor(max_workers=self.ocr_pool_size,
+                                                    thread_name_prefix='ocr')
+        return self._ocr_executor
     
     def parse_receipt_text(self, text):
         """Parse extracted text to get structured data"""
-        lines = text.split('\n')
+        with STAGE_SECONDS.time(stage='parse'):
+            return self._parse_receipt_text(text)
+    
+    def _parse_receipt_text(self, text):
+        # Tag every line once and feed all extractors from the result
+        classified = self.classify_lines(text)
         
         # Extract store information
-        store_info = self.extract_store_info(text)
+        store_info = self.extract_store_info(text, classified)
         
         # Extract items
-        items = self.extract_items(text)
+        items = self.extract_items(text, classified)
         
         # Try to extract receipt date
-        receipt_date = self.extract_receipt_date(text)
+        receipt_date = self.extract_receipt_date(text, classified)
+        
+        # Check the items against the receipt's own SUBTOTAL
+        totals = self.reconcile_totals(items, self.extract_totals(text, classified), classified)
         
         return {
             'store_info': store_info,
             'items': items,
-            'receipt_date': receipt_date
+            'receipt_date': receipt_date,
+            'totals': totals
         }
     
-    def extract_store_info(self, text):
+    def classify_lines(self, text):
+        """Single pass over the receipt lines using the precompiled patterns.
+        
+        Each line is tagged once as header, address, item, discount, total, date or
+        other. The lookups the extractors need (first store line, first address line,
+        first match of each date pattern, raw item matches) are collected in the same
+        pass, so no extractor re-splits or re-scans the text.
+        """
+        lines = text.split('\n')
+        kinds = []
+        store_line = None
+        address_line = None
+        dates = {}  # date pattern index -> first match
+        raw_items = {}  # stripped line -> raw item, in line order
+        
+        for index, line in enumerate(lines):
+            stripped = line.strip()
+            kind = None
+            
+            # Item and discount lines
+            if len(stripped) >= 10:
+                raw_item = raw_items.get(stripped)
+                if raw_item is None:
+                    raw_item = self.match_item_line(stripped)
+                    if raw_item is not None:
+                        raw_items[stripped] = raw_item
+                if raw_item is not None:
+                    kind = raw_item['kind']
+            
+            # Header, address and date lookups only need their first hit; after that
+            # the checks only run to tag lines that are not items
+            is_store = False
+            if (store_line is None or kind is None) and '#' in line:
+                is_store = self.is_store_line(index, line)
+                if is_store and store_line is None:
+                    store_line = index
+            
+            is_address = False
+            if address_line is None or kind is None:
+                is_address = self.street_regex.search(line) is not None
+                if is_address and address_line is None:
+                    address_line = index
+            
+            if len(dates) < len(self.date_regexes) and ('/' in line or '-' in line):
+                for pattern_num, pattern in enumerate(self.date_regexes):
+                    if pattern_num not in dates:
+                        match = pattern.search(line)
+                        if match:
+                            dates[pattern_num] = match.group(0)
+            
+            if kind is None:
+                if is_store:
+                    kind = 'header'
+                elif is_address or self.city_regex.search(stripped):
+                    kind = 'address'
+                elif self.total_regex.search(stripped):
+                    kind = 'total'
+                elif ('/' in line or '-' in line) and self.any_date_regex.search(line):
+                    kind = 'date'
+                else:
+                    kind = 'other'
+            kinds.append(kind)
+        
+        return {
+            'lines': lines,
+            'kinds': kinds,
+            'store_line': store_line,
+            'address_line': address_line,
+            'dates': dates,
+            'raw_items': raw_items
+        }
+    
+    def is_store_line(self, index, line):
+        """Does the store-number pattern ("HAYWARD #1061") end on this line?"""
+        if self.store_anchor_regex.search(line):
+            return True
+        # A "#123" at the start of a line follows the previous line's newline
+        return index > 0 and self.line_start_store_regex.match(line) is not None
+    
+    def match_item_line(self, line):
+        """Match one stripped line against the item patterns, in priority order"""
+        # Every item pattern starts with a 6-8 digit item number
+        if not self.item_prefilter.search(line):
+            return None
+        
+        for pattern_num, pattern in enumerate(self.item_regexes):
+            for match in pattern.finditer(line):
+                item_number_candidate = match.group(1)
+                description_candidate = match.group(2).strip()
+                price_str_candidate = match.group(3).strip() # P0 captures "12.34" or "12.34-", P3 captures "12.34", P4/P5 capture "12.34-"
+                
+                # --- Start Refined Description Filter ---
+                if pattern_num == 5: # P5: Costco specific discount r'(\d{6,8})\s+(\d{6,8})\s+(\d+\.\d{2}-)...'
+                    # For P5, description_candidate *must* be a 6-8 digit item code
+                    if not (description_candidate.isdigit() and 6 <= len(description_candidate) <= 8):
+                        continue
+                else: # For other patterns (P0-P4)
+                    # Reject if too short, or if all digits (usually not a valid description)
+                    if len(description_candidate) < 3 or description_candidate.isdigit():
+                        continue
+                # --- End Refined Description Filter ---
+                
+                # --- Start Refined Price Parsing ---
+                price_numeric_part = price_str_candidate
+                is_negative = False
+                
+                if price_str_candidate.endswith('-'): # Handles P0 (if "12.34-"), P4, P5
+                    price_numeric_part = price_str_candidate[:-1]
+                    is_negative = True
+                
+                # For P3 (r'... \-(\d+\.\d{2})'), price_str_candidate is "3.00", but pattern implies negative.
+                if pattern_num == 3:
+                    is_negative = True
+                
+                # Validate numeric part before float conversion
+                if not self.price_regex.match(price_numeric_part):
+                    continue
+                
+                try:
+                    price_abs = float(price_numeric_part)
+                except ValueError:
+                    continue
+                price = -price_abs if is_negative else price_abs
+                # --- End Refined Price Parsing ---
+                
+                kind, referenced_item = self.classify_item(item_number_candidate, description_candidate, price)
+                return {
+                    'item_number': item_number_candidate,
+                    'description': description_candidate,
+                    'price': price,
+                    'original_line': line,
+                    'pattern_num': pattern_num,
+                    'kind': kind,
+                    'referenced_item': referenced_item
+                }
+        
+        return None
+    
+    def classify_item(self, item_number, description, price):
+        """Tell regular items from discount lines; returns (kind, referenced item number)"""
+        if description.startswith('/'): # Standard discount: /<item_num>
+            match = self.discount_reference_regex.search(description)
+            if match:
+                return 'discount', match.group(1)
+            return 'item', None
+        
+        if price < 0: # Price itself is negative
+            # Try to find referenced item in description if it's a digit string (item code)
+            if description.isdigit() and 6 <= len(description) <= 8:
+                return 'discount', description
+            if item_number.isdigit() and 6 <= len(item_number) <= 8:
+                return 'discount', item_number
+            return 'discount', None
+        
+        return 'item', None
+    
+    def extract_store_info(self, text, classified=None):
         """Extract store number and address"""
+        if classified is None:
+            classified = self.classify_lines(text)
+        lines = classified['lines']
         store_info = {'store_number': '', 'address': ''}
         
-        # Look for store number pattern (e.g., "HAYWARD #1061")
-        store_match = re.search(r'([A-Z\s]+)#(\d+)', text)
-        if store_match:
-            store_info['store_number'] = f"{store_match.group(1).strip()} #{store_match.group(2)}"
+        # Look for store number pattern (e.g., "HAYWARD #1061"). The capitals before
+        # the "#" may run back over earlier all-caps lines, so search from the first
+        # line that stops that run.
+        store_index = classified['store_line']
+        if store_index is not None:
+            start = store_index
+            while start > 0 and self.caps_line_regex.fullmatch(lines[start - 1]):
+                start -= 1
+            if start > 0:
+                start -= 1
+            store_match = self.store_number_regex.search('\n'.join(lines[start:store_index + 1]))
+            if store_match:
+                store_info['store_number'] = f"{store_match.group(1).strip()} #{store_match.group(2)}"
         
         # Look for address pattern
-        address_lines = []
-        lines = text.split('\n')
-        for i, line in enumerate(lines):
-            # Look for street address pattern
-            if re.search(r'\d+\s+[A-Z\s]+(BLVD|AVE|ST|RD|DR|LN|CT|WAY)', line):
-                address_lines.append(line.strip())
-                # Check next line for city, state, zip
-                if i + 1 < len(lines):
-                    next_line = lines[i + 1].strip()
-                    if re.search(r'[A-Z\s]+,\s*[A-Z]{2}\s*\d{5}', next_line):
-                        address_lines.append(next_line)
-                break
-        
-        if address_lines:
+        address_index = classified['address_line']
+        if address_index is not None:
+            address_lines = [lines[address_index].strip()]
+            # Check next line for city, state, zip
+            if address_index + 1 < len(lines):
+                next_line = lines[address_index + 1].strip()
+                if self.city_regex.search(next_line):
+                    address_lines.append(next_line)
             store_info['address'] = ' '.join(address_lines)
         
         return store_info
     
-    def extract_items(self, text):
-        """Extract item numbers, descriptions, and prices with multiple patterns"""
+    def extract_items(self, text, classified=None, timed=True):
+        """Extract item numbers, descriptions, and prices with multiple patterns.
+        
+        timed=False leaves the discount_match stage metric alone, for the
+        extra extractions that score OCR passes rather than parse a receipt.
+        """
+        if classified is None:
+            classified = self.classify_lines(text)
         items = []
-        lines = text.split('\n')
+        raw_items = classified['raw_items']
+        debug = logger.isEnabledFor(logging.DEBUG)
         
-        print(f"Processing {len(lines)} lines for items...")
-        
-        raw_items = {} 
-        for line_num, line in enumerate(lines):
-            line = line.strip()
-            if len(line) < 10:
-                continue
-            if line in raw_items:
-                continue
-                
-            item_found_this_line = False
-            for pattern_num, pattern in enumerate(self.item_patterns):
-                if item_found_this_line:
-                    break
-                    
-                matches = re.findall(pattern, line, re.IGNORECASE)
-                for match_parts in matches:
-                    # Ensure match_parts is a tuple (it will be if groups are defined)
-                    current_match_tuple = match_parts if isinstance(match_parts, tuple) else (match_parts,)
-
-                    if len(current_match_tuple) < 3: # Need at least item, desc, price
-                        continue
-
-                    item_number_candidate = current_match_tuple[0]
-                    description_candidate = current_match_tuple[1].strip()
-                    price_str_candidate = current_match_tuple[2].strip() # P0 captures "12.34" or "12.34-", P3 captures "12.34", P4/P5 capture "12.34-"
-
-                    # --- Start Refined Description Filter ---
-                    passes_description_filter = True # Assume valid by default
-                    if pattern_num == 5: # P5: Costco specific discount r'(\d{6,8})\s+(\d{6,8})\s+(\d+\.\d{2}-)...'
-                        # For P5, description_candidate *must* be a 6-8 digit item code
-                        if not (description_candidate.isdigit() and 6 <= len(description_candidate) <= 8):
-                            passes_description_filter = False 
-                    else: # For other patterns (P0-P4)
-                        # Reject if too short, or if all digits (usually not a valid description)
-                        if len(description_candidate) < 3 or description_candidate.isdigit():
-                            passes_description_filter = False
-                    
-                    if not passes_description_filter:
-                        # print(f"DEBUG: Line skipped by description filter. Pattern {pattern_num}, Desc: '{description_candidate}', Line: '{line}'")
-                        continue
-                    # --- End Refined Description Filter ---
-
-                    # --- Start Refined Price Parsing ---
-                    price = 0.0
-                    try:
-                        price_numeric_part = price_str_candidate
-                        is_negative = False
-
-                        if price_str_candidate.endswith('-'): # Handles P0 (if "12.34-"), P4, P5
-                            price_numeric_part = price_str_candidate[:-1]
-                            is_negative = True
-                        
-                        # For P3 (r'... \-(\d+\.\d{2})'), price_str_candidate is "3.00", but pattern implies negative.
-                        if pattern_num == 3: 
-                            is_negative = True
-                        
-                        # Validate numeric part before float conversion
-                        if not re.match(r'^\d+\.\d{2}$', price_numeric_part):
-                            # print(f"DEBUG: Invalid numeric price part: '{price_numeric_part}' from '{price_str_candidate}' (Pattern {pattern_num}) line: '{line}'. Skipping.")
-                            continue
-
-                        price_abs = float(price_numeric_part)
-                        price = -price_abs if is_negative else price_abs
-                    except ValueError:
-                        # print(f"DEBUG: ValueError converting price: '{price_str_candidate}' (numeric part: '{price_numeric_part}') (Pattern {pattern_num}) line: '{line}'. Skipping.")
-                        continue
-                    # --- End Refined Price Parsing ---
-                    
-                    raw_items[line] = {
-                        'item_number': item_number_candidate,
-                        'description': description_candidate,
-                        'price': price,
-                        'original_line': line
-                    }
-                    print(f"Raw item found (Pattern {pattern_num}): {item_number_candidate} - {description_candidate} - ${price:.2f}")
-                    item_found_this_line = True
-                    break # Found a match with this pattern, move to next line
+        logger.debug("Processing %d lines for items...", len(classified['lines']))
+        if debug:
+            for item_data in raw_items.values():
+                logger.debug("Raw item found (Pattern %d): %s - %s - $%.2f", item_data['pattern_num'],
+                             item_data['item_number'], item_data['description'], item_data['price'])
         
         # Second pass: separate regular items from discount items
         regular_items = {}
         discount_items_raw = []
         
-        print(f"=== SECOND PASS: Processing {len(raw_items)} raw items ===")
+        logger.debug("=== SECOND PASS: Processing %d raw items ===", len(raw_items))
         
         for line, item_data in raw_items.items():
             item_price = item_data['price']
             item_description = item_data['description']
             item_number = item_data['item_number'] # This is the first field from regex
-
-            print(f"Processing: {item_number} - '{item_description}' - ${item_price:.2f}")
-
-            # Check if this is a discount line based on description or price
-            is_discount_line = False
-            referenced_item_for_discount = None
-            discount_value = 0
-
-            if item_description.startswith('/'): # Standard discount: /<item_num>
-                match = re.search(r'/(\d{6,8})', item_description)
-                if match:
-                    referenced_item_for_discount = match.group(1)
-                    discount_value = abs(item_price)
-                    is_discount_line = True
-                    print(f"  → Discount found (slash type): ${discount_value:.2f} for item {referenced_item_for_discount}")
             
-            elif item_price < 0: # Price itself is negative
+            logger.debug("Processing: %s - '%s' - $%.2f", item_number, item_description, item_price)
+            
+            if item_data['kind'] == 'discount':
                 discount_value = abs(item_price)
-                is_discount_line = True
-                # Try to find referenced item in description if it's a digit string (item code)
-                if item_description.isdigit() and 6 <= len(item_description) <= 8:
-                    referenced_item_for_discount = item_description
-                    print(f"  → Discount found (negative price, desc is item code): ${discount_value:.2f} for item {referenced_item_for_discount}")
-                else:
-                    print(f"  → Discount found (negative price, general): ${discount_value:.2f}. Trying to use item_number as reference.")
-                    if item_number.isdigit() and 6 <= len(item_number) <= 8:
-                        referenced_item_for_discount = item_number
-                        print(f"  → Using item_number {item_number} as reference")
-
-            if is_discount_line and referenced_item_for_discount:
-                discount_items_raw.append({
-                    'referenced_item': referenced_item_for_discount,
-                    'discount': discount_value
-                })
-                print(f"  → Added to discount list: ${discount_value:.2f} for item {referenced_item_for_discount}")
-            elif is_discount_line and not referenced_item_for_discount:
-                # This is a discount line but we couldn't directly extract a referenced item number
-                if item_number.isdigit() and 6 <= len(item_number) <= 8:
-                     discount_items_raw.append({
+                referenced_item_for_discount = item_data['referenced_item']
+                
+                if referenced_item_for_discount:
+                    discount_items_raw.append({
+                        'referenced_item': referenced_item_for_discount,
+                        'discount': discount_value
+                    })
+                    logger.debug("  → Added to discount list: $%.2f for item %s", discount_value, referenced_item_for_discount)
+                elif item_number.isdigit() and 6 <= len(item_number) <= 8:
+                    # This is a discount line but we couldn't directly extract a referenced item number
+                    discount_items_raw.append({
                         'referenced_item': item_number, # Use the discount's own code as a candidate for fuzzy matching
                         'discount': discount_value,
-                        'is_fuzzy_candidate': True 
+                        'is_fuzzy_candidate': True
                     })
-                     print(f"  → Added to discount list (fuzzy candidate): ${discount_value:.2f} using item_number {item_number}")
+                    logger.debug("  → Added to discount list (fuzzy candidate): $%.2f using item_number %s", discount_value, item_number)
             else: # Regular item (price is positive, or not identified as discount structure)
                 if item_number not in regular_items:
                     regular_items[item_number] = {
@@ -323,35 +1148,41 @@ class ReceiptProcessor:
                         'original_price': item_price, # This is the price from receipt
                         'discount': 0
                     }
-                    print(f"  → Added as regular item: {item_number} - {item_description} - ${item_price:.2f}")
+                    logger.debug("  → Added as regular item: %s - %s - $%.2f", item_number, item_description, item_price)
                 else:
-                    print(f"  → Duplicate regular item skipped: {item_number}")
-
-        print(f"=== SUMMARY: {len(regular_items)} regular items, {len(discount_items_raw)} discount items ===")
-        print("Regular items:", list(regular_items.keys()))
-        print("Discount items:", [f"{d['referenced_item']}(${d['discount']:.2f})" for d in discount_items_raw])
+                    logger.debug("  → Duplicate regular item skipped: %s", item_number)
+        
+        # Correct misread item numbers and descriptions against earlier receipts
+        if self.item_catalog is not None and len(self.item_catalog):
+            regular_items = self.correct_with_catalog(regular_items)
+        
+        if debug:
+            logger.debug("=== SUMMARY: %d regular items, %d discount items ===", len(regular_items), len(discount_items_raw))
+            logger.debug("Regular items: %s", list(regular_items.keys()))
+            logger.debug("Discount items: %s", [f"{d['referenced_item']}(${d['discount']:.2f})" for d in discount_items_raw])
         
         # Third pass: apply discounts to regular items with fuzzy matching for OCR errors
+        discount_match_start = time.perf_counter()
         discount_totals = {}
         
-        print(f"=== THIRD PASS: Applying {len(discount_items_raw)} discounts to {len(regular_items)} regular items ===")
+        logger.debug("=== THIRD PASS: Applying %d discounts to %d regular items ===", len(discount_items_raw), len(regular_items))
         
         for discount_item in discount_items_raw:
             referenced_item_number = discount_item['referenced_item']
             discount_amount = discount_item['discount']
             
-            print(f"Trying to apply ${discount_amount:.2f} discount for item {referenced_item_number}")
+            logger.debug("Trying to apply $%.2f discount for item %s", discount_amount, referenced_item_number)
             
             # First try exact match
             if referenced_item_number in regular_items:
                 if referenced_item_number not in discount_totals:
                     discount_totals[referenced_item_number] = 0
                 discount_totals[referenced_item_number] += discount_amount
-                print(f"  → Applied ${discount_amount:.2f} discount to item {referenced_item_number} (exact match)")
+                logger.debug("  → Applied $%.2f discount to item %s (exact match)", discount_amount, referenced_item_number)
                 continue
             
             # If no exact match, try fuzzy matching for OCR errors
-            print(f"  → No exact match found, trying fuzzy matching...")
+            logger.debug("  → No exact match found, trying fuzzy matching...")
             best_match = None
             min_diff = float('inf')
             
@@ -362,26 +1193,36 @@ class ReceiptProcessor:
                     if diff_count <= 2 and diff_count < min_diff:  # Allow 1-2 character differences
                         min_diff = diff_count
                         best_match = existing_item
-                        print(f"    → Potential match: {existing_item} (diff: {diff_count})")
+                        logger.debug("    → Potential match: %s (diff: %d)", existing_item, diff_count)
+            
+            if best_match is None and self.item_catalog is not None and len(self.item_catalog):
+                # A reference garbled beyond substitutions can still resolve, through the catalog, to an item on this receipt
+                catalog_match = self.item_catalog.correct_item_number(referenced_item_number)
+                if catalog_match in regular_items:
+                    best_match = catalog_match
+                    min_diff = edit_distance(catalog_match, referenced_item_number)
             
             if best_match:
                 if best_match not in discount_totals:
                     discount_totals[best_match] = 0
                 discount_totals[best_match] += discount_amount
-                print(f"  → Applied ${discount_amount:.2f} discount to item {best_match} (fuzzy matched from {referenced_item_number}, {min_diff} differences)")
+                logger.debug("  → Applied $%.2f discount to item %s (fuzzy matched from %s, %d differences)", discount_amount, best_match, referenced_item_number, min_diff)
             else:
-                print(f"  → Warning: Could not find item to apply discount of ${discount_amount:.2f} for reference {referenced_item_number}")
+                logger.debug("  → Warning: Could not find item to apply discount of $%.2f for reference %s", discount_amount, referenced_item_number)
         
-        print(f"=== DISCOUNT TOTALS: {discount_totals} ===")
+        logger.debug("=== DISCOUNT TOTALS: %s ===", discount_totals)
         
         # Apply discount totals to regular items
         for item_number, total_discount in discount_totals.items():
             if item_number in regular_items:
                 regular_items[item_number]['discount'] = total_discount
-                print(f"Applied total discount of ${total_discount:.2f} to item {item_number}")
+                logger.debug("Applied total discount of $%.2f to item %s", total_discount, item_number)
+        
+        if timed:
+            STAGE_SECONDS.observe(time.perf_counter() - discount_match_start, stage='discount_match')
         
         # Calculate final prices and create items list
-        print(f"=== FINAL ITEMS LIST ===")
+        logger.debug("=== FINAL ITEMS LIST ===")
         for item_number, item_data in regular_items.items():
             final_price = item_data['original_price'] - item_data['discount']
             
@@ -394,33 +1235,52 @@ class ReceiptProcessor:
             })
             
             if item_data['discount'] > 0:
-                print(f"Final item: {item_number} - {item_data['description']} - Original: ${item_data['original_price']:.2f}, Discount: ${item_data['discount']:.2f}, Final: ${final_price:.2f}")
+                logger.debug("Final item: %s - %s - Original: $%.2f, Discount: $%.2f, Final: $%.2f", item_number, item_data['description'],
+                             item_data['original_price'], item_data['discount'], final_price)
             else:
-                print(f"Final item: {item_number} - {item_data['description']} - ${final_price:.2f}")
+                logger.debug("Final item: %s - %s - $%.2f", item_number, item_data['description'], final_price)
         
         # If no items found with strict patterns, try a looser approach
         if not items:
-            print("No items found with standard patterns, trying looser matching...")
-            items = self.extract_items_loose(text)
+            logger.debug("No items found with standard patterns, trying looser matching...")
+            items = self.extract_items_loose(text, classified)
         
-        print(f"Total items found: {len(items)}")
+        logger.debug("Total items found: %d", len(items))
         return items
     
-    def extract_items_loose(self, text):
+    def correct_with_catalog(self, regular_items):
+        """Swap misread item numbers and garbled descriptions for the catalog's"""
+        corrected = {}
+        for item_number, item_data in regular_items.items():
+            catalog_number = self.item_catalog.correct_item_number(item_number, item_data['description']) or item_number
+            if catalog_number in corrected:
+                logger.debug("  → Catalog correction %s → %s duplicates an item, skipped", item_number, catalog_number)
+                continue
+            description = self.item_catalog.correct_description(catalog_number, item_data['description'])
+            if catalog_number != item_number or description != item_data['description']:
+                logger.debug("  → Catalog corrected %s '%s' to %s '%s'", item_number, item_data['description'],
+                             catalog_number, description)
+            item_data['item_number'] = catalog_number
+            item_data['description'] = description
+            corrected[catalog_number] = item_data
+        return corrected
+    
+    def extract_items_loose(self, text, classified=None):
         """Looser item extraction for difficult-to-parse receipts"""
+        if classified is None:
+            classified = self.classify_lines(text)
         items = []
-        lines = text.split('\n')
         
-        for line in lines:
+        for line in classified['lines']:
             line = line.strip()
             
             # Look for any line with a price pattern at the end
-            price_match = re.search(r'(\d+\.\d{2})[-]?\s*$', line)
+            price_match = self.loose_price_regex.search(line)
             if price_match:
                 price_str = price_match.group(1)
                 
                 # Look for item number at the beginning
-                item_match = re.match(r'^(\d{6,8})', line)
+                item_match = self.loose_item_number_regex.match(line)
                 if item_match:
                     item_number = item_match.group(1)
                     
@@ -428,7 +1288,7 @@ class ReceiptProcessor:
                     description_part = line[len(item_number):line.rfind(price_str)].strip()
                     
                     # Clean up description
-                    description = re.sub(r'[*\s]+', ' ', description_part).strip()
+                    description = self.loose_cleanup_regex.sub(' ', description_part).strip()
                     
                     if len(description) > 2:
                         try:
@@ -441,33 +1301,192 @@ class ReceiptProcessor:
                                 'description': description,
                                 'price': price
                             })
-                            print(f"Loose match found: {item_number} - {description} - ${price}")
+                            logger.debug("Loose match found: %s - %s - $%s", item_number, description, price)
                         except ValueError:
                             continue
         
         return items
     
-    def extract_receipt_date(self, text):
+    def extract_totals(self, text, classified=None):
+        """SUBTOTAL, TAX and TOTAL amounts printed on the receipt (None where not read)"""
+        if classified is None:
+            classified = self.classify_lines(text)
+        
+        totals = {'subtotal': None, 'tax': None, 'total': None}
+        for line, kind in zip(classified['lines'], classified['kinds']):
+            if kind != 'total':
+                continue
+            for match in self.total_amount_regex.finditer(line):
+                label = re.sub(r'\s+', '', match.group(1)).upper()
+                name = 'subtotal' if label == 'SUBTOTAL' else 'total' if label == 'TOTAL' else 'tax'
+                if totals[name] is None:
+                    totals[name] = float(match.group(2))
+        return totals
+    
+    def reconcile_totals(self, items, totals, classified=None):
+        """Compare the receipt's item and discount lines with its SUBTOTAL.
+        
+        extract_items merges repeated item numbers, so the sum runs over every
+        item line (less every discount line) that was recognised, which is what
+        the SUBTOTAL adds up; the final item prices are summed only when the
+        items came from the loose fallback. Without a SUBTOTAL, TOTAL minus TAX
+        stands in for it. Returns the totals with items_sum, difference and a
+        status of 'reconciled', 'mismatch' or 'missing'.
+        """
+        raw_items = classified['raw_items'] if classified is not None else {}
+        if raw_items:
+            items_sum = 0.0
+            for line, kind in zip(classified['lines'], classified['kinds']):
+                raw_item = raw_items.get(line.strip()) if kind in ('item', 'discount') else None
+                if raw_item is not None:
+                    items_sum += -abs(raw_item['price']) if kind == 'discount' else raw_item['price']
+        else:
+            items_sum = sum(item['price'] for item in items)
+        items_sum = round(items_sum, 2)
+        
+        expected = totals['subtotal']
+        if expected is None and totals['total'] is not None and totals['tax'] is not None:
+            expected = round(totals['total'] - totals['tax'], 2)
+        if expected is None:
+            return {**totals, 'items_sum': items_sum, 'difference': None, 'status': 'missing'}
+        
+        difference = round(expected - items_sum, 2)
+        status = 'reconciled' if abs(difference) < self.TOTALS_TOLERANCE and items else 'mismatch'
+        return {**totals, 'items_sum': items_sum, 'difference': difference, 'status': status}
+    
+    def extract_receipt_date(self, text, classified=None):
         """Try to extract receipt date from text"""
-        # Look for date patterns
-        date_patterns = [
-            r'\d{1,2}/\d{1,2}/\d{4}',
-            r'\d{4}-\d{2}-\d{2}',
-            r'\d{2}/\d{2}/\d{4}'
-        ]
+        if classified is None:
+            classified = self.classify_lines(text)
         
-        for pattern in date_patterns:
-            match = re.search(pattern, text)
-            if match:
+        # First match of each date pattern, in pattern order
+        for pattern_num in range(len(self.date_regexes)):
+            date_str = classified['dates'].get(pattern_num)
+            if date_str:
                 try:
-                    return parser.parse(match.group(0))
+                    from dateutil import parser
+                    return parser.parse(date_str)
                 except:
                     continue
         
         return None
 
-# Initialize the processor
-processor = ReceiptProcessor()
+# Initialize the processor. The backend gets one engine per OCR pool thread.
+def create_processor(parallel_ocr=None, ocr_pool_size=None):
+    """ReceiptProcessor configured from app.config; arguments override the config.
+    
+    The item catalog and the OCR config ranking start empty; refresh_item_catalog()
+    and refresh_ocr_ranking() load them on first use.
+    """
+    if parallel_ocr is None:
+        parallel_ocr = app.config['OCR_PARALLEL']
+    if ocr_pool_size is None:
+        ocr_pool_size = app.config['OCR_POOL_SIZE']
+    if parallel_ocr and min(ocr_pool_size, app.config['CPU_THREADS_PER_WORKER']) <= 1:
+        logger.warning("OCR_PARALLEL is on but each worker may only run one OCR pass at a time "
+                       "(CPU_THREADS_PER_WORKER=%d, OCR_POOL_SIZE=%d), so the sweep runs serially; "
+                       "run fewer workers than cores (WEB_CONCURRENCY) to give each worker more",
+                       app.config['CPU_THREADS_PER_WORKER'], ocr_pool_size)
+    from ocr_backends import create_ocr_backend
+    return ReceiptProcessor(parallel_ocr=parallel_ocr,
+                            ocr_pool_size=ocr_pool_size,
+                            min_item_lines=app.config['OCR_MIN_ITEM_LINES'],
+                            min_confidence=app.config['OCR_MIN_CONFIDENCE'],
+                            config_ranking=ConfigRanking() if app.config['OCR_ADAPTIVE_ORDER'] else None,
+                            escalate=app.config['OCR_ESCALATION'],
+                            quality_configs=app.config['OCR_QUALITY_CONFIGS'],
+                            ocr_backend=create_ocr_backend(app.config['OCR_BACKEND'], pool_size=ocr_pool_size),
+                            ocr_cache=OCRCache(app.config['OCR_CACHE_PATH'],
+                                               max_bytes=app.config['OCR_CACHE_MAX_BYTES'])
+                                      if app.config['OCR_CACHE_ENABLED'] else None,
+                            preprocess_profile=app.config['PREPROCESS_PROFILE'],
+                            target_dpi=app.config['PREPROCESS_TARGET_DPI'],
+                            segmentation=app.config['OCR_SEGMENTATION'],
+                            strip_lines=app.config['OCR_STRIP_LINES'],
+                            item_catalog=ItemCatalog() if app.config['ITEM_CATALOG_ENABLED'] else None,
+                            max_ocr_passes=app.config['CPU_THREADS_PER_WORKER'],
+                            ocr_limiter=OCRLimiter(app.config['OCR_MAX_CONCURRENT'], app.config['OCR_QUEUE_DEPTH'],
+                                                   timeout=app.config['OCR_QUEUE_TIMEOUT']))
+
+_processor = None
+_processor_lock = threading.Lock()
+
+def get_processor():
+    """The process's ReceiptProcessor, created on first use along with the OCR stack.
+    
+    Thread limits are applied first, so OpenCV's pool and tesserocr (which reads
+    OMP_THREAD_LIMIT once, when it loads) start within the CPU budget.
+    """
+    global _processor
+    if _processor is None:
+        with _processor_lock:
+            if _processor is None:
+                limit_native_threads(app.config['CPU_THREADS_PER_WORKER'])
+                _processor = create_processor()
+    return _processor
+
+_catalog_refresh_lock = threading.Lock()
+
+def refresh_item_catalog(catalog=None, max_age=None):
+    """Load receipt_item rows added since the catalog's last refresh, by any process.
+    
+    The first call loads the whole table; later ones only newer ids, and only
+    once the catalog is older than max_age (ITEM_CATALOG_REFRESH_SECONDS).
+    """
+    catalog = catalog if catalog is not None else get_processor().item_catalog
+    if catalog is None:
+        return 0
+    if max_age is None:
+        max_age = app.config['ITEM_CATALOG_REFRESH_SECONDS']
+    if catalog.refreshed_at and time.monotonic() - catalog.refreshed_at < max_age:
+        return 0
+    # Another thread is already refreshing; its result is good enough
+    if not _catalog_refresh_lock.acquire(blocking=False):
+        return 0
+    try:
+        rows = db.session.query(ReceiptItem.id, ReceiptItem.item_number, ReceiptItem.description) \
+            .filter(ReceiptItem.id > catalog.last_id) \
+            .order_by(ReceiptItem.id.asc()) \
+            .yield_per(5000)
+        added = catalog.load(rows)
+        if added:
+            logger.debug("Item catalog: loaded %d rows, %d items", added, len(catalog))
+        return added
+    finally:
+        _catalog_refresh_lock.release()
+
+def refresh_ocr_ranking(ranking=None, max_age=None):
+    """Load the OCR config counts saved by every process, once the loaded ones are older than max_age"""
+    ranking = ranking if ranking is not None else get_processor().config_ranking
+    if ranking is None:
+        return
+    if max_age is None:
+        max_age = app.config['OCR_RANKING_REFRESH_SECONDS']
+    if ranking.refreshed_at and time.monotonic() - ranking.refreshed_at < max_age:
+        return
+    ranking.load(db.session.query(OCRConfigStat.config, OCRConfigStat.attempts, OCRConfigStat.wins).all(),
+                 refreshed_at=time.monotonic())
+
+def record_ocr_ranking(deltas):
+    """Add {config: (attempts, wins)} from ConfigRanking.take_pending() to the saved counts.
+    
+    Runs in the caller's transaction; counts are added in SQL so other
+    processes' updates aren't overwritten.
+    """
+    if not deltas:
+        return
+    now = datetime.utcnow()
+    existing = {config for config, in db.session.query(OCRConfigStat.config)
+                .filter(OCRConfigStat.config.in_(list(deltas)))}
+    for config, (attempts, wins) in deltas.items():
+        if config in existing:
+            db.session.query(OCRConfigStat).filter_by(config=config).update({
+                OCRConfigStat.attempts: OCRConfigStat.attempts + attempts,
+                OCRConfigStat.wins: OCRConfigStat.wins + wins,
+                OCRConfigStat.updated_at: now
+            }, synchronize_session=False)
+        else:
+            db.session.add(OCRConfigStat(config=config, attempts=attempts, wins=wins, updated_at=now))
 
 def allowed_file(filename):
     """Check if uploaded file is allowed"""
@@ -479,6 +1498,493 @@ def index():
     """Home page"""
     return render_template('index.html')
 
+def archive_upload(image_bytes, filename):
+    """Keep a copy of the uploaded image when ARCHIVE_UPLOADS is on"""
+    if not app.config['ARCHIVE_UPLOADS']:
+        return None
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S_')
+    filepath = os.path.join(app.config['UPLOAD_FOLDER'], timestamp + filename)
+    with open(filepath, 'wb') as f:
+        f.write(image_bytes)
+    return filepath
+
+def price_window_start():
+    """Oldest purchase time that still counts towards the lowest-price comparison"""
+    return datetime.utcnow() - timedelta(days=PRICE_WINDOW_DAYS)
+
+def lowest_recent_prices(item_numbers, since, store_number=None):
+    """{item_number: (price, store_address, date_recorded)} of the cheapest purchase since the given time"""
+    item_numbers = sorted(set(item_numbers))
+    if not item_numbers:
+        return {}
+    
+    ranked = db.session.query(
+        ReceiptItem.item_number,
+        ReceiptItem.price,
+        Receipt.store_address,
+        ReceiptItem.date_recorded,
+        db.func.row_number().over(
+            partition_by=ReceiptItem.item_number,
+            order_by=(ReceiptItem.price.asc(), ReceiptItem.date_recorded.desc(), ReceiptItem.id.desc())
+        ).label('rank')
+    ).join(Receipt, Receipt.id == ReceiptItem.receipt_id).filter(
+        ReceiptItem.item_number.in_(item_numbers),
+        ReceiptItem.date_recorded >= since
+    )
+    if store_number is not None:
+        ranked = ranked.filter(Receipt.store_number == store_number)
+    ranked = ranked.subquery()
+    
+    rows = db.session.query(ranked.c.item_number, ranked.c.price, ranked.c.store_address, ranked.c.date_recorded) \
+        .filter(ranked.c.rank == 1).all()
+    return {row[0]: tuple(row[1:]) for row in rows}
+
+def load_price_summaries(item_numbers, store_number, since):
+    """{item_number: ItemPriceSummary} for one store ('' for all stores).
+    
+    A window minimum that has aged out is recomputed from receipt_item, in
+    one query for all such items; every other lookup is served by the summary.
+    """
+    summaries = {
+        summary.item_number: summary
+        for summary in ItemPriceSummary.query.filter(
+            ItemPriceSummary.item_number.in_(sorted(set(item_numbers))),
+            ItemPriceSummary.store_number == store_number
+        )
+    }
+    
+    expired = [item_number for item_number, summary in summaries.items()
+               if summary.min_seen is not None and summary.min_seen < since]
+    if expired:
+        lowest = lowest_recent_prices(expired, since, store_number or None)
+        for item_number in expired:
+            summary = summaries[item_number]
+            summary.min_price, summary.min_store_address, summary.min_seen = lowest.get(item_number, (None, None, None))
+    return summaries
+
+def record_price(summaries, item_number, store_number, price, store_address, seen_at):
+    """Fold one purchase into the summary for its item, creating it if needed"""
+    summary = summaries.get(item_number)
+    if summary is None:
+        summary = ItemPriceSummary(item_number=item_number, store_number=store_number, observation_count=0)
+        db.session.add(summary)
+        summaries[item_number] = summary
+    
+    summary.observation_count += 1
+    summary.updated_at = datetime.utcnow()
+    if summary.last_seen is None or seen_at >= summary.last_seen:
+        summary.last_price = price
+        summary.last_seen = seen_at
+        summary.last_store_address = store_address
+    # Ties move the minimum forward so it stays in the window longer
+    if summary.min_price is None or price <= summary.min_price:
+        summary.min_price = price
+        summary.min_seen = seen_at
+        summary.min_store_address = store_address
+    return summary
+
+def rebuild_price_summaries():
+    """Recompute every ItemPriceSummary row from receipt_item; returns the row count"""
+    since = price_window_start()
+    summaries = {}
+    rows = db.session.query(
+        ReceiptItem.item_number, ReceiptItem.price, ReceiptItem.date_recorded,
+        Receipt.store_number, Receipt.store_address
+    ).join(Receipt, Receipt.id == ReceiptItem.receipt_id) \
+        .order_by(ReceiptItem.date_recorded.asc(), ReceiptItem.id.asc()) \
+        .yield_per(5000)
+    
+    for item_number, price, seen_at, store_number, store_address in rows:
+        seen_at = seen_at or datetime.min
+        for key in ('', store_number):
+            summary = summaries.get((item_number, key))
+            if summary is None:
+                summary = summaries[(item_number, key)] = {
+                    'item_number': item_number, 'store_number': key, 'observation_count': 0,
+                    'min_price': None, 'min_seen': None, 'min_store_address': None
+                }
+            summary['observation_count'] += 1
+            summary['last_price'] = price
+            summary['last_seen'] = seen_at
+            summary['last_store_address'] = store_address
+            if seen_at >= since and (summary['min_price'] is None or price <= summary['min_price']):
+                summary['min_price'] = price
+                summary['min_seen'] = seen_at
+                summary['min_store_address'] = store_address
+    
+    updated_at = datetime.utcnow()
+    for summary in summaries.values():
+        summary['updated_at'] = updated_at
+    ItemPriceSummary.query.delete()
+    if summaries:
+        db.session.execute(db.insert(ItemPriceSummary), list(summaries.values()))
+    db.session.commit()
+    return len(summaries)
+
+def spending_deltas(store_number, store_address, month, items):
+    """{(dimension, key): totals} one receipt adds to the spending rollups.
+    
+    items are (item_number, description, price, discount) tuples.
+    """
+    deltas = {}
+    
+    def delta(dimension, key, label=None):
+        entry = deltas.get((dimension, key))
+        if entry is None:
+            entry = deltas[(dimension, key)] = {
+                'dimension': dimension, 'key': key, 'label': label, 'receipt_count': 1, 'item_count': 0,
+                'spend': 0.0, 'discount': 0.0, 'top_price': None, 'top_price_item': None,
+                'top_discount': None, 'top_discount_item': None
+            }
+        elif label:
+            entry['label'] = label
+        return entry
+    
+    receipt_totals = [delta('total', ''), delta('store', store_number, store_address), delta('month', month)]
+    for item_number, description, price, discount in items:
+        discount = discount or 0
+        for entry in receipt_totals + [delta('item', item_number, description)]:
+            entry['item_count'] += 1
+            entry['spend'] += price
+            entry['discount'] += discount
+            if entry['top_price'] is None or price > entry['top_price']:
+                entry['top_price'], entry['top_price_item'] = price, item_number
+            if discount > 0 and (entry['top_discount'] is None or discount > entry['top_discount']):
+                entry['top_discount'], entry['top_discount_item'] = discount, item_number
+    return deltas
+
+def merge_spending(totals, delta):
+    """Fold one spending_deltas() entry into a running totals dict"""
+    if totals['label'] is None or delta['label']:
+        totals['label'] = delta['label'] or totals['label']
+    for name in ('receipt_count', 'item_count', 'spend', 'discount'):
+        totals[name] += delta[name]
+    for value, item in (('top_price', 'top_price_item'), ('top_discount', 'top_discount_item')):
+        if delta[value] is not None and (totals[value] is None or delta[value] > totals[value]):
+            totals[value], totals[item] = delta[value], delta[item]
+
+def record_spending(deltas, updated_at):
+    """Add spending_deltas() to the rollup rows, creating missing ones.
+    
+    Existing rows are updated by one executemany UPDATE that does the
+    arithmetic in SQL, so receipts stored concurrently by different workers
+    never overwrite each other's totals.
+    """
+    keys_by_dimension = {}
+    for dimension, key in deltas:
+        keys_by_dimension.setdefault(dimension, []).append(key)
+    existing = {
+        tuple(row) for row in db.session.query(SpendingRollup.dimension, SpendingRollup.key).filter(db.or_(*[
+            db.and_(SpendingRollup.dimension == dimension, SpendingRollup.key.in_(keys))
+            for dimension, keys in keys_by_dimension.items()
+        ]))
+    }
+    
+    new_rows = [dict(delta, updated_at=updated_at) for key, delta in deltas.items() if key not in existing]
+    if new_rows:
+        db.session.execute(db.insert(SpendingRollup), new_rows)
+    updates = [{'b_' + name: value for name, value in delta.items()} for key, delta in deltas.items() if key in existing]
+    if updates:
+        db.session.execute(spending_update_statement(), [dict(update, b_updated_at=updated_at) for update in updates])
+
+@lru_cache(maxsize=None)
+def spending_update_statement():
+    """UPDATE adding one spending_deltas() entry (as b_* parameters) to its rollup row"""
+    table = SpendingRollup.__table__
+    
+    def higher(value):
+        new = db.bindparam('b_' + value, type_=db.Float)
+        return db.and_(new.isnot(None), db.or_(table.c[value].is_(None), new > table.c[value]))
+    
+    return table.update().where(
+        table.c.dimension == db.bindparam('b_dimension'),
+        table.c.key == db.bindparam('b_key')
+    ).values(
+        label=db.func.coalesce(db.bindparam('b_label'), table.c.label),
+        receipt_count=table.c.receipt_count + db.bindparam('b_receipt_count'),
+        item_count=table.c.item_count + db.bindparam('b_item_count'),
+        spend=table.c.spend + db.bindparam('b_spend'),
+        discount=table.c.discount + db.bindparam('b_discount'),
+        # Every SET sees the old values, so the item follows the price it was compared with
+        top_price=db.case((higher('top_price'), db.bindparam('b_top_price')), else_=table.c.top_price),
+        top_price_item=db.case((higher('top_price'), db.bindparam('b_top_price_item')), else_=table.c.top_price_item),
+        top_discount=db.case((higher('top_discount'), db.bindparam('b_top_discount')), else_=table.c.top_discount),
+        top_discount_item=db.case((higher('top_discount'), db.bindparam('b_top_discount_item')),
+                                  else_=table.c.top_discount_item),
+        updated_at=db.bindparam('b_updated_at')
+    )
+
+def rebuild_spending_rollups():
+    """Recompute every SpendingRollup row from the stored receipts; returns the row count"""
+    totals = {}
+    rows = db.session.query(
+        Receipt.id, Receipt.store_number, Receipt.store_address, Receipt.receipt_date, Receipt.upload_date,
+        ReceiptItem.item_number, ReceiptItem.description, ReceiptItem.price, ReceiptItem.discount
+    ).join(ReceiptItem, ReceiptItem.receipt_id == Receipt.id) \
+        .order_by(Receipt.id.asc(), ReceiptItem.id.asc()) \
+        .yield_per(5000)
+    
+    for _, receipt_rows in groupby(rows, key=lambda row: row[0]):
+        receipt_rows = list(receipt_rows)
+        _, store_number, store_address, receipt_date, upload_date = receipt_rows[0][:5]
+        month = (receipt_date or upload_date or datetime.min).strftime('%Y-%m')
+        deltas = spending_deltas(store_number, store_address, month, [row[5:] for row in receipt_rows])
+        for key, delta in deltas.items():
+            if key in totals:
+                merge_spending(totals[key], delta)
+            else:
+                totals[key] = delta
+    
+    updated_at = datetime.utcnow()
+    for row in totals.values():
+        row['updated_at'] = updated_at
+    SpendingRollup.query.delete()
+    if totals:
+        db.session.execute(db.insert(SpendingRollup), list(totals.values()))
+    db.session.commit()
+    return len(totals)
+
+def write_with_retry(write):
+    """Run write(), which must commit, again from scratch if SQLite reports the database locked"""
+    return retry_write(db.session, write, attempts=app.config['DB_WRITE_RETRIES'], on_retry=DB_WRITE_RETRIES.inc)
+
+def process_receipt(image_bytes, filename, wait_for_ocr=True):
+    """OCR, parse and store a receipt; returns the data results.html renders.
+    
+    With wait_for_ocr=False a full OCR queue raises OCRBusy instead of waiting.
+    """
+    logger.info("Processing receipt: %s (%d bytes)", filename, len(image_bytes))
+    processor = get_processor()
+    refresh_ocr_ranking(processor.config_ranking)
+    with STAGE_SECONDS.time(stage='ocr'):
+        text, ocr_config = processor.extract_text_with_config(image_bytes, wait=wait_for_ocr)
+    
+    if len(text.strip()) < 10:
+        RECEIPTS_TOTAL.inc(result='no_text')
+        raise ReceiptProcessingError('Unable to extract text from the image. Please ensure the image is clear and try again.')
+    
+    refresh_item_catalog()
+    receipt_data = processor.parse_receipt_text(text)
+    
+    # Check if we found any items
+    if not receipt_data['items']:
+        RECEIPTS_TOTAL.inc(result='no_items')
+        raise ReceiptProcessingError('No items found in the receipt. The image may be unclear or not a valid Costco receipt. Please try with a clearer image or different angle.')
+    
+    # Sweeps of earlier receipts that failed to parse are saved along with this one
+    ranking = processor.config_ranking
+    ranking_deltas = ranking.take_pending() if ranking is not None else {}
+    
+    def save():
+        saved = store_receipt(receipt_data, ocr_text=text, ocr_config=ocr_config)
+        record_ocr_ranking(ranking_deltas)
+        with STAGE_SECONDS.time(stage='db_commit'):
+            db.session.commit()
+        return saved
+    
+    try:
+        receipt, price_comparisons = write_with_retry(save)
+    except Exception:
+        if ranking is not None:
+            ranking.put_back(ranking_deltas)
+        raise
+    # The next receipt can already be corrected against this one
+    refresh_item_catalog(max_age=0)
+    RECEIPTS_TOTAL.inc(result='success')
+    ITEMS_TOTAL.inc(len(receipt_data['items']))
+    TOTALS_TOTAL.inc(status=receipt_data['totals']['status'])
+    
+    return {
+        'receipt_id': receipt.id,
+        'comparisons': price_comparisons,
+        'store_info': receipt_data['store_info'],
+        'ocr_config': ocr_config,
+        'totals': receipt_data['totals']
+    }
+
+def receipt_totals_fields(receipt_data):
+    """Receipt column values for a parse's totals reconciliation"""
+    totals = receipt_data.get('totals') or {}
+    return {
+        'subtotal': totals.get('subtotal'),
+        'tax': totals.get('tax'),
+        'total': totals.get('total'),
+        'totals_status': totals.get('status'),
+        'totals_difference': totals.get('difference')
+    }
+
+def store_receipt(receipt_data, ocr_text=None, ocr_config=None):
+    """Add a parsed receipt, its items and the price summary updates to the session.
+    
+    The OCR text is kept (compressed) so the receipt can be re-parsed later.
+    Returns (receipt, price comparisons); committing is left to the caller.
+    """
+    receipt = Receipt(
+        store_address=receipt_data['store_info']['address'] or 'Unknown Store',
+        store_number=receipt_data['store_info']['store_number'] or 'Unknown',
+        receipt_date=receipt_data['receipt_date'],
+        ocr_text=ocr_text if app.config['KEEP_OCR_TEXT'] else None,
+        ocr_config=ocr_config,
+        **receipt_totals_fields(receipt_data)
+    )
+    db.session.add(receipt)
+    db.session.flush()  # Get the receipt ID
+    
+    # Lowest recent prices come from the running summaries, not receipt_item
+    seen_at = datetime.utcnow()
+    since = price_window_start()
+    item_numbers = [item['item_number'] for item in receipt_data['items']]
+    summaries = load_price_summaries(item_numbers, '', since)
+    store_summaries = load_price_summaries(item_numbers, receipt.store_number, since)
+    
+    # Process each item
+    price_comparisons = []
+    for item_data in receipt_data['items']:
+        comparison = {
+            'item_number': item_data['item_number'],
+            'description': item_data['description'],
+            'current_price': item_data['price'],
+            'original_price': item_data.get('original_price', item_data['price']),
+            'discount': item_data.get('discount', 0),
+            'is_lowest': True,
+            'existing_price': None,
+            'existing_store': None
+        }
+        
+        summary = summaries.get(item_data['item_number'])
+        if summary and summary.min_price is not None and summary.min_price < item_data['price']:
+            comparison['is_lowest'] = False
+            comparison['existing_price'] = summary.min_price
+            comparison['existing_store'] = summary.min_store_address
+        
+        # Later lines on the same receipt compare against this one too
+        record_price(summaries, item_data['item_number'], '', item_data['price'], receipt.store_address, seen_at)
+        record_price(store_summaries, item_data['item_number'], receipt.store_number, item_data['price'],
+                     receipt.store_address, seen_at)
+        
+        price_comparisons.append(comparison)
+        
+        # Add item to database
+        new_item = ReceiptItem(
+            receipt_id=receipt.id,
+            item_number=item_data['item_number'],
+            description=item_data['description'],
+            price=item_data['price'],
+            original_price=item_data.get('original_price', item_data['price']),
+            discount=item_data.get('discount', 0),
+            date_recorded=seen_at
+        )
+        db.session.add(new_item)
+    
+    # Dashboard totals; months follow the date printed on the receipt when there is one
+    month = (receipt.receipt_date or seen_at).strftime('%Y-%m')
+    record_spending(spending_deltas(receipt.store_number, receipt.store_address, month, [
+        (item['item_number'], item['description'], item['price'], item.get('discount', 0))
+        for item in receipt_data['items']
+    ]), seen_at)
+    
+    return receipt, price_comparisons
+
+def enqueue_receipt_job(image_bytes, filename):
+    """Persist an upload as a queued job and wake a worker"""
+    job = ProcessingJob(filename=filename, image_data=image_bytes)
+    db.session.add(job)
+    db.session.commit()
+    job_workers.notify()
+    return job
+
+def claim_next_job():
+    """Atomically move the oldest queued job to running, or return None"""
+    stale_before = datetime.utcnow() - timedelta(seconds=app.config['JOB_STALE_SECONDS'])
+    
+    def requeue_stale():
+        # Requeue jobs whose worker died mid-run
+        ProcessingJob.query.filter(
+            ProcessingJob.status == 'running',
+            ProcessingJob.started_at < stale_before
+        ).update({'status': 'queued', 'started_at': None}, synchronize_session=False)
+        db.session.commit()
+    
+    def claim(job_id):
+        # Conditional update so only one worker (in any process) wins the job
+        claimed = ProcessingJob.query.filter_by(id=job_id, status='queued') \
+            .update({'status': 'running', 'started_at': datetime.utcnow()}, synchronize_session=False)
+        db.session.commit()
+        return claimed
+    
+    write_with_retry(requeue_stale)
+    while True:
+        job_id = db.session.query(ProcessingJob.id).filter_by(status='queued') \
+            .order_by(ProcessingJob.created_at.asc()).limit(1).scalar()
+        if job_id is None:
+            return None
+        
+        if write_with_retry(lambda: claim(job_id)):
+            return db.session.get(ProcessingJob, job_id)
+
+def run_next_job():
+    """Process one queued job; returns False when the queue is empty"""
+    job = claim_next_job()
+    if job is None:
+        return False
+    
+    job_id = job.id
+    outcome = {}
+    try:
+        result = process_receipt(job.image_data, job.filename)
+        outcome = {'status': 'done', 'result': json.dumps(result), 'receipt_id': result['receipt_id']}
+    except Exception as e:
+        db.session.rollback()
+        logger.error("Error processing job %s: %s", job_id, e)
+        if not isinstance(e, ReceiptProcessingError):
+            RECEIPTS_TOTAL.inc(result='error')
+        if isinstance(e, ReceiptProcessingError):
+            error = str(e)
+        else:
+            error = f'Error processing receipt. Please try with a clearer image. Technical details: {str(e)}'
+        outcome = {'status': 'failed', 'error': error}
+    
+    def finish():
+        job = db.session.get(ProcessingJob, job_id)
+        for name, value in outcome.items():
+            setattr(job, name, value)
+        job.image_data = None
+        job.finished_at = datetime.utcnow()
+        db.session.commit()
+    
+    write_with_retry(finish)
+    return True
+
+job_workers = JobWorkerPool(app, run_next_job,
+                            num_workers=app.config['JOB_WORKERS'],
+                            poll_interval=app.config['JOB_POLL_INTERVAL'])
+
+def resume_jobs():
+    """Start the job threads at worker boot if uploads are queued by default or jobs are already waiting"""
+    with app.app_context():
+        waiting = db.session.query(ProcessingJob.id).filter_by(status='queued').first() is not None
+    if app.config['ASYNC_PROCESSING'] or waiting:
+        job_workers.start()
+
+def wants_json():
+    """True when the client asked for a JSON response"""
+    if request.args.get('format') == 'json':
+        return True
+    best = request.accept_mimetypes.best_match(['application/json', 'text/html'])
+    return best == 'application/json' and request.accept_mimetypes[best] > request.accept_mimetypes['text/html']
+
+def ocr_busy_response(error):
+    """503 with Retry-After for an upload turned away by the OCR limiter"""
+    message = 'The server is busy reading other receipts. Please try again in a moment, or upload with async=true to queue it.'
+    if wants_json():
+        response = jsonify({'error': message, 'retry_after': error.retry_after})
+    else:
+        flash(message)
+        response = app.make_response(render_template('upload.html'))
+    response.status_code = 503
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response
+
 @app.route('/upload', methods=['GET', 'POST'])
 def upload_receipt():
     """Handle receipt upload and processing"""
@@ -494,92 +2000,44 @@ def upload_receipt():
         
         if file and allowed_file(file.filename):
             filename = secure_filename(file.filename)
-            timestamp = datetime.now().strftime('%Y%m%d_%H%M%S_')
-            filename = timestamp + filename
-            filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            file.save(filepath)
+            image_bytes = file.read()
+            archive_upload(image_bytes, filename)
+            
+            # Queue the work and return right away
+            run_async = request.values.get('async', str(app.config['ASYNC_PROCESSING'])).lower() in ('1', 'true', 'yes')
+            if run_async:
+                job = enqueue_receipt_job(image_bytes, filename)
+                if wants_json():
+                    return jsonify({
+                        'job_id': job.id,
+                        'status': job.status,
+                        'status_url': url_for('job_status', job_id=job.id)
+                    }), 202
+                return redirect(url_for('job_status', job_id=job.id))
             
             try:
-                # Process the receipt
-                print(f"Processing receipt: {filepath}")
-                text = processor.extract_text_from_image(filepath)
-                
-                if len(text.strip()) < 10:
-                    flash('Unable to extract text from the image. Please ensure the image is clear and try again.')
-                    os.remove(filepath)
-                    return redirect(request.url)
+                # Process the receipt; turn it away rather than queue behind a full OCR queue
+                result = process_receipt(image_bytes, filename, wait_for_ocr=False)
                 
-                receipt_data = processor.parse_receipt_text(text)
-                
-                # Check if we found any items
-                if not receipt_data['items']:
-                    flash('No items found in the receipt. The image may be unclear or not a valid Costco receipt. Please try with a clearer image or different angle.')
-                    os.remove(filepath)
-                    return redirect(request.url)
-                
-                # Save to database
-                receipt = Receipt(
-                    store_address=receipt_data['store_info']['address'] or 'Unknown Store',
-                    store_number=receipt_data['store_info']['store_number'] or 'Unknown',
-                    receipt_date=receipt_data['receipt_date']
-                )
-                db.session.add(receipt)
-                db.session.flush()  # Get the receipt ID
-                
-                # Process each item
-                price_comparisons = []
-                for item_data in receipt_data['items']:
-                    # Check for existing lower prices within 30 days
-                    thirty_days_ago = datetime.now() - timedelta(days=30)
-                    existing_item = ReceiptItem.query.filter(
-                        ReceiptItem.item_number == item_data['item_number'],
-                        ReceiptItem.date_recorded >= thirty_days_ago
-                    ).order_by(ReceiptItem.price.asc()).first()
-                    
-                    comparison = {
-                        'item_number': item_data['item_number'],
-                        'description': item_data['description'],
-                        'current_price': item_data['price'],
-                        'original_price': item_data.get('original_price', item_data['price']),
-                        'discount': item_data.get('discount', 0),
-                        'is_lowest': True,
-                        'existing_price': None,
-                        'existing_store': None
-                    }
-                    
-                    if existing_item and existing_item.price < item_data['price']:
-                        comparison['is_lowest'] = False
-                        comparison['existing_price'] = existing_item.price
-                        comparison['existing_store'] = existing_item.receipt.store_address
-                    
-                    price_comparisons.append(comparison)
-                    
-                    # Add item to database
-                    new_item = ReceiptItem(
-                        receipt_id=receipt.id,
-                        item_number=item_data['item_number'],
-                        description=item_data['description'],
-                        price=item_data['price'],
-                        original_price=item_data.get('original_price', item_data['price']),
-                        discount=item_data.get('discount', 0)
-                    )
-                    db.session.add(new_item)
-                
-                db.session.commit()
-                
-                # Clean up uploaded file
-                os.remove(filepath)
-                
-                flash(f'Successfully processed receipt with {len(receipt_data["items"])} items!', 'success')
+                flash(f'Successfully processed receipt with {len(result["comparisons"])} items!', 'success')
                 return render_template('results.html', 
-                                     comparisons=price_comparisons,
-                                     store_info=receipt_data['store_info'])
+                                     comparisons=result['comparisons'],
+                                     store_info=result['store_info'],
+                                     ocr_config=result['ocr_config'],
+                                     totals=result['totals'])
                 
+            except OCRBusy as e:
+                db.session.rollback()
+                RECEIPTS_TOTAL.inc(result='busy')
+                return ocr_busy_response(e)
+            except ReceiptProcessingError as e:
+                db.session.rollback()
+                flash(str(e))
+                return redirect(request.url)
             except Exception as e:
                 db.session.rollback()
-                if os.path.exists(filepath):
-                    os.remove(filepath)
-                print(f"Error processing receipt: {str(e)}")
+                logger.error("Error processing receipt: %s", e)
+                RECEIPTS_TOTAL.inc(result='error')
                 flash(f'Error processing receipt. Please try with a clearer image. Technical details: {str(e)}')
                 return redirect(url_for('upload_receipt'))
         
@@ -589,6 +2047,40 @@ def upload_receipt():
     
     return render_template('upload.html')
 
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    """Poll an asynchronous receipt job; renders the results once it is done"""
+    job = db.session.get(ProcessingJob, job_id)
+    if job is None:
+        if wants_json():
+            return jsonify({'error': 'Job not found'}), 404
+        flash('Receipt job not found.')
+        return redirect(url_for('upload_receipt'))
+    
+    if job.status == 'queued':
+        job_workers.start()  # Pick up jobs left over from a restart
+    
+    result = json.loads(job.result) if job.result else None
+    
+    if wants_json():
+        return jsonify({
+            'job_id': job.id,
+            'status': job.status,
+            'error': job.error,
+            'created_at': job.created_at.isoformat() if job.created_at else None,
+            'finished_at': job.finished_at.isoformat() if job.finished_at else None,
+            'result': result
+        })
+    
+    if job.status == 'done':
+        return render_template('results.html',
+                             comparisons=result['comparisons'],
+                             store_info=result['store_info'],
+                             ocr_config=result['ocr_config'],
+                             totals=result.get('totals'))
+    
+    return render_template('job_status.html', job=job)
+
 @app.route('/debug/ocr', methods=['POST'])
 def debug_ocr():
     """Debug endpoint to test OCR extraction"""
@@ -598,63 +2090,499 @@ def debug_ocr():
     file = request.files['file']
     if file and allowed_file(file.filename):
         filename = secure_filename(file.filename)
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S_')
-        filename = timestamp + filename
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(filepath)
+        image_bytes = file.read()
+        archive_upload(image_bytes, filename)
+        
+        # Lets a deployment compare profiles on the same image
+        processor = get_processor()
+        profile = request.form.get('profile') or processor.preprocess_profile
+        if profile not in processor.PREPROCESS_PROFILES:
+            return jsonify({'error': f'Unknown preprocessing profile: {profile}'}), 400
         
         try:
             # Extract text
-            text = processor.extract_text_from_image(filepath)
+            text, ocr_config = processor.extract_text_with_config(image_bytes, profile, wait=False)
             receipt_data = processor.parse_receipt_text(text)
             
-            # Clean up
-            os.remove(filepath)
-            
             return jsonify({
                 'extracted_text': text[:1000],  # First 1000 characters
                 'text_length': len(text),
+                'ocr_config': ocr_config,
+                'preprocess_profile': profile,
                 'items_found': len(receipt_data['items']),
                 'items': receipt_data['items'][:5],  # First 5 items
-                'store_info': receipt_data['store_info']
+                'store_info': receipt_data['store_info'],
+                'totals': receipt_data['totals']
             })
             
+        except OCRBusy as e:
+            return jsonify({'error': str(e), 'retry_after': e.retry_after}), 503, {'Retry-After': str(e.retry_after)}
         except Exception as e:
-            if os.path.exists(filepath):
-                os.remove(filepath)
             return jsonify({'error': str(e)}), 500
     
     return jsonify({'error': 'Invalid file type'}), 400
 
+@app.route('/debug/ocr/cache')
+def debug_ocr_cache():
+    """Debug endpoint reporting OCR cache hit/miss counters"""
+    processor = get_processor()
+    if processor.ocr_cache is None:
+        return jsonify({'enabled': False})
+    return jsonify({'enabled': True, **processor.ocr_cache.stats()})
+
+@app.route('/debug/ocr/configs')
+def debug_ocr_configs():
+    """Debug endpoint with the OCR configs in the order a sweep tries them and their win counts"""
+    processor = get_processor()
+    if processor.config_ranking is None:
+        return jsonify({'adaptive': False, 'configs': processor.ranked_configs()})
+    refresh_ocr_ranking(processor.config_ranking, max_age=0)
+    return jsonify({'adaptive': True, 'configs': processor.config_ranking.stats(processor.ocr_configs)})
+
+@app.route('/debug/preprocess/timings')
+def debug_preprocess_timings():
+    """Debug endpoint with average stage timings for each preprocessing profile"""
+    processor = get_processor()
+    return jsonify({
+        'active_profile': processor.preprocess_profile,
+        'profiles': processor.timing_stats()
+    })
+
+@app.route('/metrics')
+def metrics():
+    """Prometheus metrics for this worker process"""
+    return metrics_registry.render(), 200, {'Content-Type': METRICS_CONTENT_TYPE}
+
+def encode_history_cursor(receipt):
+    """Opaque /history position of a receipt: its upload date and id"""
+    return f"{receipt.upload_date.isoformat()}_{receipt.id}"
+
+def decode_history_cursor(cursor):
+    """(upload_date, id) from encode_history_cursor, or None if malformed"""
+    try:
+        upload_date, receipt_id = cursor.rsplit('_', 1)
+        return datetime.fromisoformat(upload_date), int(receipt_id)
+    except (AttributeError, ValueError):
+        return None
+
+def history_summary():
+    """Totals shown under the history table, computed in the database"""
+    receipts, items, stores = db.session.query(
+        db.select(db.func.count(Receipt.id)).scalar_subquery(),
+        db.select(db.func.count(ReceiptItem.id)).scalar_subquery(),
+        db.select(db.func.count(db.distinct(Receipt.store_number))).scalar_subquery()
+    ).one()
+    return {'receipts': receipts, 'item_count': items, 'stores': stores}
+
 @app.route('/history')
 def history():
-    """View receipt history"""
-    receipts = Receipt.query.order_by(Receipt.upload_date.desc()).all()
-    return render_template('history.html', receipts=receipts)
+    """View receipt history, newest first, one page at a time"""
+    per_page = min(max(request.args.get('per_page', app.config['HISTORY_PAGE_SIZE'], type=int), 1), 100)
+    before = decode_history_cursor(request.args.get('before'))
+    after = decode_history_cursor(request.args.get('after'))
+    
+    query = Receipt.query.options(selectinload(Receipt.items))
+    if after:
+        # Walking back towards newer receipts: read ascending, then flip
+        upload_date, receipt_id = after
+        query = query.filter(db.or_(
+            Receipt.upload_date > upload_date,
+            db.and_(Receipt.upload_date == upload_date, Receipt.id > receipt_id)
+        )).order_by(Receipt.upload_date.asc(), Receipt.id.asc())
+    else:
+        if before:
+            upload_date, receipt_id = before
+            query = query.filter(db.or_(
+                Receipt.upload_date < upload_date,
+                db.and_(Receipt.upload_date == upload_date, Receipt.id < receipt_id)
+            ))
+        query = query.order_by(Receipt.upload_date.desc(), Receipt.id.desc())
+    
+    # One extra row tells whether there is another page in that direction
+    receipts = query.limit(per_page + 1).all()
+    has_more = len(receipts) > per_page
+    receipts = receipts[:per_page]
+    if after:
+        if not receipts:
+            return redirect(url_for('history', per_page=per_page))
+        receipts.reverse()
+        has_newer, has_older = has_more, True
+    else:
+        has_newer, has_older = before is not None, has_more
+    
+    newer_url = older_url = None
+    if receipts and has_newer:
+        newer_url = url_for('history', after=encode_history_cursor(receipts[0]), per_page=per_page)
+    if receipts and has_older:
+        older_url = url_for('history', before=encode_history_cursor(receipts[-1]), per_page=per_page)
+    
+    return render_template('history.html', receipts=receipts, summary=history_summary(),
+                           newer_url=newer_url, older_url=older_url)
+
+def parse_history_window():
+    """(since, until, limit) from the query string; raises ValueError on bad input.
+    
+    The default window starts at midnight UTC PRICE_WINDOW_DAYS ago, so the
+    response (and its ETag) only changes when an item is bought or the day rolls over.
+    """
+    since = request.args.get('since')
+    until = request.args.get('until')
+    since = datetime.fromisoformat(since) if since else \
+        price_window_start().replace(hour=0, minute=0, second=0, microsecond=0)
+    until = datetime.fromisoformat(until) if until else None
+    if since.tzinfo or (until and until.tzinfo):
+        raise ValueError('since and until are UTC and must not carry a timezone')
+    
+    max_limit = app.config['ITEM_HISTORY_MAX_LIMIT']
+    limit = request.args.get('limit', max_limit, type=int)
+    if limit is None or limit < 1:
+        raise ValueError('limit must be a positive integer')
+    return since, until, min(limit, max_limit)
+
+def item_price_history(item_numbers, since, until=None, limit=None):
+    """{item_number: [purchase dicts, newest first]} in a single joined query"""
+    rank = db.func.row_number().over(
+        partition_by=ReceiptItem.item_number,
+        order_by=(ReceiptItem.date_recorded.desc(), ReceiptItem.id.desc())
+    ).label('rank')
+    query = db.session.query(
+        ReceiptItem.item_number, ReceiptItem.price, ReceiptItem.date_recorded,
+        Receipt.store_address, Receipt.store_number, rank
+    ).join(Receipt, Receipt.id == ReceiptItem.receipt_id).filter(
+        ReceiptItem.item_number.in_(item_numbers),
+        ReceiptItem.date_recorded >= since
+    )
+    if until is not None:
+        query = query.filter(ReceiptItem.date_recorded < until)
+    ranked = query.subquery()
+    
+    rows = db.session.query(ranked)
+    if limit is not None:
+        rows = rows.filter(ranked.c.rank <= limit)
+    rows = rows.order_by(ranked.c.item_number, ranked.c.rank)
+    
+    history = {item_number: [] for item_number in item_numbers}
+    for item_number, price, date_recorded, store_address, store_number, _ in rows:
+        history[item_number].append({
+            'price': price,
+            'date': date_recorded.isoformat(),
+            'store': store_address,
+            'store_number': store_number
+        })
+    return history
+
+def item_history_validators(item_numbers, since, until, limit):
+    """(ETag, Last-Modified) for an item history response, from the price summaries.
+    
+    A new purchase updates its item's summary, and re-parsing stored receipts
+    (which can rewrite prices while keeping dates and counts) rebuilds them
+    all; both set updated_at, so this never has to look at receipt_item.
+    """
+    updated_at, observations = db.session.query(
+        # Rows from before updated_at existed haven't been written since last_seen
+        db.func.max(db.func.coalesce(ItemPriceSummary.updated_at, ItemPriceSummary.last_seen)),
+        db.func.coalesce(db.func.sum(ItemPriceSummary.observation_count), 0)
+    ).filter(
+        ItemPriceSummary.item_number.in_(item_numbers),
+        ItemPriceSummary.store_number == ''
+    ).one()
+    
+    key = '|'.join([','.join(item_numbers), since.isoformat(), until.isoformat() if until else '',
+                    str(limit), updated_at.isoformat() if updated_at else '', str(observations)])
+    etag = hashlib.sha1(key.encode('utf-8')).hexdigest()
+    return etag, updated_at.replace(microsecond=0) if updated_at else None
+
+def item_history_response(item_numbers, render):
+    """Answer with 304 when the client's copy is current, else render() as JSON with validators"""
+    try:
+        since, until, limit = parse_history_window()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    etag, last_modified = item_history_validators(item_numbers, since, until, limit)
+    if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        response = app.response_class(status=304)
+    else:
+        response = jsonify(render(item_price_history(item_numbers, since, until, limit)))
+    response.set_etag(etag)
+    if last_modified:
+        response.last_modified = last_modified
+    response.cache_control.no_cache = True
+    return response
 
 @app.route('/api/item/<item_number>')
 def get_item_history(item_number):
     """API endpoint to get price history for an item"""
-    thirty_days_ago = datetime.now() - timedelta(days=30)
-    items = ReceiptItem.query.filter(
-        ReceiptItem.item_number == item_number,
-        ReceiptItem.date_recorded >= thirty_days_ago
-    ).order_by(ReceiptItem.date_recorded.desc()).all()
+    return item_history_response([item_number], lambda history: history[item_number])
+
+@app.route('/api/items')
+def get_items_history():
+    """API endpoint to get price history for several items, e.g. ?item=123&item=456 or ?item=123,456"""
+    item_numbers = requested_item_numbers()
+    if not item_numbers:
+        return jsonify({'error': 'Pass one or more item numbers as ?item='}), 400
+    if len(item_numbers) > app.config['ITEM_HISTORY_MAX_ITEMS']:
+        return jsonify({'error': f"At most {app.config['ITEM_HISTORY_MAX_ITEMS']} items per request"}), 400
+    return item_history_response(item_numbers, lambda history: history)
+
+@app.route('/api/item/<item_number>/summary')
+def get_item_summary(item_number):
+    """API endpoint for an item's last and lowest recent price, overall and per store"""
+    since = price_window_start()
+    summaries = ItemPriceSummary.query.filter_by(item_number=item_number) \
+        .order_by(ItemPriceSummary.store_number.asc()).all()
+    if not summaries:
+        return jsonify({'error': 'Item not found'}), 404
     
-    history = []
-    for item in items:
-        history.append({
-            'price': item.price,
-            'date': item.date_recorded.isoformat(),
-            'store': item.receipt.store_address,
-            'store_number': item.receipt.store_number
+    # Refresh minimums that have aged out of the window (rare; one query each)
+    expired = [summary for summary in summaries if summary.min_seen is not None and summary.min_seen < since]
+    for summary in expired:
+        lowest = lowest_recent_prices([item_number], since, summary.store_number or None)
+        summary.min_price, summary.min_store_address, summary.min_seen = lowest.get(item_number, (None, None, None))
+    if expired:
+        db.session.commit()
+    
+    overall, stores = None, []
+    for summary in summaries:
+        if summary.store_number:
+            stores.append(summary.to_dict())
+        else:
+            overall = summary.to_dict()
+    return jsonify({'item_number': item_number, 'overall': overall, 'stores': stores})
+
+@app.route('/api/stats')
+def get_stats():
+    """API endpoint for spending totals overall, per store, per month and for the top items.
+    
+    Everything comes from the spending rollups; ?items=N sets how many of
+    the items with the highest spend are listed (default 20, at most 100).
+    """
+    top_items = min(max(request.args.get('items', 20, type=int), 0), 100)
+    total = db.session.get(SpendingRollup, ('total', ''))
+    
+    # The overall row changes with every stored receipt
+    key = f"{total.receipt_count}|{total.item_count}|{total.updated_at.isoformat()}" if total else 'empty'
+    etag = hashlib.sha1(f"{key}|{top_items}".encode('utf-8')).hexdigest()
+    last_modified = total.updated_at.replace(microsecond=0) if total else None
+    if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        response = app.response_class(status=304)
+    else:
+        rollups = SpendingRollup.query.filter(SpendingRollup.dimension.in_(['store', 'month'])).all()
+        items = []
+        if top_items:
+            items = SpendingRollup.query.filter_by(dimension='item') \
+                .order_by(SpendingRollup.spend.desc(), SpendingRollup.key.asc()).limit(top_items).all()
+        
+        # Name the top-price and top-discount items in one lookup
+        rows = ([total] if total else []) + rollups + items
+        referenced = {item for row in rows for item in (row.top_price_item, row.top_discount_item) if item}
+        descriptions = dict(db.session.query(SpendingRollup.key, SpendingRollup.label).filter(
+            SpendingRollup.dimension == 'item', SpendingRollup.key.in_(sorted(referenced))
+        )) if referenced else {}
+        
+        def to_dict(row):
+            data = row.to_dict()
+            for name in ('top_price', 'top_discount'):
+                if data[name]:
+                    data[name]['description'] = descriptions.get(data[name]['item_number'])
+            return data
+        
+        response = jsonify({
+            'totals': to_dict(total) if total else
+            {'receipts': 0, 'items': 0, 'spend': 0, 'discount': 0, 'top_price': None, 'top_discount': None},
+            'stores': [to_dict(row) for row in sorted(
+                (row for row in rollups if row.dimension == 'store'), key=lambda row: -row.spend)],
+            'months': [to_dict(row) for row in sorted(
+                (row for row in rollups if row.dimension == 'month'), key=lambda row: row.key)],
+            'top_items': [to_dict(row) for row in items],
+            'updated_at': total.updated_at.isoformat() if total else None
         })
+    response.set_etag(etag)
+    if last_modified:
+        response.last_modified = last_modified
+    response.cache_control.no_cache = True
+    return response
+
+# Columnar purchase history for /api/analytics, shared by the requests of this process.
+# Created on the first analytics request, since price_analytics loads NumPy.
+price_analytics = None
+_price_analytics_lock = threading.Lock()
+
+def load_price_history():
+    """The cached PriceHistory of every stored purchase, reloaded once receipt_item changes"""
+    global price_analytics
+    if price_analytics is None:
+        from price_analytics import PriceAnalytics
+        with _price_analytics_lock:
+            if price_analytics is None:
+                price_analytics = PriceAnalytics()
+    # Both are index lookups. A new receipt raises the highest item id, and every stored
+    # receipt or rollup rebuild (which re-parsing ends with) moves the overall rollup's updated_at
+    total_updated_at = db.session.query(SpendingRollup.updated_at).filter_by(dimension='total', key='').scalar()
+    version = (db.session.query(db.func.max(ReceiptItem.id)).scalar(), total_updated_at)
+    
+    def load_rows():
+        return db.session.query(
+            ReceiptItem.item_number, Receipt.store_number, ReceiptItem.date_recorded,
+            ReceiptItem.price, ReceiptItem.discount
+        ).join(Receipt, Receipt.id == ReceiptItem.receipt_id).yield_per(10000)
     
-    return jsonify(history)
+    return price_analytics.history(version, load_rows)
 
-if __name__ == '__main__':
-    with app.app_context():
+def analytics_window():
+    """(since as epoch seconds, window days) from ?days=, starting at midnight UTC like the item history"""
+    from price_analytics import to_epoch
+    
+    days = request.args.get('days', PRICE_WINDOW_DAYS, type=int)
+    if days is None or days < 1:
+        raise ValueError('days must be a positive integer')
+    since = (datetime.utcnow() - timedelta(days=days)).replace(hour=0, minute=0, second=0, microsecond=0)
+    return to_epoch(since), days
+
+def requested_item_numbers():
+    """Item numbers from ?item=123&item=456 or ?item=123,456, in order and de-duplicated"""
+    item_numbers = []
+    for value in request.args.getlist('item'):
+        for item_number in value.split(','):
+            item_number = item_number.strip()
+            if item_number and item_number not in item_numbers:
+                item_numbers.append(item_number)
+    return item_numbers
+
+@app.route('/api/analytics')
+def get_analytics():
+    """API endpoint for per-item price analytics over all stored purchases.
+    
+    ?sort= ranks items by store spread (default), price changes, discount
+    depth or observations; ?item= restricts to given items; ?days= sets the
+    window for the recent minimum and the cross-store spread.
+    """
+    from price_analytics import SORT_KEYS
+    
+    sort = request.args.get('sort', 'spread')
+    if sort not in SORT_KEYS:
+        return jsonify({'error': f"sort must be one of {', '.join(SORT_KEYS)}"}), 400
+    try:
+        since, days = analytics_window()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    limit = min(max(request.args.get('limit', 20, type=int), 1), app.config['ITEM_HISTORY_MAX_ITEMS'])
+    item_numbers = requested_item_numbers() or None
+    
+    history = load_price_history()
+    summary = history.summary(since, days)
+    items = [history.item_report(summary, index)
+             for index in history.top_items(summary, sort, limit, item_numbers)]
+    
+    descriptions = dict(db.session.query(SpendingRollup.key, SpendingRollup.label).filter(
+        SpendingRollup.dimension == 'item', SpendingRollup.key.in_([item['item_number'] for item in items])
+    )) if items else {}
+    for item in items:
+        item['description'] = descriptions.get(item['item_number'])
+    return jsonify({'sort': sort, 'days': days, 'purchases': len(history), 'items': items})
+
+@app.route('/api/analytics/changes')
+def get_price_changes():
+    """API endpoint for price changes (same item, same store) within ?days=, newest first"""
+    try:
+        since, days = analytics_window()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    limit = min(max(request.args.get('limit', 100, type=int), 1), app.config['ITEM_HISTORY_MAX_LIMIT'])
+    
+    history = load_price_history()
+    summary = history.summary(since, days)
+    changes = history.recent_changes(summary, since, limit, requested_item_numbers() or None)
+    return jsonify({'days': days, 'changes': changes})
+
+def add_missing_columns():
+    """ALTER TABLE ... ADD COLUMN for nullable model columns an older database lacks"""
+    inspector = db.inspect(db.engine)
+    for table in db.metadata.sorted_tables:
+        existing = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing or not column.nullable:
+                continue
+            column_type = column.type.compile(dialect=db.engine.dialect)
+            with db.engine.begin() as connection:
+                connection.execute(db.text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+            logger.info("Added column %s.%s", table.name, column.name)
+
+def schema_lock_path():
+    """Lock file init_db holds: next to a SQLite database, otherwise in the instance folder"""
+    database = db.engine.url.database
+    if db.engine.dialect.name == 'sqlite' and database and database != ':memory:':
+        return f'{database}.init.lock'
+    os.makedirs(app.instance_path, exist_ok=True)
+    return os.path.join(app.instance_path, 'init_db.lock')
+
+def init_db():
+    """Create any tables, columns and indexes missing from the database.
+    
+    Every worker process runs this when it imports the app. The lock makes
+    them take turns, so the first one migrates and the rest find nothing
+    left to do.
+    """
+    with app.app_context(), exclusive_lock(schema_lock_path()):
         db.create_all()
+        # create_all skips existing tables, so add columns and indexes introduced since
+        add_missing_columns()
+        for table in db.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(bind=db.engine, checkfirst=True)
+        # Summaries and rollups are kept up to date with every receipt, so empty ones
+        # next to stored items mean a database from before they existed
+        has_items = db.session.query(ReceiptItem.id).first() is not None
+        if has_items and db.session.query(ItemPriceSummary.item_number).first() is None:
+            logger.info("Building item price summaries from existing receipts")
+            rebuild_price_summaries()
+        if has_items and db.session.query(SpendingRollup.dimension).first() is None:
+            logger.info("Building spending rollups from existing receipts")
+            rebuild_spending_rollups()
+
+@app.cli.command('rebuild-price-summary')
+def rebuild_price_summary_command():
+    """Recompute the per-item price summaries from all stored receipt items."""
+    count = rebuild_price_summaries()
+    print(f"Rebuilt {count} item price summaries")
+
+@app.cli.command('rebuild-stats')
+def rebuild_stats_command():
+    """Recompute the spending rollups behind /api/stats from all stored receipts."""
+    count = rebuild_spending_rollups()
+    print(f"Rebuilt {count} spending rollups")
+
+@app.cli.command('price-analytics')
+@click.option('--sort', default='spread', show_default=True,
+              help='Rank by spread, changes, discount or observations.')
+@click.option('--limit', type=int, default=20, show_default=True)
+@click.option('--days', type=int, default=PRICE_WINDOW_DAYS, show_default=True,
+              help='Window for the recent minimum and the cross-store spread.')
+def price_analytics_command(sort, limit, days):
+    """Print per-item price analytics computed over all stored purchases."""
+    from price_analytics import SORT_KEYS, to_epoch
+    
+    if sort not in SORT_KEYS:
+        raise click.BadParameter(f"must be one of {', '.join(SORT_KEYS)}", param_hint='--sort')
+    since = (datetime.utcnow() - timedelta(days=days)).replace(hour=0, minute=0, second=0, microsecond=0)
+    history = load_price_history()
+    summary = history.summary(to_epoch(since), days)
+    print(f"{len(history)} purchases of {len(history.items)} items; top {limit} by {sort}, {days}-day window")
+    print(f"{'item':>10} {'seen':>5} {'last':>8} {'low':>8} {'changes':>7} {'disc %':>6} {'stores':>6} {'spread':>7}  cheapest")
+    for index in history.top_items(summary, sort, limit):
+        item = history.item_report(summary, index)
+        low = f"{item['window_min']:.2f}" if item['window_min'] is not None else '-'
+        spread = f"{item['stores']['spread']:.2f}" if item['stores']['spread'] is not None else '-'
+        print(f"{item['item_number']:>10} {item['observations']:>5} {item['last_price']:>8.2f} {low:>8} "
+              f"{item['price_changes']:>7} {item['avg_discount_depth'] * 100:>6.1f} {item['stores']['count']:>6} "
+              f"{spread:>7}  {item['stores']['cheapest'] or '-'}")
+
+init_db()
+if app.config['OCR_PRELOAD']:
+    get_processor()
+
+if __name__ == '__main__':
+    job_workers.start()
     port = int(os.environ.get('PORT', 5002))
     app.run(debug=os.environ.get('DEBUG', 'False').lower() == 'true', 
             host='0.0.0.0', port=port) 
\ No newline at end of file
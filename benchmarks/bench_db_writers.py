@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+"""
+Concurrent database writer stress test
+
+Starts N writer processes, each storing synthetic parsed receipts through
+the app's store_receipt + commit path (with its locked-write retry), while
+reader processes keep querying the history totals. This is what several
+gunicorn workers do to one SQLite file. Every journal mode and writer count
+runs against a fresh temporary database and reports receipts/sec, commit
+latency, retries and writes that failed even after retrying.
+
+    python benchmarks/bench_db_writers.py
+    python benchmarks/bench_db_writers.py --writers 1,4,8 --journal-modes WAL,DELETE --retries 1
+    python benchmarks/bench_db_writers.py --busy-timeout 0.05   # exercise the retry path
+"""
+
+import argparse
+import multiprocessing
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def configure_environment(db_path, journal_mode, retries, busy_timeout):
+    """Settings the spawned processes pick up when they import app"""
+    os.environ.update({
+        'DATABASE_URL': f'sqlite:///{db_path}',
+        'SQLITE_JOURNAL_MODE': journal_mode,
+        'DB_WRITE_RETRIES': str(retries),
+        'DB_BUSY_TIMEOUT': str(busy_timeout),
+        'OCR_CACHE_ENABLED': 'false',
+        'ITEM_CATALOG_ENABLED': 'false',
+        'LOG_LEVEL': 'ERROR',
+    })
+
+
+def make_receipt_data(rng, num_items):
+    store_number = str(rng.choice([148, 423, 1061]))
+    return {
+        'store_info': {'address': f'Store {store_number}', 'store_number': store_number},
+        'receipt_date': None,
+        'items': [
+            {'item_number': str(rng.randrange(100000, 100500)), 'description': 'BENCH ITEM',
+             'price': round(rng.uniform(1, 50), 2), 'discount': 0}
+            for _ in range(num_items)
+        ],
+    }
+
+
+def init_database():
+    import app  # noqa: F401  Importing creates the tables
+
+
+def writer(index, receipts, num_items, start, results):
+    from app import app, db, store_receipt, write_with_retry, DB_WRITE_RETRIES
+
+    rng = random.Random(index)
+    latencies, failed = [], 0
+    with app.app_context():
+        start.wait()
+        for _ in range(receipts):
+            receipt_data = make_receipt_data(rng, num_items)
+
+            def save():
+                store_receipt(receipt_data)
+                db.session.commit()
+
+            began = time.perf_counter()
+            try:
+                write_with_retry(save)
+                latencies.append(time.perf_counter() - began)
+            except Exception:
+                db.session.rollback()
+                failed += 1
+    results.put(('writer', latencies, failed, DB_WRITE_RETRIES.value()))
+
+
+def reader(stop, start, results):
+    from app import app, db, history_summary
+
+    reads, failed = 0, 0
+    with app.app_context():
+        start.wait()
+        while not stop.is_set():
+            try:
+                history_summary()
+                db.session.rollback()  # End the read transaction, as a request would
+                reads += 1
+            except Exception:
+                db.session.rollback()
+                failed += 1
+    results.put(('reader', reads, failed, 0))
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def run(journal_mode, writers, readers, receipts, num_items, retries, busy_timeout):
+    directory = tempfile.mkdtemp(prefix='bench_db_')
+    try:
+        configure_environment(os.path.join(directory, 'bench.db'), journal_mode, retries, busy_timeout)
+        context = multiprocessing.get_context('spawn')
+        setup = context.Process(target=init_database)
+        setup.start()
+        setup.join()
+
+        start, stop, results = context.Event(), context.Event(), context.Queue()
+        processes = [context.Process(target=writer, args=(i, receipts, num_items, start, results))
+                     for i in range(writers)]
+        processes += [context.Process(target=reader, args=(stop, start, results)) for _ in range(readers)]
+        for process in processes:
+            process.start()
+        time.sleep(1.0)  # Let every process import the app before the clock starts
+
+        began = time.perf_counter()
+        start.set()
+        latencies, failed, retried, reads, read_failures = [], 0, 0, 0, 0
+        for _ in range(writers):
+            _, writer_latencies, writer_failed, writer_retries = results.get()
+            latencies += writer_latencies
+            failed += writer_failed
+            retried += writer_retries
+        elapsed = time.perf_counter() - began
+        stop.set()
+        for _ in range(readers):
+            _, reader_reads, reader_failed, _ = results.get()
+            reads += reader_reads
+            read_failures += reader_failed
+        for process in processes:
+            process.join()
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    return {
+        'journal_mode': journal_mode,
+        'writers': writers,
+        'receipts_per_sec': len(latencies) / elapsed,
+        'p50_ms': percentile(latencies, 0.5) * 1000,
+        'p95_ms': percentile(latencies, 0.95) * 1000,
+        'retries': retried,
+        'failed': failed,
+        'reads_per_sec': reads / elapsed,
+        'read_failures': read_failures,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--writers', default='1,2,4,8', type=lambda value: [int(n) for n in value.split(',')],
+                        help='comma-separated writer process counts')
+    parser.add_argument('--readers', type=int, default=1, help='reader processes running alongside the writers')
+    parser.add_argument('--journal-modes', default='WAL,DELETE', type=lambda value: value.split(','),
+                        help='SQLite journal modes to compare')
+    parser.add_argument('--receipts', type=int, default=40, help='receipts stored by each writer')
+    parser.add_argument('--items', type=int, default=20, help='items per receipt')
+    parser.add_argument('--retries', type=int, default=5, help='attempts per locked write (1 disables retrying)')
+    parser.add_argument('--busy-timeout', type=float, default=30.0,
+                        help='seconds a connection waits for a lock before the write counts as locked')
+    args = parser.parse_args()
+
+    print(f"{'journal':<8} {'writers':>7} {'receipts/s':>11} {'p50 ms':>8} {'p95 ms':>8} "
+          f"{'retries':>8} {'failed':>7} {'reads/s':>9} {'read err':>8}")
+    for journal_mode in args.journal_modes:
+        for writers in args.writers:
+            result = run(journal_mode, writers, args.readers, args.receipts, args.items, args.retries,
+                         args.busy_timeout)
+            print(f"{result['journal_mode']:<8} {result['writers']:>7} {result['receipts_per_sec']:>11.1f} "
+                  f"{result['p50_ms']:>8.1f} {result['p95_ms']:>8.1f} {result['retries']:>8} "
+                  f"{result['failed']:>7} {result['reads_per_sec']:>9.1f} {result['read_failures']:>8}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+Receipt parser benchmark
+
+Runs ReceiptProcessor.parse_receipt_text over the saved OCR texts in
+benchmarks/corpus, checks the output against the recorded *.json results
+and reports throughput in lines per second.
+
+    python benchmarks/bench_parser.py             # check + benchmark
+    python benchmarks/bench_parser.py --update    # re-record expected output
+"""
+
+import argparse
+import contextlib
+import glob
+import io
+import json
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CORPUS_DIR = os.path.join(ROOT, 'benchmarks', 'corpus')
+
+# Keep the benchmark away from the real database and OCR cache
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+os.environ.setdefault('OCR_CACHE_ENABLED', 'false')
+sys.path.insert(0, ROOT)
+
+from app import ReceiptProcessor  # noqa: E402
+
+
+def to_jsonable(result):
+    return {
+        'store_info': result['store_info'],
+        'items': result['items'],
+        'receipt_date': result['receipt_date'].isoformat() if result['receipt_date'] else None,
+        'totals': result['totals'],
+    }
+
+
+def load_corpus():
+    corpus = []
+    for path in sorted(glob.glob(os.path.join(CORPUS_DIR, '*.txt'))):
+        with open(path, newline='') as f:
+            corpus.append((path, f.read()))
+    return corpus
+
+
+def parse_quietly(processor, text):
+    # The parser prints debug output for every line; keep it out of the timings
+    with contextlib.redirect_stdout(io.StringIO()):
+        return processor.parse_receipt_text(text)
+
+
+def check_corpus(processor, corpus, update=False):
+    failures = 0
+    for path, text in corpus:
+        expected_path = path[:-len('.txt')] + '.json'
+        result = to_jsonable(parse_quietly(processor, text))
+        if update:
+            with open(expected_path, 'w') as f:
+                json.dump(result, f, indent=2, sort_keys=True)
+                f.write('\n')
+            print(f"recorded {os.path.basename(expected_path)}")
+            continue
+
+        with open(expected_path) as f:
+            expected = json.load(f)
+        if result != expected:
+            failures += 1
+            print(f"MISMATCH {os.path.basename(path)}")
+            print(f"  expected: {json.dumps(expected, sort_keys=True)}")
+            print(f"  got:      {json.dumps(result, sort_keys=True)}")
+        else:
+            print(f"ok       {os.path.basename(path)}")
+    return failures
+
+
+def benchmark(processor, corpus, min_seconds):
+    total_lines = sum(text.count('\n') + 1 for _, text in corpus)
+    runs = 0
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()) as sink:
+        while time.perf_counter() - start < min_seconds:
+            for _, text in corpus:
+                processor.parse_receipt_text(text)
+            runs += 1
+            sink.seek(0)
+            sink.truncate()
+    elapsed = time.perf_counter() - start
+    return runs * total_lines / elapsed, runs, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--update', action='store_true', help='re-record the expected output')
+    parser.add_argument('--seconds', type=float, default=3.0, help='minimum benchmark duration')
+    args = parser.parse_args()
+
+    processor = ReceiptProcessor()
+    corpus = load_corpus()
+    if not corpus:
+        print(f"No corpus files found in {CORPUS_DIR}")
+        return 1
+
+    failures = check_corpus(processor, corpus, update=args.update)
+    if args.update:
+        return 0
+
+    lines_per_second, runs, elapsed = benchmark(processor, corpus, args.seconds)
+    print(f"\n{len(corpus)} receipts x {runs} runs in {elapsed:.2f}s: {lines_per_second:,.0f} lines/sec")
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+"""
+Receipt pipeline stage benchmark
+
+Generates synthetic Costco-style receipt photos (see synthetic.py) in a few
+sizes and times each stage of ReceiptProcessor on its own: image decode,
+preprocessing, one OCR pass and parsing, per preprocessing profile. Reports
+ops/sec, mean latency and peak traced memory per stage, plus how many of
+the receipt's items survive OCR + parsing. Results can be saved as JSON and
+compared against an earlier run.
+
+    python benchmarks/bench_stages.py --output before.json
+    python benchmarks/bench_stages.py --baseline before.json
+    python benchmarks/bench_stages.py --sizes 10,80 --profiles fast --skip-ocr
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Keep the benchmark away from the real database and OCR cache
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+os.environ.setdefault('OCR_CACHE_ENABLED', 'false')
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import cv2  # noqa: E402
+import pytesseract  # noqa: E402
+
+from app import ReceiptProcessor  # noqa: E402
+from ocr_backends import create_ocr_backend  # noqa: E402
+from synthetic import make_receipt  # noqa: E402
+
+
+def measure(func, min_seconds, min_runs):
+    """Run func repeatedly; returns (runs, elapsed seconds, peak traced MB, last result)"""
+    # One traced run for memory, kept out of the timings since tracing is slow
+    tracemalloc.start()
+    result = func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    runs = 0
+    start = time.perf_counter()
+    while runs < min_runs or time.perf_counter() - start < min_seconds:
+        result = func()
+        runs += 1
+    return runs, time.perf_counter() - start, peak / (1024 * 1024), result
+
+
+def item_recall(expected_items, parsed_items):
+    """Fraction of the receipt's (item_number, final price) pairs the parser recovered"""
+    if not expected_items:
+        return 1.0
+    found = {(item['item_number'], round(item['price'], 2)) for item in parsed_items}
+    return sum(1 for item in expected_items if item in found) / len(expected_items)
+
+
+def tesseract_version():
+    try:
+        return str(pytesseract.get_tesseract_version())
+    except Exception:
+        return None
+
+
+def run_benchmarks(args):
+    processor = ReceiptProcessor(ocr_backend=create_ocr_backend(os.environ.get('OCR_BACKEND', 'auto')))
+    ocr_config = processor.ocr_configs[0]
+    results = []
+
+    def record(receipt_name, stage, profile, func, min_runs=3, expected_items=None):
+        runs, elapsed, peak_mb, result = measure(func, args.seconds, min_runs)
+        entry = {
+            'receipt': receipt_name,
+            'stage': stage,
+            'profile': profile,
+            'runs': runs,
+            'ops_per_sec': round(runs / elapsed, 3),
+            'mean_ms': round(elapsed / runs * 1000, 3),
+            'peak_mb': round(peak_mb, 2),
+        }
+        recall = ''
+        if expected_items is not None:
+            parsed = result if stage == 'parse' else processor.parse_receipt_text(result)
+            entry['item_recall'] = round(item_recall(expected_items, parsed['items']), 3)
+            recall = f"{entry['item_recall']:>8.0%}"
+        results.append(entry)
+        print(f"{receipt_name:>10} {stage:<11} {profile or '-':<8} {entry['ops_per_sec']:>10.2f} ops/s "
+              f"{entry['mean_ms']:>10.2f} ms {entry['peak_mb']:>8.1f} MB{recall}")
+        return result
+
+    print(f"{'receipt':>10} {'stage':<11} {'profile':<8} {'throughput':>15} {'latency':>13} {'peak':>11} {'recall':>7}")
+    for size in args.sizes:
+        receipt = make_receipt(size, seed=args.seed)
+        name = f'items_{size}'
+
+        record(name, 'parse', None, lambda: processor.parse_receipt_text(receipt.text),
+               min_runs=10, expected_items=receipt.items)
+
+        for profile in args.profiles:
+            decoded = record(name, 'decode', profile, lambda: processor.decode_image(receipt.image_bytes, profile))
+            # The quality profile takes seconds on large photos, so a single run is enough
+            processed = record(name, 'preprocess', profile,
+                               lambda: processor.preprocess_image(decoded, profile), min_runs=1)
+            if args.skip_ocr:
+                continue
+            record(name, 'ocr', profile, lambda: processor.ocr_pass(processed, ocr_config),
+                   min_runs=1, expected_items=receipt.items)
+
+    return results
+
+
+def compare_to_baseline(results, baseline, threshold):
+    """Print per-stage changes against a baseline run; returns the number of regressions"""
+    previous = {(r['receipt'], r['stage'], r['profile']): r for r in baseline['results']}
+    regressions = 0
+    print(f"\nCompared with baseline from {baseline['meta'].get('timestamp', '?')}:")
+    for result in results:
+        before = previous.get((result['receipt'], result['stage'], result['profile']))
+        if before is None or not before['ops_per_sec']:
+            continue
+        change = result['ops_per_sec'] / before['ops_per_sec'] - 1
+        flag = ''
+        if change < -threshold:
+            flag = '  SLOWER'
+            regressions += 1
+        elif change > threshold:
+            flag = '  faster'
+        recall = ''
+        if 'item_recall' in result and 'item_recall' in before:
+            recall = f"  recall {before['item_recall']:.2f} -> {result['item_recall']:.2f}"
+            if result['item_recall'] < before['item_recall']:
+                regressions += 1
+                flag += '  LESS ACCURATE'
+        print(f"{result['receipt']:>10} {result['stage']:<11} {result['profile'] or '-':<8} "
+              f"{change:+8.1%}{recall}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', default='10,30,80',
+                        type=lambda value: [int(size) for size in value.split(',')],
+                        help='comma-separated item counts per synthetic receipt')
+    parser.add_argument('--profiles', default=','.join(ReceiptProcessor.PREPROCESS_PROFILES),
+                        type=lambda value: value.split(','), help='preprocessing profiles to benchmark')
+    parser.add_argument('--seconds', type=float, default=1.0, help='minimum time per stage')
+    parser.add_argument('--seed', type=int, default=0, help='synthetic receipt seed')
+    parser.add_argument('--skip-ocr', action='store_true', help='time decode, preprocess and parse only')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='compare with the results in this JSON file')
+    parser.add_argument('--threshold', type=float, default=0.10,
+                        help='relative slowdown reported as a regression (default 0.10)')
+    args = parser.parse_args()
+
+    version = tesseract_version()
+    if version is None and not args.skip_ocr:
+        print("Tesseract is not installed; skipping the OCR stage")
+        args.skip_ocr = True
+
+    results = run_benchmarks(args)
+    report = {
+        'meta': {
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'opencv': cv2.__version__,
+            'tesseract': version,
+            'sizes': args.sizes,
+            'profiles': args.profiles,
+            'seed': args.seed,
+        },
+        'results': results,
+    }
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+            f.write('\n')
+        print(f"\nWrote {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare_to_baseline(results, baseline, args.threshold)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""
+Worker startup benchmark
+
+Starts fresh interpreters that import the app the way a gunicorn worker
+does, then time the first request to a few routes. Each run reports the
+import time, the first-request latency per route and which parts of the
+OCR stack (OpenCV, NumPy, Pillow, Tesseract, dateutil) got loaded along
+the way. Runs with OCR_PRELOAD on and off show what loading the OCR stack
+lazily saves a worker that only serves pages and the API.
+
+    python benchmarks/bench_startup.py
+    python benchmarks/bench_startup.py --runs 10 --routes /history,/api/stats
+"""
+
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+HEAVY_MODULES = ('cv2', 'numpy', 'PIL', 'pytesseract', 'tesserocr', 'dateutil')
+
+# Runs in the child interpreter; prints one JSON line
+CHILD = '''
+import json, sys, time
+began = time.perf_counter()
+import app
+imported = time.perf_counter() - began
+client = app.app.test_client()
+first_request = {}
+for route in sys.argv[1].split(','):
+    began = time.perf_counter()
+    client.get(route)
+    first_request[route] = time.perf_counter() - began
+print(json.dumps({'import': imported, 'first_request': first_request,
+                  'loaded': [name for name in sys.argv[2].split(',') if name in sys.modules]}))
+'''
+
+
+def run_once(routes, preload, directory):
+    env = dict(os.environ,
+               DATABASE_URL=f"sqlite:///{os.path.join(directory, 'bench.db')}",
+               OCR_CACHE_PATH=os.path.join(directory, 'ocr_cache.db'),
+               OCR_PRELOAD='true' if preload else 'false',
+               LOG_LEVEL='ERROR')
+    output = subprocess.run([sys.executable, '-c', CHILD, ','.join(routes), ','.join(HEAVY_MODULES)],
+                            cwd=ROOT, env=env, capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5, help='fresh interpreters per mode; medians are reported')
+    parser.add_argument('--routes', default='/history,/api/stats,/api/analytics',
+                        type=lambda value: value.split(','), help='comma-separated routes to request once each')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='bench_startup_')
+    try:
+        run_once(args.routes, False, directory)  # Create the database so every run imports against the same one
+        print(f"{'mode':<8} {'import ms':>9} " + ' '.join(f'{route:>16}' for route in args.routes) + '  loaded')
+        for preload in (False, True):
+            results = [run_once(args.routes, preload, directory) for _ in range(args.runs)]
+            import_ms = statistics.median(result['import'] for result in results) * 1000
+            route_ms = [statistics.median(result['first_request'][route] for result in results) * 1000
+                        for route in args.routes]
+            print(f"{'preload' if preload else 'lazy':<8} {import_ms:>9.1f} "
+                  + ' '.join(f'{ms:>16.1f}' for ms in route_ms)
+                  + f"  {', '.join(results[-1]['loaded']) or '-'}")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
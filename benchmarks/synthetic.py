@@ -0,0 +1,141 @@
+"""
+Synthetic Costco-style receipt images
+
+Renders a receipt (store header, item lines, /item discount lines, totals
+and date) with a monospaced font and then makes it look like a phone photo
+of thermal paper: a grey background margin, a slight skew, sensor noise
+and JPEG compression. The rendered text and the expected items come back
+with the image, so OCR accuracy can be scored as well as timed.
+"""
+
+import io
+import os
+import random
+from dataclasses import dataclass, field
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFilter, ImageFont
+
+STORES = [
+    ('HAYWARD', 1061, '28505 HESPERIAN BLVD', 'HAYWARD, CA 94545'),
+    ('FREMONT', 148, '43621 PACIFIC COMMONS BLVD', 'FREMONT, CA 94538'),
+    ('SAN JOSE', 423, '1709 AUTOMATION DR', 'SAN JOSE, CA 95131'),
+    ('MOUNTAIN VIEW', 143, '1000 N RENGSTORFF AVE', 'MOUNTAIN VIEW, CA 94043'),
+]
+
+PRODUCTS = [
+    'KS TOWEL 24PK', 'ORG BANANAS', 'KS WATER 40PK', 'ROTISSERIE CHKN', 'KIRKLAND OLIVE OIL',
+    'CHEERIOS 2PK', 'PAPER TOWELS', 'AAA BATTERIES 48CT', 'ORG EGGS 24CT', 'KS BUTTER 4LB',
+    'STRAWBERRIES 2LB', 'AVOCADOS 6CT', 'KS COFFEE 3LB', 'GREEK YOGURT', 'SALMON FILLET',
+    'KS ALMOND MILK', 'BABY SPINACH', 'KS TRASH BAGS', 'DISH SOAP 2PK', 'MIXED NUTS 2.5LB',
+    'PROTEIN BARS', 'KS DIAPERS', 'GROUND BEEF 88', 'ORG BLUEBERRY', 'SPARKLING WATER',
+]
+
+FONT_PATHS = [
+    '/usr/share/fonts/truetype/dejavu/DejaVuSansMono.ttf',
+    '/usr/share/fonts/TTF/DejaVuSansMono.ttf',
+    '/Library/Fonts/Courier New.ttf',
+    'C:\\Windows\\Fonts\\cour.ttf',
+]
+
+
+@dataclass
+class SyntheticReceipt:
+    image_bytes: bytes
+    text: str
+    items: list = field(default_factory=list)  # [(item_number, final price)]
+    size: tuple = (0, 0)
+
+
+def load_font(size):
+    for path in FONT_PATHS:
+        if os.path.exists(path):
+            return ImageFont.truetype(path, size)
+    return ImageFont.load_default()
+
+
+def receipt_lines(num_items, rng, discount_rate=0.2):
+    """Receipt text lines plus the [(item_number, final price)] a perfect parse yields"""
+    store, number, street, city = rng.choice(STORES)
+    lines = ['COSTCO', 'WHOLESALE', f'{store} #{number}', street, city,
+             f'Member {rng.randrange(10 ** 11, 10 ** 12)}', '']
+
+    items = []
+    subtotal = 0.0
+    used = set()
+    for _ in range(num_items):
+        item_number = str(rng.randrange(100000, 9999999))
+        while item_number in used:
+            item_number = str(rng.randrange(100000, 9999999))
+        used.add(item_number)
+        price = round(rng.uniform(1.5, 60.0), 2)
+        lines.append(f'E {item_number} {rng.choice(PRODUCTS)} {price:.2f}')
+
+        final_price = price
+        if rng.random() < discount_rate:
+            discount = round(min(price - 0.5, rng.choice([1.0, 2.0, 3.0, 4.0, 5.0])), 2)
+            lines.append(f'E {rng.randrange(300000, 399999)} /{item_number} {discount:.2f}-')
+            final_price = round(price - discount, 2)
+        items.append((item_number, final_price))
+        subtotal += final_price
+
+    tax = round(subtotal * 0.0925, 2)
+    lines += [
+        f'SUBTOTAL {subtotal:.2f}',
+        f'TAX {tax:.2f}',
+        f'**** TOTAL {subtotal + tax:.2f}',
+        f'VISA {subtotal + tax:.2f}',
+        f'{rng.randint(1, 12):02d}/{rng.randint(1, 28):02d}/2024 {rng.randint(8, 21):02d}:{rng.randint(0, 59):02d} '
+        f'{number} {rng.randint(1, 30)} {rng.randint(100, 999)}',
+        'THANK YOU',
+    ]
+    return lines, items
+
+
+def render_receipt(lines, font_size=28, line_spacing=1.35, width_chars=36):
+    """Render text lines as clean black-on-white receipt paper"""
+    font = load_font(font_size)
+    left, top, right, bottom = font.getbbox('M' * width_chars)
+    char_height = bottom - top
+    line_height = int(char_height * line_spacing) + 2
+    margin = font_size
+
+    image = Image.new('L', (right - left + 2 * margin, len(lines) * line_height + 2 * margin), 255)
+    draw = ImageDraw.Draw(image)
+    for i, line in enumerate(lines):
+        draw.text((margin, margin + i * line_height), line, font=font, fill=0)
+    return image
+
+
+def photograph(paper, rng, skew_degrees=1.5, noise=8.0, blur=0.6, background=110, jpeg_quality=85):
+    """Make clean receipt paper look like a phone photo of it"""
+    # Thermal print is never pure black, and the paper is rarely pure white
+    paper_array = np.asarray(paper, dtype=np.float32)
+    paper = Image.fromarray((40 + paper_array * (205 / 255.0)).astype(np.uint8))
+
+    pad = paper.width // 6
+    photo = Image.new('L', (paper.width + 2 * pad, paper.height + 2 * pad), background)
+    photo.paste(paper, (pad, pad))
+    angle = rng.uniform(-skew_degrees, skew_degrees)
+    photo = photo.rotate(angle, resample=Image.BICUBIC, expand=False, fillcolor=background)
+    if blur:
+        photo = photo.filter(ImageFilter.GaussianBlur(blur))
+
+    pixels = np.asarray(photo, dtype=np.float32)
+    if noise:
+        noise_rng = np.random.default_rng(rng.randrange(2 ** 32))
+        pixels = pixels + noise_rng.normal(0.0, noise, pixels.shape)
+    photo = Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8)).convert('RGB')
+
+    buffer = io.BytesIO()
+    photo.save(buffer, format='JPEG', quality=jpeg_quality)
+    return buffer.getvalue(), photo.size
+
+
+def make_receipt(num_items, seed=0, discount_rate=0.2, font_size=28, skew_degrees=1.5, noise=8.0):
+    """A reproducible synthetic receipt photo with num_items items"""
+    rng = random.Random(f'{seed}-{num_items}')
+    lines, items = receipt_lines(num_items, rng, discount_rate)
+    image_bytes, size = photograph(render_receipt(lines, font_size), rng,
+                                   skew_degrees=skew_degrees, noise=noise)
+    return SyntheticReceipt(image_bytes=image_bytes, text='\n'.join(lines), items=items, size=size)
@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+"""
+Bulk importer for directories of Costco receipt images
+
+OCRs and parses receipts across a pool of processes (one per CPU core by
+default) and stores them in batched transactions. Every file is recorded
+by content hash, so running the same command again after an interrupt
+skips whatever was already imported.
+
+    python bulk_import.py ~/receipts
+    python bulk_import.py "scans/2024-*.jpg" --workers 4 --batch-size 50
+"""
+
+import argparse
+import glob
+import hashlib
+import os
+import signal
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from app import (app, db, allowed_file, create_processor, record_ocr_ranking, refresh_item_catalog,
+                 refresh_ocr_ranking, store_receipt, ImportedFile)
+from cpu_budget import available_cpus, limit_native_threads
+
+_processor = None
+
+
+def _init_worker():
+    global _processor
+    # Ctrl-C is handled by the parent, which lets running files finish
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # One OCR pass and one OpenCV/OpenMP thread per process; the process pool is the parallelism
+    limit_native_threads(1)
+    _processor = create_processor(parallel_ocr=False, ocr_pool_size=1)
+    # Item corrections use the catalog as it was when the import started; the OCR config
+    # ranking starts from the saved counts and then learns from this worker's receipts
+    with app.app_context():
+        db.engine.dispose(close=False)  # Don't share the parent's connections
+        if _processor.item_catalog is not None:
+            refresh_item_catalog(_processor.item_catalog)
+        if _processor.config_ranking is not None:
+            refresh_ocr_ranking(_processor.config_ranking, max_age=0)
+
+
+def take_ocr_ranking():
+    """OCR config counts recorded since the last call, for the parent to save"""
+    ranking = _processor.config_ranking
+    if ranking is None:
+        return {}
+    return ranking.take_pending()
+
+
+def ocr_receipt(image_bytes):
+    """Worker: OCR and parse one image; returns (receipt_data, text, ocr_config, error, ocr_ranking)"""
+    try:
+        text, ocr_config = _processor.extract_text_with_config(image_bytes)
+        if len(text.strip()) < 10:
+            return None, text, ocr_config, 'No text found in the image', take_ocr_ranking()
+        receipt_data = _processor.parse_receipt_text(text)
+        if not receipt_data['items']:
+            return None, text, ocr_config, 'No items found in the receipt', take_ocr_ranking()
+        return receipt_data, text, ocr_config, None, take_ocr_ranking()
+    except Exception as e:
+        return None, None, None, f'{type(e).__name__}: {e}', take_ocr_ranking()
+
+
+def find_images(sources):
+    """Image files under the given directories and glob patterns, sorted and de-duplicated"""
+    paths = set()
+    for source in sources:
+        if os.path.isdir(source):
+            for root, _, files in os.walk(source):
+                paths.update(os.path.join(root, name) for name in files)
+        else:
+            paths.update(glob.glob(source, recursive=True))
+    return sorted(path for path in paths if os.path.isfile(path) and allowed_file(path))
+
+
+def read_image(path):
+    with open(path, 'rb') as f:
+        image_bytes = f.read()
+    return image_bytes, hashlib.sha256(image_bytes).hexdigest()
+
+
+def import_receipts(paths, workers, batch_size, retry_failed=False):
+    """Import the given files; returns a dict of counts"""
+    counts = {'imported': 0, 'failed': 0, 'skipped': 0, 'items': 0}
+
+    already_done = db.session.query(ImportedFile.sha256)
+    if retry_failed:
+        already_done = already_done.filter(ImportedFile.receipt_id.isnot(None))
+    seen = {sha256 for sha256, in already_done}
+
+    paths = iter(paths)
+    pending = {}
+    uncommitted = 0
+    start = time.perf_counter()
+    interrupted = False
+
+    executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker)
+    try:
+        while True:
+            # Keep every worker busy without reading the whole directory into memory
+            while len(pending) < workers * 2:
+                path = next(paths, None)
+                if path is None:
+                    break
+                image_bytes, sha256 = read_image(path)
+                if sha256 in seen:
+                    counts['skipped'] += 1
+                    continue
+                seen.add(sha256)
+                pending[executor.submit(ocr_receipt, image_bytes)] = (path, sha256)
+
+            if not pending:
+                break
+
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                path, sha256 = pending.pop(future)
+                receipt_data, text, ocr_config, error, ocr_ranking = future.result()
+                record_ocr_ranking(ocr_ranking)
+
+                receipt_id = None
+                if receipt_data:
+                    try:
+                        with db.session.begin_nested():
+                            receipt, _ = store_receipt(receipt_data, ocr_text=text, ocr_config=ocr_config)
+                            receipt_id = receipt.id
+                    except Exception as e:
+                        error = f'{type(e).__name__}: {e}'
+                db.session.merge(ImportedFile(sha256=sha256, path=os.path.abspath(path),
+                                              receipt_id=receipt_id, error=error))
+                uncommitted += 1
+
+                if receipt_id:
+                    counts['imported'] += 1
+                    counts['items'] += len(receipt_data['items'])
+                    status = f"{len(receipt_data['items'])} items"
+                else:
+                    counts['failed'] += 1
+                    status = f"failed: {error}"
+                done = counts['imported'] + counts['failed']
+                rate = done / (time.perf_counter() - start)
+                print(f"[{done}] {path}: {status} ({rate:.2f} receipts/s)")
+
+            if uncommitted >= batch_size:
+                db.session.commit()
+                uncommitted = 0
+    except KeyboardInterrupt:
+        interrupted = True
+        print("\nInterrupted; saving finished receipts. Run the same command again to resume.")
+        executor.shutdown(wait=False, cancel_futures=True)
+    finally:
+        db.session.commit()
+        executor.shutdown(wait=not interrupted, cancel_futures=True)
+
+    counts['seconds'] = time.perf_counter() - start
+    counts['interrupted'] = interrupted
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('sources', nargs='+', help='directories, image files or glob patterns')
+    parser.add_argument('--workers', type=int, default=available_cpus(),
+                        help='OCR processes (default: one per core this process may use, '
+                             'after CPU affinity and container quotas)')
+    parser.add_argument('--batch-size', type=int, default=25, help='receipts per database transaction')
+    parser.add_argument('--retry-failed', action='store_true',
+                        help='process files that failed in an earlier run again')
+    args = parser.parse_args()
+
+    paths = find_images(args.sources)
+    if not paths:
+        print("No receipt images found")
+        return 1
+    print(f"Found {len(paths)} image(s); importing with {args.workers} worker(s)")
+
+    with app.app_context():
+        counts = import_receipts(paths, max(1, args.workers), max(1, args.batch_size), args.retry_failed)
+
+    processed = counts['imported'] + counts['failed']
+    rate = processed / counts['seconds'] if counts['seconds'] else 0
+    print(f"\nImported {counts['imported']} receipt(s) with {counts['items']} item(s), "
+          f"{counts['failed']} failed, {counts['skipped']} already done "
+          f"in {counts['seconds']:.1f}s ({rate:.2f} receipts/s)")
+    return 130 if counts['interrupted'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,143 @@
+"""
+CPU budget for OCR work
+
+Every app process runs OpenCV, which starts a thread pool sized to the
+machine, and Tesseract, which starts OpenMP threads for every pass. With
+one gunicorn worker per core that adds up to dozens of runnable threads
+fighting over the same cores. This module works out how many workers and
+native threads per worker fit the cores the app may use, applies those
+thread limits, and bounds how many receipts one process OCRs at once,
+turning requests away once too many are already waiting.
+"""
+
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+
+
+def cgroup_cpu_quota():
+    """CPUs allowed by the container's cgroup quota, or None when unlimited"""
+    try:
+        with open('/sys/fs/cgroup/cpu.max') as f:  # cgroup v2: "<quota> <period>" or "max <period>"
+            quota, period = f.read().split()[:2]
+        if quota != 'max':
+            return int(quota) / int(period)
+        return None
+    except (OSError, ValueError):
+        pass
+    try:
+        with open('/sys/fs/cgroup/cpu/cpu.cfs_quota_us') as f:  # cgroup v1
+            quota = int(f.read())
+        with open('/sys/fs/cgroup/cpu/cpu.cfs_period_us') as f:
+            period = int(f.read())
+        return quota / period if quota > 0 and period > 0 else None
+    except (OSError, ValueError):
+        return None
+
+
+def available_cpus():
+    """Cores this process may actually use: the affinity mask and cgroup quota, not just os.cpu_count()"""
+    try:
+        cores = len(os.sched_getaffinity(0))
+    except AttributeError:  # Not available on macOS
+        cores = os.cpu_count() or 1
+    quota = cgroup_cpu_quota()
+    if quota:
+        cores = min(cores, math.ceil(quota))
+    return max(1, cores)
+
+
+@dataclass
+class CpuBudget:
+    cores: int
+    workers: int
+    threads_per_worker: int  # OpenCV/OpenMP threads and concurrent OCR passes in each worker
+
+
+def plan_budget(cores=None, workers=None):
+    """Split the cores between worker processes; one worker per core unless told otherwise"""
+    cores = max(1, cores or available_cpus())
+    workers = max(1, workers or cores)
+    return CpuBudget(cores=cores, workers=workers, threads_per_worker=max(1, cores // workers))
+
+
+def limit_native_threads(threads):
+    """Cap OpenCV's thread pool and Tesseract's OpenMP threads for this process.
+
+    Tesseract run through pytesseract reads OMP_THREAD_LIMIT from the
+    environment of every pass. tesserocr reads it once when the library
+    loads, so gunicorn.conf.py sets it before the workers import the app.
+    """
+    threads = max(1, int(threads))
+    os.environ['OMP_THREAD_LIMIT'] = str(threads)
+    import cv2
+    cv2.setNumThreads(threads)
+
+
+class OCRBusy(Exception):
+    """Too many receipts are already waiting for OCR; retry_after is a suggested wait in seconds"""
+
+    def __init__(self, retry_after):
+        super().__init__(f'OCR queue is full; retry in {retry_after}s')
+        self.retry_after = retry_after
+
+
+class OCRLimiter:
+    """Lets at most `slots` receipts through OCR at once, with at most `max_waiting` more queued.
+
+    Callers that can't wait (web requests) get OCRBusy when the queue is
+    full or their wait exceeds `timeout`; background jobs wait as long as it
+    takes but still count towards the queue.
+    """
+
+    def __init__(self, slots, max_waiting, timeout=30.0):
+        self.slots = max(1, slots)
+        self.max_waiting = max(0, max_waiting)
+        self.timeout = timeout
+        self.active = 0
+        self.waiting = 0
+        self._average_seconds = 5.0  # Moving average of the time a slot is held
+        self._condition = threading.Condition()
+
+    def _retry_after(self):
+        # Roughly how long the receipts ahead take to clear
+        return max(1, math.ceil(self._average_seconds * (self.waiting + 1) / self.slots))
+
+    def acquire(self, wait=False):
+        """Take an OCR slot, raising OCRBusy if wait is False and none frees up in time.
+
+        Returns a token to hand back to release().
+        """
+        with self._condition:
+            if not wait and self.active >= self.slots and self.waiting >= self.max_waiting:
+                raise OCRBusy(self._retry_after())
+            self.waiting += 1
+            try:
+                deadline = None if wait else time.monotonic() + self.timeout
+                while self.active >= self.slots:
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        raise OCRBusy(self._retry_after())
+                    self._condition.wait(remaining)
+            finally:
+                self.waiting -= 1
+            self.active += 1
+        return time.monotonic()
+
+    def release(self, token):
+        with self._condition:
+            self.active -= 1
+            self._average_seconds += 0.2 * (time.monotonic() - token - self._average_seconds)
+            self._condition.notify()
+
+    @contextmanager
+    def slot(self, wait=False):
+        """Hold one OCR slot for the duration of the block"""
+        token = self.acquire(wait)
+        try:
+            yield
+        finally:
+            self.release(token)
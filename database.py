@@ -0,0 +1,131 @@
+"""
+Database connection setup shared by the app and the standalone scripts
+
+SQLite gets WAL journaling (readers and the writer stop blocking each
+other), NORMAL fsync, a larger page cache, memory-mapped reads and a busy
+timeout, so several gunicorn workers can share one database file. Server
+databases given via DATABASE_URL get a connection pool that checks
+connections before use and recycles them before the server drops them.
+Writes that still lose the race for SQLite's single write lock are retried
+with exponential backoff, and schema changes made at startup take turns
+under a file lock.
+"""
+
+import logging
+import random
+import sqlite3
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Not available on Windows
+    fcntl = None
+
+from sqlalchemy import event
+from sqlalchemy.exc import OperationalError
+
+logger = logging.getLogger(__name__)
+
+LOCK_ERRORS = ('database is locked', 'database table is locked', 'database is busy')
+
+
+def is_sqlite(uri):
+    return uri.startswith('sqlite')
+
+
+def engine_options(uri, busy_timeout=30.0, pool_size=5, max_overflow=10, pool_recycle=1800):
+    """SQLALCHEMY_ENGINE_OPTIONS for a database URI"""
+    if is_sqlite(uri):
+        # sqlite3's timeout is the busy handler: wait this long for a lock before failing
+        return {'connect_args': {'timeout': busy_timeout}}
+    return {
+        'pool_size': pool_size,
+        'max_overflow': max_overflow,
+        'pool_pre_ping': True,
+        'pool_recycle': pool_recycle,
+    }
+
+
+def sqlite_pragmas(journal_mode='WAL', synchronous='NORMAL', cache_size_kb=32768, mmap_size=256 * 1024 * 1024,
+                   busy_timeout=30.0):
+    """[(pragma, value)] run on every new SQLite connection"""
+    return [
+        ('journal_mode', journal_mode),
+        # Safe with WAL: a power cut can lose the last commits but not corrupt the file
+        ('synchronous', synchronous),
+        ('cache_size', -int(cache_size_kb)),  # Negative means KiB rather than pages
+        ('mmap_size', int(mmap_size)),
+        ('busy_timeout', int(busy_timeout * 1000)),
+    ]
+
+
+def apply_pragmas(connection, pragmas):
+    cursor = connection.cursor()
+    try:
+        for name, value in pragmas:
+            cursor.execute(f'PRAGMA {name}={value}')
+    finally:
+        cursor.close()
+
+
+def configure_engine(engine, pragmas):
+    """Run the pragmas on every connection the engine opens (SQLite only)"""
+    if engine.dialect.name != 'sqlite':
+        return
+
+    @event.listens_for(engine, 'connect')
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        apply_pragmas(dbapi_connection, pragmas)
+
+
+def connect_sqlite(path, busy_timeout=30.0, read_only=False):
+    """A plain sqlite3 connection that waits for locks like the app does"""
+    conn = sqlite3.connect(path, timeout=busy_timeout)
+    if read_only:
+        conn.execute('PRAGMA query_only=1')
+    return conn
+
+
+def is_lock_error(error):
+    """True for SQLite's lock/busy errors, which are worth retrying"""
+    message = str(getattr(error, 'orig', None) or error).lower()
+    return any(text in message for text in LOCK_ERRORS)
+
+
+def retry_write(session, write, attempts=5, base_delay=0.05, max_delay=2.0, on_retry=None):
+    """Call write() (which should commit), rolling back and retrying it when the database is locked.
+
+    write() must redo all of its work, since the rollback discards it.
+    Delays grow exponentially with random jitter so that competing
+    writers don't retry in lockstep.
+    """
+    for attempt in range(1, attempts + 1):
+        try:
+            return write()
+        except (OperationalError, sqlite3.OperationalError) as e:
+            session.rollback()
+            if attempt >= attempts or not is_lock_error(e):
+                raise
+            delay = min(max_delay, base_delay * 2 ** (attempt - 1)) * random.uniform(0.5, 1.0)
+            logger.warning("Database locked (attempt %d/%d); retrying in %.2fs", attempt, attempts, delay)
+            if on_retry:
+                on_retry()
+            time.sleep(delay)
+
+
+@contextmanager
+def exclusive_lock(path):
+    """Hold an exclusive lock on the file at path for the block, waiting for other processes holding it.
+
+    A no-op where fcntl isn't available.
+    """
+    if fcntl is None:
+        yield
+        return
+    with open(path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
@@ -0,0 +1,33 @@
+"""
+Gunicorn settings sized from the CPU budget (see cpu_budget.py)
+
+Gunicorn reads this file from the working directory on its own, so the
+Procfile and Dockerfile commands pick it up unchanged. Workers default to
+one per core the container may use. The worker count is exported as
+WEB_CONCURRENCY so every worker (app.py) can take its share of the
+OpenCV/Tesseract threads, and OMP_THREAD_LIMIT is set before any worker
+loads Tesseract. Workers start their background job threads as soon as they
+boot, so jobs queued by a worker that has since exited don't wait for the
+next upload.
+"""
+
+import os
+
+from cpu_budget import available_cpus, plan_budget
+
+budget = plan_budget(int(os.environ.get('CPU_BUDGET', 0)) or available_cpus(),
+                     int(os.environ.get('WEB_CONCURRENCY', 0)) or None)
+os.environ['WEB_CONCURRENCY'] = str(budget.workers)
+os.environ['OMP_THREAD_LIMIT'] = os.environ.get('CPU_THREADS_PER_WORKER', str(budget.threads_per_worker))
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8000')}"
+workers = budget.workers
+# Request threads only wait on OCR slots and the database; the OCR limiter bounds the CPU work
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 120))
+
+
+def post_worker_init(worker):
+    from app import resume_jobs
+    resume_jobs()
@@ -0,0 +1,178 @@
+"""
+Catalog of known Costco item numbers for correcting OCR misreads
+
+Built from the item numbers and descriptions already stored in receipt_item.
+Lookups use a deletion-neighbourhood index (as in SymSpell): every key is
+filed under each string it turns into after deleting up to max_distance
+characters. Two strings within edit distance k always share such a
+variant, so a lookup only checks the keys filed under the query's own
+variants instead of scanning the whole catalog.
+"""
+
+import threading
+import time
+from collections import Counter
+from difflib import SequenceMatcher
+
+
+def edit_distance(a, b, max_distance=None):
+    """Levenshtein distance; stops early once every path exceeds max_distance"""
+    if a == b:
+        return 0
+    if len(a) < len(b):
+        a, b = b, a
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != char_b)))
+        if max_distance is not None and min(current) > max_distance:
+            return max_distance + 1
+        previous = current
+    return previous[-1]
+
+
+def hamming_distance(a, b):
+    """Differing positions between two equal-length strings"""
+    return sum(1 for char_a, char_b in zip(a, b) if char_a != char_b)
+
+
+def deletion_variants(key, max_deletions):
+    """key with every combination of up to max_deletions characters removed"""
+    variants = {key}
+    frontier = {key}
+    for _ in range(max_deletions):
+        frontier = {word[:i] + word[i + 1:] for word in frontier for i in range(len(word))}
+        variants |= frontier
+    return variants
+
+
+class FuzzyIndex:
+    """Set of strings with sub-linear lookup of the keys within a small edit distance"""
+
+    def __init__(self, max_distance=2):
+        self.max_distance = max_distance
+        self._variants = {}
+        self._keys = {}  # key -> insertion order
+
+    def __contains__(self, key):
+        return key in self._keys
+
+    def __len__(self):
+        return len(self._keys)
+
+    def add(self, key):
+        if key in self._keys:
+            return
+        self._keys[key] = len(self._keys)
+        for variant in deletion_variants(key, self.max_distance):
+            self._variants.setdefault(variant, []).append(key)
+
+    def lookup(self, query, max_distance=None, same_length=False):
+        """[(distance, key)] within max_distance, nearest first, then in insertion order.
+
+        same_length compares by Hamming distance (substitutions only), which is
+        how OCR usually garbles a fixed-width item number.
+        """
+        max_distance = self.max_distance if max_distance is None else min(max_distance, self.max_distance)
+        candidates = set()
+        for variant in deletion_variants(query, max_distance):
+            candidates.update(self._variants.get(variant, ()))
+
+        matches = []
+        for key in candidates:
+            if same_length:
+                if len(key) != len(query):
+                    continue
+                distance = hamming_distance(key, query)
+            else:
+                distance = edit_distance(key, query, max_distance)
+            if distance <= max_distance:
+                matches.append((distance, key))
+        matches.sort(key=lambda match: (match[0], self._keys[match[1]]))
+        return matches
+
+
+class ItemCatalog:
+    """Known item numbers with their most common description.
+
+    Updated incrementally: load() takes (id, item_number, description) rows
+    and remembers the highest id seen, so callers only fetch newer rows.
+    """
+
+    def __init__(self, max_distance=2, min_description_similarity=0.6):
+        self.max_distance = max_distance
+        self.min_description_similarity = min_description_similarity
+        self.last_id = 0
+        self.refreshed_at = 0.0  # time.monotonic() of the last load()
+        self._index = FuzzyIndex(max_distance)
+        self._descriptions = {}  # item_number -> Counter of descriptions
+        self._canonical = {}  # item_number -> most common description
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, item_number):
+        return item_number in self._index
+
+    def add(self, item_number, description=None, count=1):
+        with self._lock:
+            self._index.add(item_number)
+            descriptions = self._descriptions.setdefault(item_number, Counter())
+            if description:
+                descriptions[description] += count
+                canonical = self._canonical.get(item_number)
+                if canonical is None or descriptions[description] > descriptions[canonical]:
+                    self._canonical[item_number] = description
+
+    def load(self, rows):
+        """Add (id, item_number, description) rows; returns how many were added"""
+        added = 0
+        for row_id, item_number, description in rows:
+            self.add(item_number, description)
+            self.last_id = max(self.last_id, row_id)
+            added += 1
+        self.refreshed_at = time.monotonic()
+        return added
+
+    def description(self, item_number):
+        return self._canonical.get(item_number)
+
+    def description_similarity(self, item_number, description):
+        canonical = self._canonical.get(item_number)
+        if not canonical or not description:
+            return 0.0
+        return SequenceMatcher(None, canonical.upper(), description.upper()).ratio()
+
+    def correct_item_number(self, item_number, description=None):
+        """The catalog item an unknown item number was most likely misread from, or None.
+
+        Only an unambiguous nearest match counts. Given a description, the
+        catalog's description for that item must agree with it too, so a new
+        item that happens to be a digit away from a known one is left alone.
+        Without one, the caller has to confirm the match some other way.
+        """
+        if item_number in self._index:
+            return item_number
+        with self._lock:
+            matches = self._index.lookup(item_number)
+        if not matches:
+            return None
+        distance, best = matches[0]
+        if len(matches) > 1 and matches[1][0] == distance:
+            return None
+        if description is not None and \
+                self.description_similarity(best, description) < self.min_description_similarity:
+            return None
+        return best
+
+    def correct_description(self, item_number, description):
+        """The catalog's description when the OCR'd one is a garbled copy of it"""
+        canonical = self._canonical.get(item_number)
+        if not canonical or canonical == description:
+            return description
+        if not description or self.description_similarity(item_number, description) >= self.min_description_similarity:
+            return canonical
+        # Too different to be a misread; keep what the receipt says
+        return description
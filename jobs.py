@@ -0,0 +1,66 @@
+"""
+Background worker pool for asynchronous receipt processing
+
+The queue itself lives in the app database (see ProcessingJob in app.py),
+so there is no outside broker: each worker thread repeatedly asks the app to
+claim and run the next queued job, and sleeps until woken by a new upload or
+until the poll interval passes (which also picks up jobs queued by other
+processes).
+"""
+
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class JobWorkerPool:
+    def __init__(self, app, run_next_job, num_workers=2, poll_interval=2.0):
+        self.app = app
+        self.run_next_job = run_next_job
+        self.num_workers = max(1, num_workers)
+        self.poll_interval = poll_interval
+        self._wakeup = threading.Condition()
+        self._threads = []
+        self._stopping = False
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Start the worker threads (no-op if already running)"""
+        with self._lock:
+            if self._threads:
+                return
+            self._stopping = False
+            for i in range(self.num_workers):
+                thread = threading.Thread(target=self._work, name=f'receipt-job-{i}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def notify(self):
+        """Wake one idle worker after a job has been queued"""
+        self.start()
+        with self._wakeup:
+            self._wakeup.notify()
+
+    def stop(self, timeout=None):
+        with self._lock:
+            self._stopping = True
+            threads, self._threads = self._threads, []
+        with self._wakeup:
+            self._wakeup.notify_all()
+        for thread in threads:
+            thread.join(timeout)
+
+    def _work(self):
+        while not self._stopping:
+            try:
+                with self.app.app_context():
+                    ran = self.run_next_job()
+            except Exception as e:
+                logger.exception("Job worker error: %s", e)
+                ran = False
+
+            if not ran:
+                with self._wakeup:
+                    if not self._stopping:
+                        self._wakeup.wait(self.poll_interval)
@@ -0,0 +1,218 @@
+"""
+OCR backends for the Costco receipt processor
+
+ReceiptProcessor talks to one of these instead of calling pytesseract
+directly. The tesserocr backend keeps a pool of warm Tesseract engines in
+process, so an OCR pass is a C API call on an in-memory image instead of a
+temp file plus a fresh `tesseract` process that reloads the traineddata.
+Both can also report Tesseract's word confidences alongside the text.
+"""
+
+import logging
+import queue
+import shlex
+import threading
+
+import pytesseract
+
+try:
+    import tesserocr
+except ImportError:  # optional dependency
+    tesserocr = None
+
+logger = logging.getLogger(__name__)
+
+
+def parse_tesseract_config(config):
+    """Split a pytesseract-style config string into (psm, variables)"""
+    psm = None
+    variables = {}
+    args = shlex.split(config or '')
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        if arg == '--psm' and i + 1 < len(args):
+            psm = int(args[i + 1])
+            i += 2
+        elif arg == '-c' and i + 1 < len(args):
+            name, _, value = args[i + 1].partition('=')
+            variables[name] = value
+            i += 2
+        elif arg == '--oem' and i + 1 < len(args):
+            # The engine mode is fixed when an engine is initialised
+            i += 2
+        else:
+            i += 1
+    return psm, variables
+
+
+def mean_confidence(confidences):
+    """Average word confidence (0-100), ignoring Tesseract's -1 for non-word boxes"""
+    confidences = [float(conf) for conf in confidences if float(conf) >= 0]
+    return sum(confidences) / len(confidences) if confidences else 0.0
+
+
+def text_from_data(data):
+    """Rebuild image_to_string-style text and word confidences from image_to_data's rows.
+
+    Words on the same line are joined with spaces and paragraphs are
+    separated by a blank line, as in Tesseract's plain text output.
+    """
+    lines = {}
+    confidences = []
+    for level, block, paragraph, line, word, conf in zip(data['level'], data['block_num'], data['par_num'],
+                                                         data['line_num'], data['text'], data['conf']):
+        if int(level) != 5 or not str(word).strip():  # Level 5 rows are words
+            continue
+        lines.setdefault((int(block), int(paragraph), int(line)), []).append(str(word).strip())
+        confidences.append(conf)
+
+    text_lines = []
+    previous = None
+    for (block, paragraph, _), words in lines.items():
+        if previous is not None and (block, paragraph) != previous:
+            text_lines.append('')
+        text_lines.append(' '.join(words))
+        previous = (block, paragraph)
+    return '\n'.join(text_lines) + '\n' if text_lines else '', confidences
+
+
+class PytesseractBackend:
+    """Runs each OCR pass through the `tesseract` command line tool"""
+    name = 'pytesseract'
+
+    def image_to_string(self, image, config=''):
+        return pytesseract.image_to_string(image, config=config)
+
+    def image_to_text_with_confidence(self, image, config=''):
+        """(text, mean word confidence) from a single TSV run of `tesseract`"""
+        data = pytesseract.image_to_data(image, config=config, output_type=pytesseract.Output.DICT)
+        text, confidences = text_from_data(data)
+        return text, mean_confidence(confidences)
+
+
+class TesserocrBackend:
+    """Thread-safe pool of persistent in-process Tesseract engines.
+
+    Engines are created lazily, up to pool_size, and handed out one per
+    caller, so concurrent OCR passes never share an engine. Variables set
+    from a config string are restored before the engine goes back to the pool.
+    """
+    name = 'tesserocr'
+
+    def __init__(self, pool_size=1, lang='eng', tessdata_path=None):
+        if tesserocr is None:
+            raise RuntimeError("tesserocr is not installed")
+        self.pool_size = max(1, pool_size)
+        self.lang = lang
+        self.tessdata_path = tessdata_path
+        self._engines = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def _create_engine(self):
+        kwargs = {'lang': self.lang}
+        if self.tessdata_path:
+            kwargs['path'] = self.tessdata_path
+        return tesserocr.PyTessBaseAPI(**kwargs)
+
+    def _acquire(self):
+        try:
+            return self._engines.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            if self._created < self.pool_size:
+                self._created += 1
+                create = True
+            else:
+                create = False
+
+        if create:
+            try:
+                return self._create_engine()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+        return self._engines.get()
+
+    def _release(self, engine):
+        self._engines.put(engine)
+
+    def image_to_string(self, image, config=''):
+        text, _ = self._recognize(image, config, with_confidence=False)
+        return text
+
+    def image_to_text_with_confidence(self, image, config=''):
+        """(text, mean word confidence); the confidences come from the same recognition"""
+        text, confidences = self._recognize(image, config, with_confidence=True)
+        return text, mean_confidence(confidences)
+
+    def _recognize(self, image, config, with_confidence):
+        psm, variables = parse_tesseract_config(config)
+        engine = self._acquire()
+        try:
+            default_psm = engine.GetPageSegMode()  # Restored below, so read it before changing anything
+        except Exception:
+            self._release(engine)
+            raise
+        previous = {}
+        try:
+            if psm is not None:
+                engine.SetPageSegMode(psm)
+            for name, value in variables.items():
+                previous[name] = engine.GetVariableAsString(name)
+                engine.SetVariable(name, value)
+
+            self._set_image(engine, image)
+            text = engine.GetUTF8Text()
+            return text, engine.AllWordConfidences() if with_confidence else None
+        finally:
+            engine.Clear()
+            for name, value in previous.items():
+                engine.SetVariable(name, value if value is not None else '')
+            engine.SetPageSegMode(default_psm)
+            self._release(engine)
+
+    def _set_image(self, engine, image):
+        # numpy arrays are handed over as raw pixel buffers; anything else
+        # (e.g. a PIL image) goes through SetImage
+        if hasattr(image, 'shape') and hasattr(image, 'tobytes'):
+            height, width = image.shape[:2]
+            channels = image.shape[2] if image.ndim == 3 else 1
+            engine.SetImageBytes(image.tobytes(), width, height, channels, width * channels)
+        else:
+            engine.SetImage(image)
+
+    def close(self):
+        while True:
+            try:
+                engine = self._engines.get_nowait()
+            except queue.Empty:
+                break
+            engine.End()
+        with self._lock:
+            self._created = 0
+
+
+def create_ocr_backend(name='auto', pool_size=1, lang='eng', tessdata_path=None):
+    """Build the configured OCR backend.
+
+    'auto' prefers tesserocr and falls back to pytesseract, with a warning,
+    when it is not installed; asking for 'tesserocr' without it installed
+    is an error.
+    """
+    name = (name or 'auto').lower()
+    if name in ('auto', 'tesserocr'):
+        if tesserocr is not None:
+            return TesserocrBackend(pool_size=pool_size, lang=lang, tessdata_path=tessdata_path)
+        if name == 'tesserocr':
+            raise RuntimeError("OCR backend 'tesserocr' is not installed (pip install tesserocr)")
+        logger.warning("tesserocr is not installed; OCR runs through pytesseract, "
+                       "which starts a Tesseract process for every pass")
+        return PytesseractBackend()
+    if name == 'pytesseract':
+        return PytesseractBackend()
+    raise ValueError(f"Unknown OCR backend: {name}")
@@ -0,0 +1,132 @@
+"""
+Content-addressed OCR result cache
+
+Maps a hash of the uploaded image bytes plus the preprocessing/OCR settings
+to the extracted text. Entries live in a small SQLite file so they survive
+restarts and are shared by every worker process; the total size of the
+stored text is bounded and the least recently used entries are evicted first.
+"""
+
+import logging
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+
+class OCRCache:
+    def __init__(self, path='ocr_cache.db', max_bytes=64 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._init_db()
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=10)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _init_db(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS ocr_cache (
+                    key TEXT PRIMARY KEY,
+                    text TEXT NOT NULL,
+                    config TEXT,
+                    size INTEGER NOT NULL,
+                    last_access REAL NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS ix_ocr_cache_last_access ON ocr_cache (last_access)")
+
+    @staticmethod
+    def make_key(image_bytes, settings):
+        """Hash of the image bytes plus everything that affects the OCR output"""
+        digest = hashlib.sha256(image_bytes)
+        digest.update(b'\0')
+        digest.update(settings.encode('utf-8'))
+        return digest.hexdigest()
+
+    def get(self, key):
+        """Return (text, config) for a cached entry, or None"""
+        try:
+            with self._connect() as conn:
+                row = conn.execute("SELECT text, config FROM ocr_cache WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    conn.execute("UPDATE ocr_cache SET last_access = ? WHERE key = ?", (time.time(), key))
+        except sqlite3.Error as e:
+            logger.warning("OCR cache error: %s", e)
+            row = None
+
+        with self._lock:
+            if row is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return row
+
+    def put(self, key, text, config=None):
+        size = len(text.encode('utf-8'))
+        if size > self.max_bytes:
+            return
+        try:
+            with self._connect() as conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO ocr_cache (key, text, config, size, last_access) VALUES (?, ?, ?, ?, ?)",
+                    (key, text, config, size, time.time())
+                )
+                self._evict(conn)
+        except sqlite3.Error as e:
+            logger.warning("OCR cache error: %s", e)
+
+    def _evict(self, conn):
+        """Drop least recently used entries until the cache fits in max_bytes"""
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM ocr_cache").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        rows = conn.execute("SELECT key, size FROM ocr_cache ORDER BY last_access ASC")
+        stale = []
+        for key, size in rows:
+            if total <= self.max_bytes:
+                break
+            stale.append((key,))
+            total -= size
+        conn.executemany("DELETE FROM ocr_cache WHERE key = ?", stale)
+
+    def clear(self):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM ocr_cache")
+
+    def stats(self):
+        try:
+            with self._connect() as conn:
+                entries, size = conn.execute(
+                    "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM ocr_cache"
+                ).fetchone()
+        except sqlite3.Error:
+            entries, size = None, None
+
+        with self._lock:
+            hits, misses = self.hits, self.misses
+        lookups = hits + misses
+        return {
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': hits / lookups if lookups else 0.0,
+            'entries': entries,
+            'size_bytes': size,
+            'max_bytes': self.max_bytes,
+        }
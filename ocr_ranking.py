@@ -0,0 +1,98 @@
+"""
+Adaptive ordering of the OCR configs
+
+A receipt's OCR sweep tries the Tesseract configs one after another until
+an output reads well enough. ConfigRanking counts how often each config
+was tried and how often its output was the one kept, so the sweep starts
+with the configs that usually win and most receipts need a single pass.
+The app saves the counts to the database, so every process learns from
+every receipt and the ordering survives restarts.
+"""
+
+import threading
+
+
+class ConfigRanking:
+    """Per-config attempt and win counts, saved ones plus those not saved yet.
+
+    Win rates are smoothed towards prior_wins / prior_attempts, so a config
+    that has hardly been tried is neither written off after one loss nor
+    trusted after one win.
+    """
+
+    def __init__(self, prior_wins=1, prior_attempts=2):
+        self.prior_wins = prior_wins
+        self.prior_attempts = prior_attempts
+        self.refreshed_at = None  # monotonic time of the last load()
+        self._saved = {}    # config -> [attempts, wins] as last loaded from the database
+        self._pending = {}  # config -> [attempts, wins] recorded here and not saved yet
+        self._lock = threading.Lock()
+
+    def _counts(self, config):
+        saved = self._saved.get(config, (0, 0))
+        pending = self._pending.get(config, (0, 0))
+        return saved[0] + pending[0], saved[1] + pending[1]
+
+    def win_rate(self, config):
+        with self._lock:
+            attempts, wins = self._counts(config)
+        return (wins + self.prior_wins) / (attempts + self.prior_attempts)
+
+    def order(self, configs):
+        """configs by win rate, highest first; ties keep the given order"""
+        rates = {config: self.win_rate(config) for config in configs}
+        return sorted(configs, key=lambda config: -rates[config])
+
+    def record(self, tried, winner):
+        """Count one receipt: every config in tried was attempted (a config can repeat
+        across escalation tiers), and winner's output was kept
+        """
+        with self._lock:
+            for config in tried:
+                self._pending.setdefault(config, [0, 0])[0] += 1
+            if winner in tried:
+                self._pending[winner][1] += 1
+
+    def take_pending(self):
+        """Remove and return the {config: (attempts, wins)} recorded since the last take.
+
+        They count as saved from here on, so concurrent callers never save the
+        same counts twice. Hand them to put_back() if the database write fails.
+        """
+        with self._lock:
+            deltas = {config: tuple(counts) for config, counts in self._pending.items() if counts[0]}
+            self._pending = {}
+            for config, (attempts, wins) in deltas.items():
+                saved = self._saved.setdefault(config, [0, 0])
+                saved[0] += attempts
+                saved[1] += wins
+            return deltas
+
+    def put_back(self, deltas):
+        """Return counts from take_pending() that didn't make it to the database"""
+        with self._lock:
+            for config, (attempts, wins) in deltas.items():
+                saved = self._saved.get(config)
+                if saved is not None:
+                    saved[0] = max(0, saved[0] - attempts)
+                    saved[1] = max(0, saved[1] - wins)
+                pending = self._pending.setdefault(config, [0, 0])
+                pending[0] += attempts
+                pending[1] += wins
+
+    def load(self, rows, refreshed_at=None):
+        """Replace the saved counts with (config, attempts, wins) rows from the database"""
+        saved = {config: [attempts, wins] for config, attempts, wins in rows}
+        with self._lock:
+            self._saved = saved
+            self.refreshed_at = refreshed_at
+
+    def stats(self, configs):
+        """Attempts, wins and win rate for each config, in the order a sweep tries them"""
+        stats = []
+        for config in self.order(configs):
+            with self._lock:
+                attempts, wins = self._counts(config)
+            stats.append({'config': config, 'attempts': attempts, 'wins': wins,
+                          'win_rate': round(self.win_rate(config), 4)})
+        return stats
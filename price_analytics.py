@@ -0,0 +1,321 @@
+"""
+Vectorized price analytics over the whole purchase history
+
+PriceHistory holds every stored purchase as columnar NumPy arrays (item
+index, store index, timestamp, price, discount) sorted by item and time.
+Per-item figures (trailing-window minimums, price change events, discount
+depth, cross-store spreads) are computed for all items at once with array
+operations rather than by looping over rows. PriceAnalytics caches the
+arrays between calls and reloads them when the stored items change.
+"""
+
+import threading
+from datetime import datetime, timedelta
+from itertools import islice
+
+import numpy as np
+
+SECONDS_PER_DAY = 86400
+EPOCH = datetime(1970, 1, 1)
+
+# Per-item summary columns that items can be ranked by, highest first
+SORT_KEYS = {
+    'spread': 'spread',
+    'changes': 'change_count',
+    'discount': 'avg_discount_depth',
+    'observations': 'observations',
+}
+
+
+def to_epoch(moment):
+    """Seconds since the epoch for a naive UTC datetime"""
+    return int((moment - EPOCH).total_seconds())
+
+
+def from_epoch(seconds):
+    return (EPOCH + timedelta(seconds=int(seconds))).isoformat()
+
+
+def optional(value, digits=2):
+    """A float rounded for JSON, or None for NaN"""
+    return None if np.isnan(value) else round(float(value), digits)
+
+
+def range_minimum(values, starts, ends):
+    """min(values[start:end + 1]) for every (start, end) pair at once, via a sparse table"""
+    result = np.empty(len(starts), dtype=values.dtype)
+    if not len(starts):
+        return result
+    lengths = ends - starts + 1
+    levels = np.floor(np.log2(lengths)).astype(np.int64)
+
+    # table[i] = min(values[i:i + width]), doubling the width every level
+    table, width = values, 1
+    for level in range(int(levels.max()) + 1):
+        if level:
+            table = np.minimum(table[:-width], table[width:])
+            width *= 2
+        selected = levels == level
+        if selected.any():
+            result[selected] = np.minimum(table[starts[selected]], table[ends[selected] - width + 1])
+    return result
+
+
+def group_starts(groups):
+    """Indices where a new group begins in a sorted group-id array"""
+    if not len(groups):
+        return np.empty(0, dtype=np.int64)
+    return np.flatnonzero(np.r_[True, groups[1:] != groups[:-1]])
+
+
+def reduce_by_group(ufunc, groups, values, num_groups, fill=np.nan):
+    """ufunc.reduce of values per group id (groups sorted); fill where a group has no values"""
+    result = np.full(num_groups, fill, dtype=np.float64)
+    starts = group_starts(groups)
+    if len(starts):
+        result[groups[starts]] = ufunc.reduceat(values, starts)
+    return result
+
+
+class PriceHistory:
+    """Columnar purchase history, sorted by item and then time"""
+
+    def __init__(self, item_numbers, store_numbers, timestamps, prices, discounts):
+        self.items, item_index = np.unique(np.asarray(item_numbers, dtype=str), return_inverse=True)
+        self.stores, store_index = np.unique(np.asarray(store_numbers, dtype=str), return_inverse=True)
+        timestamps = np.asarray(timestamps, dtype='datetime64[s]')
+        # Purchases without a date sort first, at the epoch
+        timestamps = np.where(np.isnat(timestamps), np.datetime64(0, 's'), timestamps).astype(np.int64)
+
+        order = np.lexsort((timestamps, item_index))
+        self.item_index = item_index[order].astype(np.int64)
+        self.store_index = store_index[order].astype(np.int64)
+        self.timestamps = timestamps[order]
+        self.prices = np.asarray(prices, dtype=np.float64)[order]
+        self.discounts = np.nan_to_num(np.asarray(discounts, dtype=np.float64)[order])
+        self._summaries = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_rows(cls, rows, chunk_size=50000):
+        """Build from (item_number, store_number, timestamp, price, discount) rows, chunk_size at a time"""
+        rows = iter(rows)
+        columns = [[] for _ in range(5)]
+        while True:
+            chunk = list(islice(rows, chunk_size))
+            if not chunk:
+                break
+            for column, values in zip(columns, zip(*chunk)):
+                column.append(np.array(values, dtype=object))
+        return cls(*(np.concatenate(column) if column else np.empty(0, dtype=object) for column in columns))
+
+    def __len__(self):
+        return len(self.prices)
+
+    def rolling_minimum(self, window_days):
+        """Lowest price of the same item within window_days before (and at) each purchase"""
+        if not len(self):
+            return np.empty(0)
+        window = int(window_days * SECONDS_PER_DAY)
+        # One sorted key across items, with a gap wider than the window between them
+        span = int(self.timestamps.max() - self.timestamps.min()) + window + 1
+        key = self.item_index * span + (self.timestamps - self.timestamps.min())
+        starts = np.searchsorted(key, key - window, side='left')
+        return range_minimum(self.prices, starts, np.arange(len(self)))
+
+    def price_changes(self, min_change=0.005):
+        """Purchases whose price differs from the previous purchase of the item at the same store.
+
+        Returns a dict of arrays: item_index, store_index, timestamp, old_price, new_price.
+        """
+        order = np.lexsort((self.timestamps, self.store_index, self.item_index))
+        items, stores, prices = self.item_index[order], self.store_index[order], self.prices[order]
+        changed = (items[1:] == items[:-1]) & (stores[1:] == stores[:-1]) & \
+            (np.abs(prices[1:] - prices[:-1]) >= min_change)
+        rows = order[1:][changed]
+        return {
+            'item_index': self.item_index[rows],
+            'store_index': self.store_index[rows],
+            'timestamp': self.timestamps[rows],
+            'old_price': prices[:-1][changed],
+            'new_price': prices[1:][changed],
+        }
+
+    def store_spreads(self, since):
+        """Per item: lowest and highest latest price across stores seen since `since` (epoch seconds).
+
+        Returns a dict of per-item arrays: store_count, min_price, max_price,
+        cheapest_store and priciest_store (store indices, -1 without data).
+        """
+        num_items = len(self.items)
+        recent = np.flatnonzero(self.timestamps >= since)
+        order = recent[np.lexsort((self.timestamps[recent], self.store_index[recent], self.item_index[recent]))]
+        # Last purchase per (item, store)
+        pair = self.item_index[order] * len(self.stores) + self.store_index[order]
+        latest = order[np.r_[pair[1:] != pair[:-1], True]] if len(order) else order
+
+        # Sort the latest prices within each item: first is cheapest, last is priciest
+        latest = latest[np.lexsort((self.prices[latest], self.item_index[latest]))]
+        items = self.item_index[latest]
+        starts = group_starts(items)
+        ends = np.r_[starts[1:], len(latest)] - 1
+
+        result = {
+            'store_count': np.zeros(num_items, dtype=np.int64),
+            'min_price': np.full(num_items, np.nan),
+            'max_price': np.full(num_items, np.nan),
+            'cheapest_store': np.full(num_items, -1, dtype=np.int64),
+            'priciest_store': np.full(num_items, -1, dtype=np.int64),
+        }
+        if len(starts):
+            group = items[starts]
+            result['store_count'][group] = ends - starts + 1
+            result['min_price'][group] = self.prices[latest[starts]]
+            result['max_price'][group] = self.prices[latest[ends]]
+            result['cheapest_store'][group] = self.store_index[latest[starts]]
+            result['priciest_store'][group] = self.store_index[latest[ends]]
+        return result
+
+    def summary(self, since, window_days):
+        """Per-item figures as a dict of arrays aligned with self.items; memoized per (since, window_days).
+
+        since is epoch seconds: the window minimum and store spreads only
+        look at purchases from then on.
+        """
+        key = (since, window_days)
+        with self._lock:
+            if key in self._summaries:
+                return self._summaries[key]
+
+        num_items = len(self.items)
+        items = self.item_index
+        counts = np.bincount(items, minlength=num_items)
+        last = np.r_[group_starts(items)[1:], len(self)] - 1 if len(self) else np.empty(0, dtype=np.int64)
+
+        recent = self.timestamps >= since
+        original = self.prices + self.discounts
+        discounted = (self.discounts > 0) & (original > 0)
+        depth = np.divide(self.discounts, original, out=np.zeros(len(self)), where=discounted)
+        discount_counts = np.bincount(items[discounted], minlength=num_items)
+
+        changes = self.price_changes()
+        change_counts = np.bincount(changes['item_index'], minlength=num_items)
+        # Changes come out sorted by item, store and time; keep each item's latest
+        last_change = np.full(num_items, -1, dtype=np.int64)
+        if len(changes['timestamp']):
+            by_time = np.lexsort((changes['timestamp'], changes['item_index']))
+            change_items = changes['item_index'][by_time]
+            ends = np.r_[group_starts(change_items)[1:], len(by_time)] - 1
+            last_change[change_items[ends]] = by_time[ends]
+
+        rolling = self.rolling_minimum(window_days)
+        result = {
+            'observations': counts,
+            'last_price': self.prices[last],
+            'last_seen': self.timestamps[last],
+            'rolling_min': rolling[last],  # Lowest in the window_days up to the last purchase
+            'window_min': reduce_by_group(np.minimum, items[recent], self.prices[recent], num_items),
+            'window_observations': np.bincount(items[recent], minlength=num_items),
+            'change_count': change_counts,
+            'last_change': last_change,  # Index into price_changes() arrays, -1 without a change
+            'discount_rate': np.divide(discount_counts, counts, out=np.zeros(num_items), where=counts > 0),
+            'avg_discount_depth': np.divide(np.bincount(items, weights=depth, minlength=num_items), discount_counts,
+                                            out=np.zeros(num_items), where=discount_counts > 0),
+            'changes': changes,
+        }
+        result.update(self.store_spreads(since))
+        result['spread'] = result['max_price'] - result['min_price']
+
+        with self._lock:
+            # Only a few distinct windows are asked for; drop stale days
+            if len(self._summaries) > 8:
+                self._summaries.clear()
+            self._summaries[key] = result
+        return result
+
+    def item_indices(self, item_numbers):
+        """Positions of the given item numbers in self.items, skipping unknown ones"""
+        positions = np.searchsorted(self.items, item_numbers)
+        found = positions < len(self.items)
+        found[found] = self.items[positions[found]] == np.asarray(item_numbers, dtype=str)[found]
+        return positions[found]
+
+    def top_items(self, summary, sort='spread', limit=20, item_numbers=None):
+        """Item indices ranked by a SORT_KEYS column, highest first, ties by item number"""
+        values = np.nan_to_num(summary[SORT_KEYS[sort]].astype(np.float64), nan=-np.inf)
+        candidates = np.arange(len(self.items)) if item_numbers is None else self.item_indices(item_numbers)
+        ranked = candidates[np.lexsort((candidates, -values[candidates]))]
+        return ranked[:limit]
+
+    def item_report(self, summary, index):
+        """JSON-ready figures for one item index"""
+        def store(position):
+            return str(self.stores[position]) if position >= 0 else None
+
+        report = {
+            'item_number': str(self.items[index]),
+            'observations': int(summary['observations'][index]),
+            'last_price': optional(summary['last_price'][index]),
+            'last_seen': from_epoch(summary['last_seen'][index]),
+            'rolling_min': optional(summary['rolling_min'][index]),
+            'window_min': optional(summary['window_min'][index]),
+            'window_observations': int(summary['window_observations'][index]),
+            'price_changes': int(summary['change_count'][index]),
+            'last_change': None,
+            'discount_rate': round(float(summary['discount_rate'][index]), 3),
+            'avg_discount_depth': round(float(summary['avg_discount_depth'][index]), 3),
+            'stores': {
+                'count': int(summary['store_count'][index]),
+                'min_price': optional(summary['min_price'][index]),
+                'max_price': optional(summary['max_price'][index]),
+                'spread': optional(summary['spread'][index]),
+                'cheapest': store(summary['cheapest_store'][index]),
+                'priciest': store(summary['priciest_store'][index]),
+            },
+        }
+        change = summary['last_change'][index]
+        if change >= 0:
+            report['last_change'] = self.change_report(summary['changes'], change)
+        return report
+
+    def change_report(self, changes, position):
+        return {
+            'item_number': str(self.items[changes['item_index'][position]]),
+            'store_number': str(self.stores[changes['store_index'][position]]),
+            'date': from_epoch(changes['timestamp'][position]),
+            'old_price': round(float(changes['old_price'][position]), 2),
+            'new_price': round(float(changes['new_price'][position]), 2),
+        }
+
+    def recent_changes(self, summary, since, limit=100, item_numbers=None):
+        """Price change events from `since` (epoch seconds) on, newest first"""
+        changes = summary['changes']
+        selected = changes['timestamp'] >= since
+        if item_numbers is not None:
+            selected &= np.isin(changes['item_index'], self.item_indices(item_numbers))
+        positions = np.flatnonzero(selected)
+        positions = positions[np.argsort(-changes['timestamp'][positions], kind='stable')][:limit]
+        return [self.change_report(changes, position) for position in positions]
+
+
+class PriceAnalytics:
+    """A PriceHistory cached between calls and reloaded when its version changes.
+
+    The version is any value that changes whenever stored purchases do (the
+    app uses the highest receipt_item id and when the spending rollups were
+    last written), so receipts added or re-parsed by another process are
+    picked up as well.
+    """
+
+    def __init__(self):
+        self._history = None
+        self._version = None
+        self._lock = threading.Lock()
+
+    def history(self, version, load_rows):
+        """The cached PriceHistory, rebuilt from load_rows() when version differs"""
+        with self._lock:
+            if self._history is None or version != self._version:
+                self._history = PriceHistory.from_rows(load_rows())
+                self._version = version
+            return self._history
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+"""
+Re-parse stored receipts with the current parser
+
+Every receipt keeps the raw OCR text it was parsed from. When the rules in
+ReceiptProcessor change, this runs parse_receipt_text over all stored texts
+in parallel chunks, rewrites the items (and store, date and totals) of
+every receipt whose result changed, and prints what changed. No OCR is
+involved.
+
+    python reparse_receipts.py --dry-run      # report the differences only
+    python reparse_receipts.py                # apply them
+"""
+
+import argparse
+import sys
+import time
+import zlib
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from app import (app, db, Receipt, ReceiptItem, ReceiptProcessor, rebuild_price_summaries, rebuild_spending_rollups,
+                 receipt_totals_fields, refresh_item_catalog)
+from cpu_budget import available_cpus
+from item_catalog import ItemCatalog
+
+_processor = None
+
+
+def _init_worker():
+    global _processor
+    # Parse with the item catalog the app uses, so catalog corrections made when the
+    # receipts were stored aren't undone
+    _processor = ReceiptProcessor(item_catalog=ItemCatalog() if app.config['ITEM_CATALOG_ENABLED'] else None)
+    if _processor.item_catalog is not None:
+        with app.app_context():
+            db.engine.dispose(close=False)  # Don't share the parent's connections
+            refresh_item_catalog(_processor.item_catalog, max_age=0)
+
+
+def parse_chunk(chunk):
+    """Worker: [(receipt_id, compressed OCR text)] -> [(receipt_id, receipt_data)]"""
+    return [
+        (receipt_id, _processor.parse_receipt_text(zlib.decompress(compressed).decode('utf-8')))
+        for receipt_id, compressed in chunk
+    ]
+
+
+def iter_chunks(chunk_size, receipt_ids=None):
+    """Stored OCR texts in receipt id order, chunk_size receipts at a time"""
+    last_id = 0
+    while True:
+        query = db.session.query(Receipt.id, Receipt.ocr_text_compressed).filter(
+            Receipt.id > last_id,
+            Receipt.ocr_text_compressed.isnot(None)
+        )
+        if receipt_ids:
+            query = query.filter(Receipt.id.in_(receipt_ids))
+        chunk = query.order_by(Receipt.id.asc()).limit(chunk_size).all()
+        if not chunk:
+            return
+        last_id = chunk[-1][0]
+        yield [tuple(row) for row in chunk]
+
+
+def item_key(item_number, description, price, original_price, discount):
+    return (item_number, description or '', round(price, 2),
+            round(original_price if original_price is not None else price, 2), round(discount or 0, 2))
+
+
+def diff_receipt(receipt, items, receipt_data):
+    """What re-parsing would change on one receipt, or None if nothing"""
+    old_items = Counter(item_key(item.item_number, item.description, item.price,
+                                 item.original_price, item.discount) for item in items)
+    new_items = Counter(item_key(item['item_number'], item['description'], item['price'],
+                                 item.get('original_price', item['price']), item.get('discount', 0))
+                        for item in receipt_data['items'])
+
+    changes = {
+        'removed': sorted((old_items - new_items).elements()),
+        'added': sorted((new_items - old_items).elements()),
+        'fields': {},
+    }
+    new_fields = {
+        'store_address': receipt_data['store_info']['address'] or 'Unknown Store',
+        'store_number': receipt_data['store_info']['store_number'] or 'Unknown',
+        'receipt_date': receipt_data['receipt_date'],
+        **receipt_totals_fields(receipt_data),
+    }
+    for name, value in new_fields.items():
+        if getattr(receipt, name) != value:
+            changes['fields'][name] = (getattr(receipt, name), value)
+
+    if not (changes['removed'] or changes['added'] or changes['fields']):
+        return None
+    return changes
+
+
+def apply_changes(receipt, items, receipt_data, changes):
+    """Rewrite a receipt's items and header fields from a new parse"""
+    for name, (_, value) in changes['fields'].items():
+        setattr(receipt, name, value)
+    if not (changes['removed'] or changes['added']):
+        return
+
+    # Re-parsed items keep the date the receipt was first recorded
+    recorded = min((item.date_recorded for item in items if item.date_recorded), default=receipt.upload_date)
+    for item in items:
+        db.session.delete(item)
+    for item_data in receipt_data['items']:
+        db.session.add(ReceiptItem(
+            receipt_id=receipt.id,
+            item_number=item_data['item_number'],
+            description=item_data['description'],
+            price=item_data['price'],
+            original_price=item_data.get('original_price', item_data['price']),
+            discount=item_data.get('discount', 0),
+            date_recorded=recorded
+        ))
+
+
+def print_changes(receipt_id, changes, verbose):
+    parts = []
+    if changes['added'] or changes['removed']:
+        parts.append(f"+{len(changes['added'])}/-{len(changes['removed'])} items")
+    parts.extend(f"{name} {old!r} -> {new!r}" for name, (old, new) in changes['fields'].items())
+    print(f"receipt {receipt_id}: {', '.join(parts)}")
+    if verbose:
+        for sign, key in [('-', 'removed'), ('+', 'added')]:
+            for item_number, description, price, original_price, discount in changes[key]:
+                discount_note = f" (was {original_price:.2f}, -{discount:.2f})" if discount else ''
+                print(f"    {sign} {item_number} {description} {price:.2f}{discount_note}")
+
+
+def reparse(chunk_size, workers, dry_run, verbose=False, receipt_ids=None):
+    """Re-parse every stored receipt; returns a dict of counts"""
+    counts = {'receipts': 0, 'changed': 0, 'items_added': 0, 'items_removed': 0}
+    chunks = iter_chunks(chunk_size, receipt_ids)
+    pending = set()
+    start = time.perf_counter()
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as executor:
+        while True:
+            while len(pending) < workers * 2:
+                chunk = next(chunks, None)
+                if chunk is None:
+                    break
+                pending.add(executor.submit(parse_chunk, chunk))
+            if not pending:
+                break
+
+            finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                parsed = dict(future.result())
+                receipts = Receipt.query.filter(Receipt.id.in_(parsed)).all()
+                items = {receipt_id: [] for receipt_id in parsed}
+                for item in ReceiptItem.query.filter(ReceiptItem.receipt_id.in_(parsed)):
+                    items[item.receipt_id].append(item)
+
+                for receipt in receipts:
+                    counts['receipts'] += 1
+                    changes = diff_receipt(receipt, items[receipt.id], parsed[receipt.id])
+                    if changes is None:
+                        continue
+                    counts['changed'] += 1
+                    counts['items_added'] += len(changes['added'])
+                    counts['items_removed'] += len(changes['removed'])
+                    print_changes(receipt.id, changes, verbose)
+                    if not dry_run:
+                        apply_changes(receipt, items[receipt.id], parsed[receipt.id], changes)
+
+                # One transaction per chunk
+                if dry_run:
+                    db.session.rollback()
+                else:
+                    db.session.commit()
+
+    if counts['changed'] and not dry_run:
+        rebuild_price_summaries()
+        rebuild_spending_rollups()
+    counts['seconds'] = time.perf_counter() - start
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--dry-run', action='store_true', help='report the changes without saving them')
+    parser.add_argument('--verbose', '-v', action='store_true', help='list the individual item changes')
+    parser.add_argument('--chunk-size', type=int, default=200, help='receipts per parse task and transaction')
+    parser.add_argument('--workers', type=int, default=available_cpus(),
+                        help='parser processes (default: one per core this process may use)')
+    parser.add_argument('--receipt', type=int, action='append', dest='receipt_ids',
+                        help='only re-parse this receipt id (repeatable)')
+    args = parser.parse_args()
+
+    with app.app_context():
+        counts = reparse(max(1, args.chunk_size), max(1, args.workers), args.dry_run,
+                         args.verbose, args.receipt_ids)
+
+    rate = counts['receipts'] / counts['seconds'] if counts['seconds'] else 0
+    action = 'would change' if args.dry_run else 'changed'
+    print(f"\nRe-parsed {counts['receipts']} receipt(s) in {counts['seconds']:.1f}s ({rate:,.0f} receipts/s); "
+          f"{action} {counts['changed']}: +{counts['items_added']}/-{counts['items_removed']} items")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,84 @@
+"""
+Line-strip segmentation for receipt images
+
+A Costco receipt is one tall, narrow column of text. These helpers take the
+binarized output of ReceiptProcessor.preprocess_image (dark text on a white
+background), crop it to the receipt body and cut it into horizontal text
+bands using projection profiles, so the bands can be OCR'd independently.
+"""
+
+import numpy as np
+
+
+def ink_mask(binary):
+    """True where a pixel is text (dark)"""
+    return binary < 128
+
+
+def crop_to_content(binary, min_ink_fraction=0.002, margin=10):
+    """Crop to the rows/columns that contain text, plus a small margin"""
+    ink = ink_mask(binary)
+    height, width = ink.shape
+
+    col_ink = ink.sum(axis=0)
+    row_ink = ink.sum(axis=1)
+    cols = np.flatnonzero(col_ink > max(1, height * min_ink_fraction))
+    rows = np.flatnonzero(row_ink > max(1, width * min_ink_fraction))
+    if cols.size == 0 or rows.size == 0:
+        return binary
+
+    top = max(0, rows[0] - margin)
+    bottom = min(height, rows[-1] + margin + 1)
+    left = max(0, cols[0] - margin)
+    right = min(width, cols[-1] + margin + 1)
+    return binary[top:bottom, left:right]
+
+
+def find_text_bands(binary, min_ink_fraction=0.005, min_gap=3, min_height=6, padding=3):
+    """Return (top, bottom) row ranges of the horizontal text lines.
+
+    A row is part of a line when more than min_ink_fraction of its pixels are
+    ink. Lines separated by fewer than min_gap blank rows are merged, bands
+    shorter than min_height are dropped as noise, and each band is padded
+    by a few rows so descenders are not clipped.
+    """
+    ink = ink_mask(binary)
+    height, width = ink.shape
+    is_text = ink.sum(axis=1) > max(1, width * min_ink_fraction)
+
+    # Rising and falling edges of the text-row mask
+    edges = np.diff(np.concatenate(([0], is_text.astype(np.int8), [0])))
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+
+    bands = []
+    for start, end in zip(starts, ends):
+        if bands and start - bands[-1][1] < min_gap:
+            bands[-1] = (bands[-1][0], end)
+        else:
+            bands.append((start, end))
+
+    return [
+        (max(0, top - padding), min(height, bottom + padding))
+        for top, bottom in bands
+        if bottom - top >= min_height
+    ]
+
+
+def group_bands(bands, lines_per_strip):
+    """Group consecutive line bands into strips of at most lines_per_strip lines"""
+    strips = []
+    for i in range(0, len(bands), max(1, lines_per_strip)):
+        chunk = bands[i:i + lines_per_strip]
+        strips.append((chunk[0][0], chunk[-1][1], len(chunk)))
+    return strips
+
+
+def split_into_strips(binary, lines_per_strip=1):
+    """Crop the receipt body and cut it into (image, line_count) strips, top to bottom"""
+    body = crop_to_content(binary)
+    bands = find_text_bands(body)
+    return [
+        (body[top:bottom], line_count)
+        for top, bottom, line_count in group_bands(bands, lines_per_strip)
+    ]
@@ -1,18 +1,43 @@
 #!/usr/bin/env python3
 """
 Database Viewer for Costco Receipt App
-Run this script to view all data in the database
+Run this script to view all data in the database, or export it
 """
 
+import argparse
+import csv
+import json
+import os
 import sqlite3
+import sys
 from datetime import datetime
 
-def view_all_data():
+from database import connect_sqlite
+
+DEFAULT_DB = 'costco_receipts.db'
+
+def default_db_path():
+    """Database file from DATABASE_URL when it is SQLite, else costco_receipts.db"""
+    url = os.environ.get('DATABASE_URL', '')
+    path = url[len('sqlite:///'):] if url.startswith('sqlite:///') else DEFAULT_DB
+    # Flask-SQLAlchemy keeps relative SQLite paths in the app's instance folder
+    instance_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'instance', path)
+    if not os.path.isabs(path) and not os.path.exists(path) and os.path.exists(instance_path):
+        return instance_path
+    return path
+
+def connect(db_path):
+    """Read-only connection that waits for the app's writes instead of failing with 'database is locked'"""
+    if not os.path.exists(db_path):
+        raise FileNotFoundError(f"Database not found: {db_path}")
+    return connect_sqlite(db_path, busy_timeout=float(os.environ.get('DB_BUSY_TIMEOUT', 30)), read_only=True)
+
+def view_all_data(db_path=DEFAULT_DB):
     """Display all data from the database in a readable format"""
     
     try:
         # Connect to database
-        conn = sqlite3.connect('costco_receipts.db')
+        conn = connect(db_path)
         cursor = conn.cursor()
         
         print("=" * 80)
@@ -92,38 +117,55 @@ def view_all_data():
         print("📊 SUMMARY STATISTICS:")
         print("-" * 60)
         
-        # Total receipts
-        cursor.execute("SELECT COUNT(*) FROM receipt")
-        total_receipts = cursor.fetchone()[0]
-        
-        # Total items
-        cursor.execute("SELECT COUNT(*) FROM receipt_item")
-        total_items = cursor.fetchone()[0]
-        
-        # Total spent
-        cursor.execute("SELECT SUM(price) FROM receipt_item")
-        total_spent = cursor.fetchone()[0] or 0
-        
-        # Total discounts
-        cursor.execute("SELECT SUM(discount) FROM receipt_item")
-        total_discounts = cursor.fetchone()[0] or 0
-        
-        # Most expensive item
-        cursor.execute("""
-            SELECT item_number, description, price 
-            FROM receipt_item 
-            ORDER BY price DESC LIMIT 1
-        """)
-        most_expensive = cursor.fetchone()
-        
-        # Most discounted item
-        cursor.execute("""
-            SELECT item_number, description, discount 
-            FROM receipt_item 
-            WHERE discount > 0
-            ORDER BY discount DESC LIMIT 1
-        """)
-        most_discounted = cursor.fetchone()
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'spending_rollup'")
+        if cursor.fetchone():
+            # Kept up to date by the app as receipts are stored
+            cursor.execute("""
+                SELECT t.receipt_count, t.item_count, t.spend, t.discount,
+                       t.top_price_item, p.label, t.top_price,
+                       t.top_discount_item, d.label, t.top_discount
+                FROM spending_rollup t
+                LEFT JOIN spending_rollup p ON p.dimension = 'item' AND p.key = t.top_price_item
+                LEFT JOIN spending_rollup d ON d.dimension = 'item' AND d.key = t.top_discount_item
+                WHERE t.dimension = 'total'
+            """)
+            row = cursor.fetchone() or (0, 0, 0, 0, None, None, None, None, None, None)
+            total_receipts, total_items, total_spent, total_discounts = row[:4]
+            most_expensive = (row[4], row[5], row[6]) if row[4] else None
+            most_discounted = (row[7], row[8], row[9]) if row[7] else None
+        else:
+            # Total receipts
+            cursor.execute("SELECT COUNT(*) FROM receipt")
+            total_receipts = cursor.fetchone()[0]
+            
+            # Total items
+            cursor.execute("SELECT COUNT(*) FROM receipt_item")
+            total_items = cursor.fetchone()[0]
+            
+            # Total spent
+            cursor.execute("SELECT SUM(price) FROM receipt_item")
+            total_spent = cursor.fetchone()[0] or 0
+            
+            # Total discounts
+            cursor.execute("SELECT SUM(discount) FROM receipt_item")
+            total_discounts = cursor.fetchone()[0] or 0
+            
+            # Most expensive item
+            cursor.execute("""
+                SELECT item_number, description, price 
+                FROM receipt_item 
+                ORDER BY price DESC LIMIT 1
+            """)
+            most_expensive = cursor.fetchone()
+            
+            # Most discounted item
+            cursor.execute("""
+                SELECT item_number, description, discount 
+                FROM receipt_item 
+                WHERE discount > 0
+                ORDER BY discount DESC LIMIT 1
+            """)
+            most_discounted = cursor.fetchone()
         
         print(f"   📄 Total Receipts: {total_receipts}")
         print(f"   🛒 Total Items: {total_items}")
@@ -143,10 +185,10 @@ def view_all_data():
     except Exception as e:
         print(f"❌ Error: {e}")
 
-def view_item_history(item_number):
+def view_item_history(item_number, db_path=DEFAULT_DB):
     """View price history for a specific item"""
     try:
-        conn = sqlite3.connect('costco_receipts.db')
+        conn = connect(db_path)
         cursor = conn.cursor()
         
         cursor.execute("""
@@ -182,19 +224,191 @@ def view_item_history(item_number):
     except Exception as e:
         print(f"❌ Error: {e}")
 
+# Export columns per table, with the SQL that produces them
+EXPORTS = {
+    'items': {
+        'columns': [
+            ('item_id', 'ri.id', 'int64'),
+            ('receipt_id', 'ri.receipt_id', 'int64'),
+            ('item_number', 'ri.item_number', 'string'),
+            ('description', 'ri.description', 'string'),
+            ('price', 'ri.price', 'float64'),
+            ('original_price', 'ri.original_price', 'float64'),
+            ('discount', 'ri.discount', 'float64'),
+            ('date_recorded', 'ri.date_recorded', 'string'),
+            ('store_number', 'r.store_number', 'string'),
+            ('store_address', 'r.store_address', 'string'),
+            ('receipt_date', 'r.receipt_date', 'string'),
+        ],
+        'from': 'receipt_item ri JOIN receipt r ON ri.receipt_id = r.id',
+        'date_column': 'ri.date_recorded',
+        'order_by': 'ri.id',
+    },
+    'receipts': {
+        'columns': [
+            ('receipt_id', 'r.id', 'int64'),
+            ('store_number', 'r.store_number', 'string'),
+            ('store_address', 'r.store_address', 'string'),
+            ('upload_date', 'r.upload_date', 'string'),
+            ('receipt_date', 'r.receipt_date', 'string'),
+        ],
+        'from': 'receipt r',
+        'date_column': 'r.upload_date',
+        'order_by': 'r.id',
+    },
+}
+
+# The app stores the store line of the receipt header, e.g. "COSTCO WHOLESALE\nSAN JOSE #0423";
+# --store matches the number after the '#', with or without leading zeros
+STORE_NUMBER_SQL = "ltrim(substr(r.store_number, instr(r.store_number, '#') + 1), '0')"
+
+def store_number_key(store):
+    """'0423', '#423' or 'SAN JOSE #0423' -> '423', as STORE_NUMBER_SQL reduces the stored value"""
+    return store.split('#', 1)[-1].strip().lstrip('0')
+
+def export_query(table, since=None, until=None, stores=None, items=None):
+    """SQL and parameters for an export, with the filters applied"""
+    spec = EXPORTS[table]
+    where, params = [], []
+    if since:
+        where.append(f"{spec['date_column']} >= ?")
+        params.append(since)
+    if until:
+        where.append(f"{spec['date_column']} < ?")
+        params.append(until)
+    if stores:
+        where.append(f"{STORE_NUMBER_SQL} IN ({', '.join('?' * len(stores))})")
+        params.extend(store_number_key(store) for store in stores)
+    if items:
+        if table == 'items':
+            where.append(f"ri.item_number IN ({', '.join('?' * len(items))})")
+        else:
+            where.append(f"r.id IN (SELECT receipt_id FROM receipt_item WHERE item_number IN ({', '.join('?' * len(items))}))")
+        params.extend(items)
+    
+    sql = f"SELECT {', '.join(expression for _, expression, _ in spec['columns'])} FROM {spec['from']}"
+    if where:
+        sql += ' WHERE ' + ' AND '.join(where)
+    sql += f" ORDER BY {spec['order_by']}"
+    return sql, params
+
+def iter_batches(cursor, batch_size):
+    """Rows from an executed cursor, batch_size at a time"""
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            return
+        yield rows
+
+def write_csv(batches, columns, output):
+    writer = csv.writer(output)
+    writer.writerow(columns)
+    count = 0
+    for rows in batches:
+        writer.writerows(rows)
+        count += len(rows)
+    return count
+
+def write_jsonl(batches, columns, output):
+    count = 0
+    for rows in batches:
+        output.write(''.join(json.dumps(dict(zip(columns, row))) + '\n' for row in rows))
+        count += len(rows)
+    return count
+
+def write_parquet(batches, columns, types, path):
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise RuntimeError("Parquet export needs pyarrow (pip install pyarrow)")
+    
+    schema = pa.schema([(name, getattr(pa, type_name)()) for name, type_name in zip(columns, types)])
+    count = 0
+    with pq.ParquetWriter(path, schema) as writer:
+        for rows in batches:
+            # One row group per batch, so memory stays bounded by the batch size
+            arrays = [pa.array(column, type=field.type) for column, field in zip(zip(*rows), schema)]
+            writer.write_batch(pa.record_batch(arrays, schema=schema))
+            count += len(rows)
+    return count
+
+def export_data(db_path, table, fmt, output=None, since=None, until=None, stores=None, items=None, batch_size=5000):
+    """Stream a table (with filters) to CSV, JSONL or Parquet; returns the row count"""
+    spec = EXPORTS[table]
+    columns = [name for name, _, _ in spec['columns']]
+    sql, params = export_query(table, since, until, stores, items)
+    
+    conn = connect(db_path)
+    try:
+        cursor = conn.execute(sql, params)
+        batches = iter_batches(cursor, batch_size)
+        if fmt == 'parquet':
+            if not output or output == '-':
+                raise RuntimeError("Parquet export needs --output FILE")
+            return write_parquet(batches, columns, [type_name for _, _, type_name in spec['columns']], output)
+        
+        writer = write_csv if fmt == 'csv' else write_jsonl
+        if not output or output == '-':
+            return writer(batches, columns, sys.stdout)
+        with open(output, 'w', newline='' if fmt == 'csv' else None, encoding='utf-8') as f:
+            return writer(batches, columns, f)
+    finally:
+        conn.close()
+
+def export_main(argv, db_path):
+    parser = argparse.ArgumentParser(prog='view_database.py export',
+                                     description='Stream receipt data to a file in bounded-size batches')
+    parser.add_argument('format', choices=['csv', 'jsonl', 'parquet'])
+    parser.add_argument('--table', choices=sorted(EXPORTS), default='items', help='what to export (default: items)')
+    parser.add_argument('--output', '-o', help='output file (default: stdout; required for parquet)')
+    parser.add_argument('--since', help='only rows recorded on/after this date (YYYY-MM-DD)')
+    parser.add_argument('--until', help='only rows recorded before this date (YYYY-MM-DD)')
+    parser.add_argument('--store', action='append', help='only this store number, e.g. 1061 (repeatable)')
+    parser.add_argument('--item', action='append', help='only this item number (repeatable)')
+    parser.add_argument('--batch-size', type=int, default=5000, help='rows fetched and written at a time')
+    args = parser.parse_args(argv)
+    
+    for name in ('since', 'until'):
+        value = getattr(args, name)
+        if value:
+            try:
+                datetime.fromisoformat(value)
+            except ValueError:
+                parser.error(f"--{name} must be an ISO date, e.g. 2024-01-31")
+    
+    try:
+        count = export_data(db_path, args.table, args.format, args.output, args.since, args.until,
+                            args.store, args.item, max(1, args.batch_size))
+    except (RuntimeError, FileNotFoundError, sqlite3.Error) as e:
+        print(f"❌ Export failed: {e}", file=sys.stderr)
+        return 1
+    print(f"✅ Exported {count} {args.table} row(s)", file=sys.stderr)
+    return 0
+
 if __name__ == "__main__":
-    import sys
+    # --db can go anywhere on the command line
+    db_parser = argparse.ArgumentParser(add_help=False)
+    db_parser.add_argument('--db', default=None)
+    db_args, argv = db_parser.parse_known_args()
+    db_path = db_args.db or default_db_path()
+    
+    if argv and argv[0] == 'export':
+        sys.exit(export_main(argv[1:], db_path))
     
-    if len(sys.argv) > 1:
+    if argv:
         # View specific item history
-        item_number = sys.argv[1]
-        view_item_history(item_number)
+        item_number = argv[0]
+        view_item_history(item_number, db_path)
     else:
         # View all data
-        view_all_data()
+        view_all_data(db_path)
     
     print("\n" + "=" * 80)
     print("USAGE:")
     print("  python view_database.py           # View all data")
     print("  python view_database.py 1797100  # View history for specific item")
-    print("=" * 80) 
\ No newline at end of file
+    print("  python view_database.py export csv -o items.csv [--since 2024-01-01] [--store 1061] [--item 1797100]")
+    print("  python view_database.py export jsonl|parquet [--table receipts]   # Other formats / tables")
+    print("  Add --db PATH to use a different database file")
+    print("=" * 80)